@@ -1,31 +1,111 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from django.http import JsonResponse
-from django.utils.deprecation import MiddlewareMixin
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.exceptions import TokenError, InvalidToken
 from rest_framework_simplejwt.serializers import TokenRefreshSerializer
 from rest_framework_simplejwt.tokens import AccessToken
 from django.utils.functional import SimpleLazyObject
-
-class JWTAutoRefreshTokenMiddleware(MiddlewareMixin):
-    def process_request(self, request):
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from WebChat.db_router import arequest_routing, get_replica_config, request_routing
+
+
+class HybridMiddleware:
+    """
+    Base for middleware that runs natively in both handler modes.
+
+    Under daphne the chain is async; a sync-only middleware would run
+    everything after it (views included) through a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.handle(request)
+
+
+class AsyncWhiteNoiseMiddleware(HybridMiddleware, WhiteNoiseMiddleware):
+    # WhiteNoiseMiddleware is sync-only; only static files leave the event loop here
+    def __init__(self, get_response=None):
+        WhiteNoiseMiddleware.__init__(self, get_response)
+        HybridMiddleware.__init__(self, get_response)
+
+    def handle(self, request):
+        return WhiteNoiseMiddleware.__call__(self, request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve)(static_file, request)
+        return await self.get_response(request)
+
+
+class ReadYourWritesMiddleware(HybridMiddleware):
+    # Lets the database router send reads to replicas, and keeps a user on
+    # the primary for a while after writes (see WebChat/db_router.py)
+    safe_methods = ("GET", "HEAD", "OPTIONS")
+
+    def handle(self, request):
+        if not get_replica_config()["ALIASES"]:
+            return self.get_response(request)
+        with request_routing(jwt_user_id(request), pinned=request.method not in self.safe_methods):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        if not get_replica_config()["ALIASES"]:
+            return await self.get_response(request)
+        async with arequest_routing(jwt_user_id(request), pinned=request.method not in self.safe_methods):
+            return await self.get_response(request)
+
+
+class JWTAutoRefreshTokenMiddleware(HybridMiddleware):
+    def handle(self, request):
+        response = self.process_request(request) or self.get_response(request)
+        return self.process_response(request, response)
+
+    async def __acall__(self, request):
+        # Checking the access token is CPU only; the refresh (token
+        # blacklist and user lookup) is the part that needs the database
+        response = None
+        if self.needs_refresh(request):
+            response = await sync_to_async(self.process_request)(request)
+        response = response or await self.get_response(request)
+        return self.process_response(request, response)
+
+    def needs_refresh(self, request):
         access_token = request.COOKIES.get("access")
-        refresh_token = request.COOKIES.get("refresh")
 
         # No access token → public request
         if not access_token:
-            return None
+            return False
 
         # Check access token validity
         try:
             AccessToken(access_token)
-            return None  # token valid → continue request
+            return False  # token valid → continue request
 
         except TokenError:
             # Access token expired or invalid
-            pass
+            return True
+
+    def process_request(self, request):
+        refresh_token = request.COOKIES.get("refresh")
+
+        if not self.needs_refresh(request):
+            return None
 
         # Access expired but refresh missing → logout
         if not refresh_token:
@@ -48,6 +128,8 @@ class JWTAutoRefreshTokenMiddleware(MiddlewareMixin):
             # Manually authenticate user
             user = JWTAuthentication().get_user(AccessToken(new_access))
             request.user = user
+            # What await request.auser() returns in async views
+            request._acached_user = user
 
         except (InvalidToken, TokenError, User.DoesNotExist):
             return self.logout_response("Invalid refresh token")
@@ -87,17 +169,48 @@ class JWTAutoRefreshTokenMiddleware(MiddlewareMixin):
 
 User = get_user_model()
 
-def get_jwt_user(request):
+def jwt_user_id(request):
     access = request.COOKIES.get("access")
     if not access:
-        return AnonymousUser()
+        return None
     try:
-        token = AccessToken(access)
-        return User.objects.get(id=token["user_id"])
+        return AccessToken(access)["user_id"]
     except Exception:
+        return None
+
+def get_jwt_user(request):
+    user_id = jwt_user_id(request)
+    if user_id is None:
+        return AnonymousUser()
+    try:
+        # Every page shows the user's avatar, so the profile comes along
+        return User.objects.select_related("profile").get(id=user_id)
+    except User.DoesNotExist:
         return AnonymousUser()
 
-class JWTAuthenticationMiddleware(MiddlewareMixin):
+async def aget_jwt_user(request):
+    if not hasattr(request, "_acached_user"):
+        user_id = jwt_user_id(request)
+        try:
+            request._acached_user = (
+                AnonymousUser() if user_id is None
+                else await User.objects.select_related("profile").aget(id=user_id)
+            )
+        except User.DoesNotExist:
+            request._acached_user = AnonymousUser()
+    return request._acached_user
+
+class JWTAuthenticationMiddleware(HybridMiddleware):
+    def handle(self, request):
+        self.process_request(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        self.process_request(request)
+        return await self.get_response(request)
+
     def process_request(self, request):
-        # Database query only happens if request.user is actually accessed
+        # Database query only happens if request.user (or, in async views,
+        # await request.auser()) is actually used
         request.user = SimpleLazyObject(lambda: get_jwt_user(request))
+        request.auser = lambda: aget_jwt_user(request)
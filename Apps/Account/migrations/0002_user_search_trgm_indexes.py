@@ -0,0 +1,40 @@
+from django.db import migrations
+
+SEARCH_FIELDS = ('username', 'first_name', 'last_name')
+
+
+def index_name(field):
+    return f'account_user_{field}_trgm'
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # pg_trgm GIN indexes answer the user search's UPPER(field) LIKE '%q%'
+    # without a sequential scan. Other databases use the in-memory prefix
+    # index in Apps.ChatApp.user_search instead.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = schema_editor.quote_name(apps.get_model('Account', 'User')._meta.db_table)
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for field in SEARCH_FIELDS:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {index_name(field)} ON {table} '
+            f'USING gin (UPPER({schema_editor.quote_name(field)}) gin_trgm_ops)'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for field in SEARCH_FIELDS:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {index_name(field)}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Account', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -2,4 +2,8 @@ from django.apps import AppConfig
 
 
 class ChatappConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
     name = 'Apps.ChatApp'
+
+    def ready(self):
+        import Apps.ChatApp.signals
@@ -0,0 +1,255 @@
+import gzip
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import storages
+from django.db import transaction
+from django.db.models import Exists, Max, OuterRef, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .message_search import unindex_messages
+from .pagination import DEFAULT_PAGE_SIZE, decode_cursor, message_page, paginate_messages
+
+logger = logging.getLogger("Apps.ChatApp.archive")
+
+DEFAULT_ARCHIVE_CONFIG = {
+    "STORAGE": "default",  # STORAGES alias: local files or an object store backend
+    "PREFIX": "chat-archive",
+    "AFTER_DAYS": 180,  # messages older than this leave the message table
+    "SEGMENT_SIZE": 1000,  # messages per compressed segment file
+    "CHATS_PER_RUN": 100,  # chats with cold messages handled per run, in id order
+    "CACHED_SEGMENTS": 32,  # decoded segments kept in each process
+}
+
+
+def get_archive_config():
+    return {**DEFAULT_ARCHIVE_CONFIG, **getattr(settings, "CHAT_ARCHIVE", {})}
+
+
+# Highest chat id handled by the previous run
+CURSOR_KEY = "chat:archive:cursor"
+
+
+def get_storage():
+    return storages[get_archive_config()["STORAGE"]]
+
+
+def encode_segment(rows):
+    # rows: (id, seq, sender_id, content, timestamp), oldest first; one JSON list per line
+    lines = (
+        json.dumps([message_id, seq, sender_id, content, timestamp.isoformat()])
+        for message_id, seq, sender_id, content, timestamp in rows
+    )
+    return gzip.compress("\n".join(lines).encode())
+
+
+def decode_segment(data):
+    rows = []
+    for line in gzip.decompress(data).decode().splitlines():
+        message_id, seq, sender_id, content, timestamp = json.loads(line)
+        rows.append((message_id, seq, sender_id, content, parse_datetime(timestamp)))
+    return rows
+
+
+class SegmentCache:
+    """
+    Decoded segments by path, least recently used dropped first.
+
+    Segments never change once written, so entries need no invalidation;
+    paging back through an archived chat reads each file once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.segments = OrderedDict()  # path -> rows
+
+    def rows(self, path):
+        with self.lock:
+            if path in self.segments:
+                self.segments.move_to_end(path)
+                return self.segments[path]
+
+        with get_storage().open(path, "rb") as segment_file:
+            rows = decode_segment(segment_file.read())
+
+        with self.lock:
+            self.segments[path] = rows
+            while len(self.segments) > get_archive_config()["CACHED_SEGMENTS"]:
+                self.segments.popitem(last=False)
+        return rows
+
+    def clear(self):
+        with self.lock:
+            self.segments.clear()
+
+
+segment_cache = SegmentCache()
+
+
+def archive_chat(chat_id, cutoff, idle=False):
+    """
+    Move the chat's messages older than cutoff into segment files.
+
+    Only whole segments are written unless the chat is idle (nothing newer
+    than cutoff), so busy chats do not leave a trail of tiny files. The
+    file is written before the rows are deleted: a run that dies in between
+    leaves the messages in the table and the next run rewrites the file.
+    """
+    from .models import Message, MessageArchiveSegment
+
+    config = get_archive_config()
+    storage = get_storage()
+    archived = 0
+    while True:
+        rows = list(
+            Message.objects.filter(chat_id=chat_id, timestamp__lt=cutoff)
+            .order_by('timestamp', 'id')
+            .values_list('id', 'seq', 'sender_id', 'content', 'timestamp')[:config["SEGMENT_SIZE"]]
+        )
+        if not rows or (len(rows) < config["SEGMENT_SIZE"] and not idle):
+            return archived
+
+        first, last = rows[0], rows[-1]
+        path = f"{config['PREFIX']}/{chat_id}/{first[0]}-{last[0]}.jsonl.gz"
+        if storage.exists(path):
+            storage.delete(path)
+        path = storage.save(path, ContentFile(encode_segment(rows)))
+
+        message_ids = [row[0] for row in rows]
+        with transaction.atomic():
+            MessageArchiveSegment.objects.create(
+                chat_id=chat_id,
+                path=path,
+                first_timestamp=first[4],
+                first_message_id=first[0],
+                last_timestamp=last[4],
+                last_message_id=last[0],
+                last_seq=max((row[1] for row in rows if row[1] is not None), default=None),
+                message_count=len(rows),
+            )
+            unindex_messages(message_ids)
+            Message.objects.filter(id__in=message_ids).delete()
+        archived += len(rows)
+
+
+def archive_cold_messages(now=None):
+    """
+    Archive the next CHATS_PER_RUN chats holding cold messages; returns messages moved.
+
+    Chats are walked in id order from where the previous run stopped, and
+    each is probed for one cold message through message_chat_ts_id_idx, so
+    a run never scans or groups the message table. Once the walk reaches
+    the last chat the next run starts over.
+    """
+    from .models import Chat, Message
+
+    config = get_archive_config()
+    cutoff = (now or timezone.now()) - timedelta(days=config["AFTER_DAYS"])
+    cold = Message.objects.filter(chat_id=OuterRef('pk'), timestamp__lt=cutoff)
+    chats = list(
+        Chat.objects.filter(id__gt=cache.get(CURSOR_KEY) or 0)
+        .filter(Exists(cold))
+        .order_by('id')
+        .values_list('id', 'updated_at')[:config["CHATS_PER_RUN"]]
+    )
+    cache.set(CURSOR_KEY, chats[-1][0] if len(chats) == config["CHATS_PER_RUN"] else 0, timeout=None)
+
+    archived = 0
+    for chat_id, updated_at in chats:
+        try:
+            archived += archive_chat(chat_id, cutoff, idle=updated_at < cutoff)
+        except Exception:
+            logger.error(f"[FAIL] archive -> chat_id={chat_id}", exc_info=True)
+    return archived
+
+
+def last_archived_seq(chat_id):
+    from .models import MessageArchiveSegment
+
+    return MessageArchiveSegment.objects.filter(chat_id=chat_id).aggregate(Max('last_seq'))['last_seq__max'] or 0
+
+
+def archived_page(chat_id, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    (messages, has_more) read from the chat's segments.
+
+    before/after are decoded (timestamp, id) cursors. Same order as
+    keyset_page: newest first, or oldest first for `after`. Messages are
+    unsaved Message instances with their sender attached.
+    """
+    from .models import Message, MessageArchiveSegment
+
+    segments = MessageArchiveSegment.objects.filter(chat_id=chat_id).only('path')
+    if after:
+        segments = segments.filter(
+            Q(last_timestamp__gt=after[0]) | Q(last_timestamp=after[0], last_message_id__gt=after[1])
+        ).order_by('last_timestamp', 'last_message_id')
+    else:
+        if before:
+            segments = segments.filter(
+                Q(first_timestamp__lt=before[0]) | Q(first_timestamp=before[0], first_message_id__lt=before[1])
+            )
+        segments = segments.order_by('-last_timestamp', '-last_message_id')
+
+    rows = []
+    for segment in segments:
+        segment_rows = segment_cache.rows(segment.path)
+        if after:
+            rows.extend(row for row in segment_rows if (row[4], row[0]) > after)
+        else:
+            rows.extend(row for row in reversed(segment_rows) if not before or (row[4], row[0]) < before)
+        if len(rows) > limit:
+            break
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    senders = get_user_model().objects.only('id', 'username').in_bulk({row[2] for row in rows})
+    messages = []
+    for message_id, seq, sender_id, content, timestamp in rows:
+        # Deleted accounts take their messages with them, archived or not
+        if sender_id in senders:
+            message = Message(id=message_id, chat_id=chat_id, sender_id=sender_id, content=content, seq=seq)
+            message.timestamp = timestamp
+            message.sender = senders[sender_id]
+            messages.append(message)
+    return messages, has_more
+
+
+def history_page(chat_id, queryset, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    paginate_messages over the hot queryset, read through to the archive.
+
+    Segments only hold messages older than anything left in the table, so
+    the archive is consulted only when a page runs off the old end of the
+    table (or starts before it, for `after`).
+    """
+    page = paginate_messages(queryset, before=before, after=after, limit=limit)
+    messages = page['messages']
+
+    if after:
+        archived, more = archived_page(chat_id, after=decode_cursor(after), limit=limit)
+        if not archived:
+            return page
+        rows = archived + messages
+        return message_page(rows[:limit], has_older=True, has_newer=more or page['has_newer'] or len(rows) > limit)
+
+    # seq 1 is the chat's first message, nothing was archived before it
+    if page['has_older'] or (messages and messages[0].seq == 1):
+        return page
+    if messages:
+        cursor = (messages[0].timestamp, messages[0].id)
+    else:
+        cursor = decode_cursor(before) if before else None
+    archived, more = archived_page(chat_id, before=cursor, limit=limit - len(messages))
+    if not archived and not more:
+        return page
+    archived.reverse()
+    return message_page(archived + messages, has_older=more, has_newer=page['has_newer'])
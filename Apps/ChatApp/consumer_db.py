@@ -0,0 +1,66 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connection
+
+DEFAULT_CONSUMER_DB_CONFIG = {
+    # Consumer database calls in flight per worker process, each on its own
+    # thread and connection. None queues them all on asgiref's single sync
+    # thread, as plain database_sync_to_async does.
+    "MAX_CONCURRENCY": 8,
+}
+
+
+def get_consumer_db_config():
+    return {**DEFAULT_CONSUMER_DB_CONFIG, **getattr(settings, "CHAT_CONSUMER_DB", {})}
+
+
+class ConsumerDB:
+    """
+    Runs ChatConsumer's blocking database work off the event loop.
+
+    database_sync_to_async is thread-sensitive: outside a request scope every
+    call in the process waits for the same sync thread, so one slow INSERT
+    holds up membership checks and saves on every socket. Calls here go to
+    a pool of MAX_CONCURRENCY threads instead; more than that wait on the
+    event loop. Django's async ORM would not help, it hops to that same
+    thread per query.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.size = None
+        # execute_wrappers applied to every query run through here
+        self.execute_wrappers = []
+
+    def get_executor(self):
+        size = get_consumer_db_config()["MAX_CONCURRENCY"]
+        with self.lock:
+            if size != self.size:
+                if self.executor is not None:
+                    self.executor.shutdown(wait=False)
+                self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="consumer-db") if size else None
+                self.size = size
+            return self.executor
+
+    def call(self, func, *args, **kwargs):
+        with ExitStack() as stack:
+            for wrapper in list(self.execute_wrappers):
+                stack.enter_context(connection.execute_wrapper(wrapper))
+            return func(*args, **kwargs)
+
+    async def run(self, func, *args, **kwargs):
+        executor = self.get_executor()
+        if executor is None:
+            return await database_sync_to_async(self.call)(func, *args, **kwargs)
+        # close_old_connections around each call, as for database_sync_to_async
+        return await database_sync_to_async(self.call, thread_sensitive=False, executor=executor)(
+            func, *args, **kwargs
+        )
+
+
+consumer_db = ConsumerDB()
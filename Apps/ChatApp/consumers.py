@@ -1,48 +1,158 @@
-import json
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
+from .consumer_db import consumer_db
+from .history import (
+    build_message_frame, bump_history_versions, claim_client_id, collect_missed, message_event,
+    next_seq, recent_history, release_client_id,
+)
+from .membership import chat_membership
+from .message_buffer import message_buffer, write_behind_enabled
+from .message_search import queue_indexing
+from .outbound import SLOW_CONSUMER_CLOSE_CODE, SLOW_CONSUMER_CLOSE_REASON, OutboundQueue
+from .presence import presence
+from .read_state import ReadReceiptBatcher, mark_read_seq
+from .summaries import record_messages
+from .typing_indicators import TypingTracker
+from .wire import MSGPACK_PROTOCOL, choose_protocol, decode_frame, encode_frame, to_epoch_ms
+
+DEFAULT_SUBSCRIPTIONS_CONFIG = {
+    "MAX_PER_SOCKET": 100,  # chats one socket may be subscribed to at the same time
+}
+
+
+def get_subscriptions_config():
+    return {**DEFAULT_SUBSCRIPTIONS_CONFIG, **getattr(settings, "CHAT_SUBSCRIPTIONS", {})}
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.chat_id = self.scope['url_route']['kwargs']['chat_id']
-        self.chat_group_name = f'chat_{self.chat_id}'
         self.user = self.scope['user']
+        # chat_id -> group name for every chat this socket is subscribed to
+        self.chat_groups = {}
+        # Only typing state transitions are broadcast, see TypingTracker
+        self.typing = TypingTracker(self.publish_typing)
+        # Read frames are batched per chat, see ReadReceiptBatcher
+        self.read_receipts = ReadReceiptBatcher(self.publish_read)
+        # Wire format negotiated via Sec-WebSocket-Protocol, JSON by default
+        self.subprotocol = choose_protocol(self.scope.get('subprotocols'))
+        self.binary = self.subprotocol == MSGPACK_PROTOCOL
+        # Bounded per-socket send queue, see OutboundQueue
+        self.outbound = OutboundQueue(self.write)
 
-        if self.user.is_anonymous:
-            await self.close()
-            return
+        # Legacy per-chat endpoint (ws/chat/<chat_id>/) subscribes on connect,
+        # the per-user endpoint (ws/chat/) waits for subscribe frames.
+        url_chat_id = self.scope['url_route']['kwargs'].get('chat_id')
+        self.default_chat_id = int(url_chat_id) if url_chat_id else None
 
-        # Check if user is participant in this chat
-        if not await self.is_chat_participant():
+        if self.user.is_anonymous:
             await self.close()
             return
 
-        # Join chat group
-        await self.channel_layer.group_add(
-            self.chat_group_name,
-            self.channel_name
-        )
+        if self.default_chat_id is not None:
+            if not await self.subscribe(self.default_chat_id):
+                await self.close()
+                return
 
         # Update user online status
         await self.update_user_status(True)
 
-        await self.accept()
+        await self.accept(subprotocol=self.subprotocol)
 
     async def disconnect(self, close_code):
-        # Leave chat group
-        await self.channel_layer.group_discard(
-            self.chat_group_name,
-            self.channel_name
-        )
+        # Record and announce reads before leaving the groups
+        await self.read_receipts.close()
+        # Leave every chat group this socket joined
+        for chat_id, group_name in self.chat_groups.items():
+            await self.typing.clear(chat_id)
+            await self.channel_layer.group_discard(
+                group_name,
+                self.channel_name
+            )
+        self.chat_groups = {}
+        self.outbound.close()
+
+        if self.user.is_anonymous:
+            return
 
         # Update user offline status
         await self.update_user_status(False)
 
+    async def subscribe(self, chat_id):
+        if chat_id in self.chat_groups:
+            return True
+
+        if len(self.chat_groups) >= get_subscriptions_config()["MAX_PER_SOCKET"]:
+            return False
+
+        # Check if user is participant in this chat
+        if not await self.is_chat_participant(chat_id):
+            return False
+
+        group_name = f'chat_{chat_id}'
+        await self.channel_layer.group_add(group_name, self.channel_name)
+        self.chat_groups[chat_id] = group_name
+        return True
+
+    async def unsubscribe(self, chat_id):
+        await self.typing.clear(chat_id)
+        group_name = self.chat_groups.pop(chat_id, None)
+        if group_name:
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+
+    def get_frame_chat_id(self, data):
+        # Frames on the legacy endpoint may omit chat_id
+        chat_id = data.get('chat_id', self.default_chat_id)
+        try:
+            return int(chat_id)
+        except (TypeError, ValueError):
+            return None
+
     async def receive(self, text_data=None, bytes_data=None):
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = decode_frame(text_data, bytes_data)
             message_type = text_data_json.get('type', 'chat_message')
+            chat_id = self.get_frame_chat_id(text_data_json)
+
+            if message_type == 'subscribe':
+                if chat_id is not None and await self.subscribe(chat_id):
+                    await self.send_frame({
+                        'type': 'subscribed',
+                        'chat_id': chat_id,
+                    })
+                else:
+                    await self.send_frame({
+                        'type': 'error',
+                        'chat_id': chat_id,
+                        'error': 'subscribe_denied',
+                    })
+                return
+
+            if message_type == 'resume':
+                # Subscribe and replay what was missed since last_seq
+                if chat_id is None or not await self.subscribe(chat_id):
+                    await self.send_frame({
+                        'type': 'error',
+                        'chat_id': chat_id,
+                        'error': 'resume_denied',
+                    })
+                    return
+                await self.replay(chat_id, int(text_data_json.get('last_seq') or 0))
+                return
+
+            if message_type == 'unsubscribe':
+                if chat_id is not None:
+                    await self.unsubscribe(chat_id)
+                    await self.send_frame({
+                        'type': 'unsubscribed',
+                        'chat_id': chat_id,
+                    })
+                return
+
+            # Everything below is routed to a chat the socket must be subscribed to
+            if chat_id not in self.chat_groups:
+                return
 
             if message_type == 'chat_message':
                 message_content = text_data_json.get('message', '').strip()
@@ -50,49 +160,123 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 if not message_content:
                     return
 
-                # Save message to database
-                message_data = await self.save_message(message_content)
+                # Client-generated id; a retried send with the same id is dropped
+                client_id = str(text_data_json.get('client_id') or '')[:64]
+
+                # Save message to database, or queue it and broadcast right
+                # away when write-behind persistence is enabled
+                if write_behind_enabled():
+                    seq = await consumer_db.run(self.allocate_seq, chat_id, client_id)
+                    message_data = None
+                    if seq is not None:
+                        message_data = await message_buffer.add(chat_id, self.user.id, message_content, seq, client_id)
+                else:
+                    message_data = await self.save_message(chat_id, message_content, client_id)
 
                 if message_data:
-                    # Send message to chat with proper timestamp
+                    # Send message to chat with its seq and epoch-ms timestamp.
+                    # The frame is encoded once here; every recipient forwards
+                    # the same payload and works out "is it mine" from sender_id.
                     await self.channel_layer.group_send(
-                        self.chat_group_name,
-                        {
-                            'type': 'chat_message',
-                            'message': message_content,
-                            'sender': self.user.username,
-                            'sender_id': self.user.id,
-                            'timestamp': message_data['timestamp'],
-                            'message_id': message_data['id'],
-                        }
+                        self.chat_groups[chat_id],
+                        message_event(build_message_frame(
+                            chat_id,
+                            message_data['seq'],
+                            message_data['id'],
+                            message_content,
+                            self.user.username,
+                            self.user.id,
+                            message_data['timestamp'],
+                            client_id,
+                        ))
                     )
 
             elif message_type == 'typing':
-                # Handle typing indicator
-                await self.channel_layer.group_send(
-                    self.chat_group_name,
-                    {
-                        'type': 'typing_indicator',
-                        'user': self.user.username,
-                        'user_id': self.user.id,
-                        'is_typing': text_data_json.get('is_typing', False),
-                    }
-                )
+                # Handle typing indicator (coalesced per chat)
+                await self.typing.update(chat_id, bool(text_data_json.get('is_typing', False)))
+
+            elif message_type == 'read':
+                # Read up to seq; one watermark write per chat per interval
+                self.read_receipts.mark(chat_id, int(text_data_json.get('seq') or 0))
 
         except Exception:
             pass
 
+    async def publish_typing(self, chat_id, is_typing):
+        group_name = self.chat_groups.get(chat_id)
+        if not group_name:
+            return
+        await self.channel_layer.group_send(
+            group_name,
+            {
+                'type': 'typing_indicator',
+                # Kept outside the encoded frame so handlers can skip the sender
+                'user_id': self.user.id,
+                **encode_frame({
+                    'type': 'typing_indicator',
+                    'chat_id': chat_id,
+                    'user': self.user.username,
+                    'is_typing': is_typing,
+                }),
+            }
+        )
+
+    async def publish_read(self, chat_id, seq):
+        if not await consumer_db.run(mark_read_seq, chat_id, self.user.id, seq):
+            return
+        group_name = self.chat_groups.get(chat_id)
+        if not group_name:
+            return
+        await self.channel_layer.group_send(
+            group_name,
+            {
+                'type': 'read_receipt',
+                **encode_frame({
+                    'type': 'read_receipt',
+                    'chat_id': chat_id,
+                    'user_id': self.user.id,
+                    'seq': seq,
+                }),
+            }
+        )
+
+    async def replay(self, chat_id, last_seq):
+        events = await consumer_db.run(collect_missed, chat_id, last_seq)
+        if events is None:
+            # Gap too large to replay, the client reloads the room instead
+            await self.send_frame({
+                'type': 'error',
+                'chat_id': chat_id,
+                'error': 'resync_required',
+            })
+            return
+        for event in events:
+            await self.send_encoded(event)
+        await self.send_frame({'type': 'resumed', 'chat_id': chat_id})
+
+    async def send_frame(self, frame):
+        await self.send_encoded(encode_frame(frame))
+
+    def encoded_payload(self, event):
+        # The pre-encoded frame in this socket's wire format
+        return event['bytes'] if self.binary else event['text']
+
+    async def send_encoded(self, event, droppable=False):
+        if not self.outbound.put(self.encoded_payload(event), droppable):
+            # Slow consumer: drop the socket; the client reconnects and
+            # resumes from its last seq instead of us buffering without bound
+            await self.close(code=SLOW_CONSUMER_CLOSE_CODE, reason=SLOW_CONSUMER_CLOSE_REASON)
+
+    async def write(self, payload):
+        if isinstance(payload, bytes):
+            await self.send(bytes_data=payload)
+        else:
+            await self.send(text_data=payload)
+
     async def chat_message(self, event):
-        # Send message to WebSocket
+        recent_history.add(event.get('chat_id'), event.get('seq'), event)
         try:
-            await self.send(text_data=json.dumps({
-                'type': 'chat_message',
-                'message': event['message'],
-                'sender': event['sender'],
-                'sender_id': event['sender_id'],
-                'timestamp': event['timestamp'],
-                'message_id': event['message_id'],
-            }))
+            await self.send_encoded(event)
         except Exception:
             pass
 
@@ -100,58 +284,80 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # Don't send typing indicator to the sender
         if event['user_id'] != self.user.id:
             try:
-                await self.send(text_data=json.dumps({
-                    'type': 'typing_indicator',
-                    'user': event['user'],
-                    'is_typing': event['is_typing'],
-                }))
+                # Typing frames are the first to go when the queue backs up
+                await self.send_encoded(event, droppable=True)
             except Exception:
                 pass
 
-    @database_sync_to_async
-    def is_chat_participant(self):
-        from .models import Chat
+    async def read_receipt(self, event):
+        try:
+            # A later receipt supersedes this one, so it may be shed too
+            await self.send_encoded(event, droppable=True)
+        except Exception:
+            pass
+
+    async def is_chat_participant(self, chat_id):
+        # Local LRU hit answers without a thread hop; misses fall through
+        # to the shared cache and finally the database
+        members = chat_membership.peek(chat_id)
+        if members is not None:
+            return self.user.id in members
         try:
-            chat = Chat.objects.get(id=self.chat_id)
-            return chat.participants.filter(id=self.user.id).exists()
+            return await consumer_db.run(chat_membership.is_member, chat_id, self.user.id)
         except Exception:
             return False
 
-    @database_sync_to_async
-    def save_message(self, content):
+    def allocate_seq(self, chat_id, client_id):
+        # None means the client already sent this message (retry)
+        if client_id and not claim_client_id(chat_id, self.user.id, client_id):
+            return None
+        return next_seq(chat_id)
+
+    async def save_message(self, chat_id, content, client_id=''):
+        return await consumer_db.run(self.store_message, chat_id, content, client_id)
+
+    def store_message(self, chat_id, content, client_id=''):
         from .models import Chat, Message
+        seq = self.allocate_seq(chat_id, client_id)
+        if seq is None:
+            return None
         try:
-            # chat = Chat.objects.get(id=self.chat_id)
-            message = Message.objects.create(
-                chat_id=self.chat_id,
-                sender=self.user,
-                content=content
-            )
+            with transaction.atomic():
+                # chat = Chat.objects.get(id=chat_id)
+                message = Message.objects.create(
+                    chat_id=chat_id,
+                    sender=self.user,
+                    content=content,
+                    seq=seq,
+                    client_id=client_id,
+                )
+                record_messages([message])
+                bump_history_versions([chat_id])
+                # Indexed for search by a Celery task after commit
+                queue_indexing([message.id])
 
-            Chat.objects.filter(id=self.chat_id).update(updated_at=timezone.now())
+                Chat.objects.filter(id=chat_id).update(updated_at=timezone.now())
             # Update chat's updated_at field
             # chat.updated_at = timezone.now()
             # chat.save()
 
-            # Return timestamp in the format we want (like 5:49 PM)
+            # Epoch milliseconds, clients format it (like 5:49 PM)
             return {
                 'id': message.id,
-                'timestamp': message.timestamp.strftime('%I:%M %p').lstrip('0'),
+                'seq': seq,
+                'timestamp': to_epoch_ms(message.timestamp),
             }
         except Exception:
+            # Let the client retry with the same id
+            if client_id:
+                release_client_id(chat_id, self.user.id, client_id)
             return None
 
-    @database_sync_to_async
-    def update_user_status(self, is_online):
-        from Apps.Account.models import UserProfile
-        UserProfile.objects.filter(user=self.user).update(
-            is_online=is_online,
-            last_seen=timezone.now()
-        )
-        # try:
-        #     profile, created = UserProfile.objects.get_or_create(user=self.user)
-        #     profile.is_online = is_online
-        #     profile.last_seen = timezone.now()
-        #     profile.save()
-        # except Exception:
-        #     pass
+    async def update_user_status(self, is_online):
+        # Connection-counted presence: one entry per socket, so closing one
+        # of two tabs keeps the user online. last_seen reaches UserProfile
+        # through the periodic chat.flush_presence task.
+        if is_online:
+            await presence.aconnect(self.user.id, self.channel_name)
+        else:
+            await presence.adisconnect(self.user.id, self.channel_name)
@@ -0,0 +1,184 @@
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max
+
+from .wire import encode_frame, to_epoch_ms
+
+DEFAULT_RESUME_CONFIG = {
+    "BUFFER_SIZE": 200,  # recent messages kept per chat in each process
+    "MAX_CHATS": 1000,  # chats with a recent-history buffer in each process
+    "MAX_REPLAY": 500,  # larger gaps make the client reload instead
+    "IDEMPOTENCY_TTL": 300,  # seconds a client message id is remembered
+}
+
+
+def get_resume_config():
+    return {**DEFAULT_RESUME_CONFIG, **getattr(settings, "CHAT_RESUME", {})}
+
+
+def seq_key(chat_id):
+    return f"chat:{chat_id}:seq"
+
+
+def next_seq(chat_id):
+    """Allocate the next per-chat sequence number from the shared cache."""
+    from .models import Message
+
+    try:
+        return cache.incr(seq_key(chat_id))
+    except ValueError:
+        # Counter missing (first message, or cache flushed): seed from the
+        # table, or the archive when every message has been archived
+        from .archive import last_archived_seq
+
+        current = Message.objects.filter(chat_id=chat_id).aggregate(Max('seq'))['seq__max'] or 0
+        current = current or last_archived_seq(chat_id)
+        cache.add(seq_key(chat_id), current, timeout=None)
+        return cache.incr(seq_key(chat_id))
+
+
+def current_seq(chat_id):
+    return cache.get(seq_key(chat_id))
+
+
+def history_version_key(chat_id):
+    return f"chat:{chat_id}:version"
+
+
+def bump_history_versions(chat_ids):
+    """Give each chat a new history version (its ETag) once the messages are committed."""
+    chat_ids = set(chat_ids)
+    if not chat_ids:
+        return
+
+    def bump():
+        version = uuid.uuid4().hex[:12]
+        cache.set_many({history_version_key(chat_id): version for chat_id in chat_ids}, timeout=None)
+
+    transaction.on_commit(bump)
+
+
+def history_version(chat_id):
+    version = cache.get(history_version_key(chat_id))
+    if version is None:
+        # Unknown after a cache flush: a fresh version, so no stale 304s
+        cache.add(history_version_key(chat_id), uuid.uuid4().hex[:12], timeout=None)
+        version = cache.get(history_version_key(chat_id))
+    return version
+
+
+def claim_client_id(chat_id, user_id, client_id):
+    """False when this client message id was already seen (a retried send)."""
+    key = f"chat:{chat_id}:client:{user_id}:{client_id}"
+    return cache.add(key, 1, timeout=get_resume_config()["IDEMPOTENCY_TTL"])
+
+
+def release_client_id(chat_id, user_id, client_id):
+    cache.delete(f"chat:{chat_id}:client:{user_id}:{client_id}")
+
+
+def build_message_frame(chat_id, seq, message_id, content, sender, sender_id, timestamp_ms, client_id=None):
+    frame = {
+        'type': 'chat_message',
+        'chat_id': chat_id,
+        'seq': seq,
+        'message': content,
+        'sender': sender,
+        'sender_id': sender_id,
+        'timestamp': timestamp_ms,
+        'message_id': message_id,
+    }
+    if client_id:
+        frame['client_id'] = client_id
+    return frame
+
+
+def message_event(frame):
+    # Channel-layer event: chat_id/seq in the clear for the history buffer,
+    # the frame itself pre-encoded once per wire format
+    return {'type': 'chat_message', 'chat_id': frame['chat_id'], 'seq': frame['seq'], **encode_frame(frame)}
+
+
+class RecentHistory:
+    """
+    Last BUFFER_SIZE encoded message events per chat, in this process.
+
+    Filled from the events every subscribed socket receives anyway, so
+    replays after a short drop never touch the database.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chats = OrderedDict()  # chat_id -> {seq: event}
+
+    def add(self, chat_id, seq, event):
+        # Every local recipient offers the same event; only the first is kept
+        if seq is None:
+            return
+        config = get_resume_config()
+        with self.lock:
+            events = self.chats.setdefault(chat_id, {})
+            self.chats.move_to_end(chat_id)
+            if seq in events:
+                return
+            events[seq] = event
+            if len(events) > config["BUFFER_SIZE"]:
+                del events[min(events)]
+            while len(self.chats) > config["MAX_CHATS"]:
+                self.chats.popitem(last=False)
+
+    def since(self, chat_id, after_seq, latest_seq):
+        """Events after after_seq, or None unless they cover the gap exactly."""
+        if latest_seq is None:
+            return None
+        with self.lock:
+            events = self.chats.get(chat_id, {})
+            seqs = sorted(seq for seq in events if seq > after_seq)
+            missed = [events[seq] for seq in seqs]
+        if seqs != list(range(after_seq + 1, latest_seq + 1)):
+            return None
+        return missed
+
+
+recent_history = RecentHistory()
+
+
+def load_missed_from_db(chat_id, after_seq, limit):
+    from .models import Message
+
+    messages = (
+        Message.objects.filter(chat_id=chat_id, seq__gt=after_seq)
+        .select_related('sender')
+        .order_by('seq')[:limit]
+    )
+    return [
+        (message.seq, message_event(build_message_frame(
+            chat_id, message.seq, message.id, message.content,
+            message.sender.username, message.sender_id, to_epoch_ms(message.timestamp),
+            message.client_id,
+        )))
+        for message in messages
+    ]
+
+
+def collect_missed(chat_id, after_seq):
+    """
+    Encoded events the client missed since after_seq, or None when the gap
+    is larger than MAX_REPLAY and the client has to reload.
+    """
+    limit = get_resume_config()["MAX_REPLAY"]
+    events = recent_history.since(chat_id, after_seq, current_seq(chat_id))
+    if events is None:
+        from_db = load_missed_from_db(chat_id, after_seq, limit + 1)
+        # Write-behind messages may not be in the table yet
+        last_db_seq = from_db[-1][0] if from_db else after_seq
+        buffered = recent_history.since(chat_id, last_db_seq, current_seq(chat_id)) or []
+        events = [event for _, event in from_db] + buffered
+    if len(events) > limit:
+        return None
+    return events
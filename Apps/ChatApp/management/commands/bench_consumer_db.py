@@ -0,0 +1,95 @@
+import asyncio
+import json
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from Apps.ChatApp.consumer_db import consumer_db
+from Apps.ChatApp.consumers import ChatConsumer
+from Apps.ChatApp.membership import chat_membership
+from Apps.ChatApp.models import Chat, Message
+
+
+class NullLayer:
+    async def group_send(self, group, message):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark: chat_message frames/sec through one worker's consumers, single sync "
+        "thread vs the consumer DB pool. Writes to (and cleans up after itself in) the configured database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sockets", type=int, default=50, help="one chat per socket")
+        parser.add_argument("--frames", type=int, default=20, help="frames per socket")
+        parser.add_argument("--concurrency", type=int, default=8, help="CHAT_CONSUMER_DB MAX_CONCURRENCY")
+        parser.add_argument(
+            "--rtt-ms", type=float, default=0,
+            help="added to every query, to model a database across the network from a local one",
+        )
+
+    def handle(self, *args, **options):
+        sockets, frames = options["sockets"], options["frames"]
+        users = []
+        for _ in range(2):
+            username = f"bench-{uuid.uuid4().hex[:12]}"
+            users.append(get_user_model().objects.create_user(username=username, email=f"{username}@example.com"))
+        chats = Chat.objects.bulk_create(
+            [Chat(chat_type='group', name="bench_consumer_db") for _ in range(sockets)]
+        )
+        for chat in chats:
+            chat.participants.set(users)
+
+        def round_trip(execute, sql, params, many, context):
+            time.sleep(options["rtt_ms"] / 1000)
+            return execute(sql, params, many, context)
+
+        if options["rtt_ms"]:
+            consumer_db.execute_wrappers.append(round_trip)
+        try:
+            with override_settings(CHAT_CONSUMER_DB={"MAX_CONCURRENCY": None}):
+                before = asyncio.run(self.run(chats, users[0], frames))
+            with override_settings(CHAT_CONSUMER_DB={"MAX_CONCURRENCY": options["concurrency"]}):
+                after = asyncio.run(self.run(chats, users[0], frames))
+            saved = Message.objects.filter(chat__in=chats).count()
+        finally:
+            if options["rtt_ms"]:
+                consumer_db.execute_wrappers.remove(round_trip)
+            Chat.objects.filter(id__in=[chat.id for chat in chats]).delete()
+            for user in users:
+                user.delete()
+
+        total = sockets * frames
+        self.stdout.write(
+            f"sockets={sockets} frames={total} concurrency={options['concurrency']} "
+            f"rtt={options['rtt_ms']}ms saved={saved}/{2 * total}"
+        )
+        self.stdout.write(f"before: {total / before:.0f} frames/sec (single sync thread)")
+        self.stdout.write(f"after:  {total / after:.0f} frames/sec (consumer DB pool)")
+        self.stdout.write(self.style.SUCCESS(f"speedup: {before / after:.1f}x"))
+
+    async def run(self, chats, user, frames):
+        async def socket(chat_id):
+            consumer = ChatConsumer()
+            consumer.user = user
+            consumer.channel_layer = NullLayer()
+            consumer.default_chat_id = None
+            consumer.chat_groups = {chat_id: f"chat_{chat_id}"}
+            for number in range(frames):
+                # Every frame misses the local membership layer and saves a message
+                chat_membership.clear_local()
+                await consumer.is_chat_participant(chat_id)
+                await consumer.receive(text_data=json.dumps({
+                    "type": "chat_message",
+                    "chat_id": chat_id,
+                    "message": f"benchmark frame {number}",
+                }))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(socket(chat.id) for chat in chats))
+        return time.perf_counter() - start
@@ -0,0 +1,80 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+from Apps.ChatApp.consumers import ChatConsumer
+from Apps.ChatApp.wire import encode_frame
+
+
+async def legacy_chat_message(consumer, event):
+    # Handler as it was before serialize-once: one json.dumps per recipient
+    await consumer.send(text_data=json.dumps({
+        'type': 'chat_message',
+        'chat_id': event['chat_id'],
+        'message': event['message'],
+        'sender': event['sender'],
+        'sender_id': event['sender_id'],
+        'timestamp': event['timestamp'],
+        'message_id': event['message_id'],
+    }))
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark: CPU per delivered group message, per-recipient encoding vs serialize-once"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--recipients", type=int, default=500)
+        parser.add_argument("--messages", type=int, default=200)
+
+    def handle(self, *args, **options):
+        recipients = options["recipients"]
+        messages = options["messages"]
+        before, after = asyncio.run(self.run(recipients, messages))
+        delivered = recipients * messages
+
+        self.stdout.write(f"recipients={recipients} messages={messages} delivered={delivered}")
+        self.stdout.write(f"before: {before / delivered * 1e6:.2f} µs CPU per delivered message")
+        self.stdout.write(f"after:  {after / delivered * 1e6:.2f} µs CPU per delivered message")
+        self.stdout.write(self.style.SUCCESS(f"speedup: {before / after:.1f}x"))
+
+    async def run(self, recipients, messages):
+        async def discard(text_data=None, bytes_data=None):
+            pass
+
+        consumers = []
+        for user_id in range(recipients):
+            consumer = ChatConsumer()
+            consumer.user = SimpleNamespace(id=user_id)
+            consumer.binary = False
+            consumer.send = discard
+            consumers.append(consumer)
+
+        frame = {
+            'type': 'chat_message',
+            'chat_id': 42,
+            'message': "Hey, are we still on for the standup at ten?",
+            'sender': "khetu",
+            'sender_id': 1,
+            'timestamp': 1760000000000,
+            'message_id': 123456,
+        }
+
+        start = time.process_time()
+        for _ in range(messages):
+            event = dict(frame)
+            for consumer in consumers:
+                await legacy_chat_message(consumer, event)
+        before = time.process_time() - start
+
+        start = time.process_time()
+        for _ in range(messages):
+            event = {'type': 'chat_message', **encode_frame(frame)}
+            for consumer in consumers:
+                # What chat_message hands to the socket, minus queueing
+                await consumer.write(consumer.encoded_payload(event))
+        after = time.process_time() - start
+
+        return before, after
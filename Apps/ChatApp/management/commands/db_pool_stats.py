@@ -0,0 +1,41 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from WebChat.db_pool import collect, summarize
+
+
+class Command(BaseCommand):
+    help = "Connection pool statistics published by every web, consumer and Celery process"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--json", action="store_true", help="print the raw snapshots and totals as JSON")
+
+    def handle(self, *args, **options):
+        snapshots = collect()
+        totals = summarize(snapshots)
+        if options["json"]:
+            self.stdout.write(json.dumps({"processes": snapshots, "totals": totals}, indent=2))
+            return
+        if not snapshots:
+            self.stdout.write("No pool statistics published (no pooled database, or no recent checkouts)")
+            return
+
+        for process, snapshot in snapshots.items():
+            for alias, stats in snapshot["pools"].items():
+                self.stdout.write(f"{process} {alias}: {self.describe(stats)}")
+        for alias, stats in totals.items():
+            line = f"total {alias} ({len(snapshots)} processes): {self.describe(stats)}"
+            if stats["requests_waiting"] or stats["requests_errors"]:
+                self.stdout.write(self.style.WARNING(line))
+            else:
+                self.stdout.write(self.style.SUCCESS(line))
+
+    def describe(self, stats):
+        return (
+            f"{stats['pool_size'] - stats['pool_available']}/{stats['pool_max']} in use "
+            f"(saturation {stats['saturation']:.0%}), {stats['requests_waiting']} waiting, "
+            f"checkout {stats['checkout_ms_avg']:.1f} ms avg, "
+            f"wait {stats['wait_ms_avg']:.1f} ms avg over {stats['requests_queued']} queued, "
+            f"{stats['requests_errors']} timeouts, {stats['requests_num']} checkouts"
+        )
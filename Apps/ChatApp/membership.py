@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.http import Http404
+
+DEFAULT_MEMBERSHIP_CONFIG = {
+    "CACHE_ALIAS": "default",
+    "TTL": 300,  # seconds a member set lives in the shared cache
+    "LOCAL_TTL": 5,  # seconds a member set lives in this process
+    "MAX_CHATS": 10000,  # LRU size of the in-process layer
+}
+
+
+def get_membership_config():
+    return {**DEFAULT_MEMBERSHIP_CONFIG, **getattr(settings, "CHAT_MEMBERSHIP_CACHE", {})}
+
+
+class ChatMembershipCache:
+    """
+    Member ids per chat: in-process LRU → shared cache (Redis) → database.
+
+    Invalidated from m2m_changed on Chat.participants (see signals.py).
+    Other processes drop their local copy after LOCAL_TTL at the latest.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = OrderedDict()  # chat_id -> (expires_at, frozenset of user ids)
+
+    @property
+    def config(self):
+        return get_membership_config()
+
+    @property
+    def cache(self):
+        return caches[self.config["CACHE_ALIAS"]]
+
+    def cache_key(self, chat_id):
+        return f"chat:{chat_id}:members"
+
+    def peek(self, chat_id):
+        """Local lookup only, returns None on a miss. Safe in async code."""
+        with self.lock:
+            entry = self.local.get(chat_id)
+            if entry is None:
+                return None
+            expires_at, members = entry
+            if expires_at <= time.monotonic():
+                del self.local[chat_id]
+                return None
+            self.local.move_to_end(chat_id)
+            return members
+
+    def members(self, chat_id):
+        members = self.peek(chat_id)
+        if members is not None:
+            return members
+
+        members = self.cache.get(self.cache_key(chat_id))
+        if members is None:
+            members = self.load(chat_id)
+            self.cache.set(self.cache_key(chat_id), members, timeout=self.config["TTL"])
+
+        self.remember(chat_id, members)
+        return members
+
+    def load(self, chat_id):
+        from .models import Chat
+        # Shared by every process for TTL seconds: never from a lagging replica
+        return frozenset(
+            Chat.participants.through.objects.using(DEFAULT_DB_ALIAS)
+            .filter(chat_id=chat_id).values_list("user_id", flat=True)
+        )
+
+    def remember(self, chat_id, members):
+        with self.lock:
+            self.local[chat_id] = (time.monotonic() + self.config["LOCAL_TTL"], members)
+            self.local.move_to_end(chat_id)
+            while len(self.local) > self.config["MAX_CHATS"]:
+                self.local.popitem(last=False)
+
+    def is_member(self, chat_id, user_id):
+        return user_id in self.members(chat_id)
+
+    def invalidate(self, *chat_ids):
+        with self.lock:
+            for chat_id in chat_ids:
+                self.local.pop(chat_id, None)
+        self.cache.delete_many([self.cache_key(chat_id) for chat_id in chat_ids])
+
+    def clear_local(self):
+        with self.lock:
+            self.local.clear()
+
+
+chat_membership = ChatMembershipCache()
+
+
+def check_chat_member(chat_id, user):
+    # Drop-in for get_object_or_404(Chat, id=..., participants=user) checks
+    if not chat_membership.is_member(chat_id, user.id):
+        raise Http404("No Chat matches the given query.")
+
+
+async def acheck_chat_member(chat_id, user):
+    # Local LRU hits answer on the event loop; misses take one thread hop
+    members = chat_membership.peek(chat_id)
+    if members is None:
+        members = await sync_to_async(chat_membership.members)(chat_id)
+    if user.id not in members:
+        raise Http404("No Chat matches the given query.")
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import sys
+
+from django.conf import settings
+from django.utils import timezone
+
+from .consumer_db import consumer_db
+from .wire import to_epoch_ms
+
+logger = logging.getLogger("Apps.ChatApp.message_buffer")
+
+# CHAT_MESSAGE_PERSISTENCE = "sync"         → ChatConsumer.save_message per frame
+# CHAT_MESSAGE_PERSISTENCE = "write_behind" → broadcast first, bulk insert later
+PERSISTENCE_SYNC = "sync"
+PERSISTENCE_WRITE_BEHIND = "write_behind"
+
+DEFAULT_BUFFER_CONFIG = {
+    "MAX_SIZE": 10000,  # producers wait (backpressure) once this many are queued
+    "BATCH_SIZE": 200,  # max messages per bulk_create
+    "FLUSH_INTERVAL": 0.05,  # seconds to wait for a batch to fill up
+    "RETRIES": 3,  # attempts at a failed batch before writing its messages one by one
+    "RETRY_DELAY": 0.5,  # seconds before the first retry, doubled after each
+    "SHUTDOWN_TIMEOUT": 10,  # seconds a stopping server waits for the queue to drain
+}
+
+
+def write_behind_enabled():
+    return getattr(settings, "CHAT_MESSAGE_PERSISTENCE", PERSISTENCE_SYNC) == PERSISTENCE_WRITE_BEHIND
+
+
+class MessageBuffer:
+    """
+    Bounded in-process queue of messages waiting to be written.
+
+    A single flush task per event loop drains the queue, inserts each batch
+    with one bulk_create and bumps every touched chat's updated_at once.
+    A failed batch is retried, then written message by message so one bad
+    row only loses itself. The buffer lives in worker memory: a daphne
+    process drains it on shutdown (see drain_on_shutdown), but messages
+    still queued when a worker is killed outright are lost.
+    """
+
+    def __init__(self, max_size=None, batch_size=None, flush_interval=None):
+        config = {**DEFAULT_BUFFER_CONFIG, **getattr(settings, "CHAT_MESSAGE_BUFFER", {})}
+        self.max_size = max_size or config["MAX_SIZE"]
+        self.batch_size = batch_size or config["BATCH_SIZE"]
+        self.flush_interval = flush_interval if flush_interval is not None else config["FLUSH_INTERVAL"]
+        self.retries = config["RETRIES"]
+        self.retry_delay = config["RETRY_DELAY"]
+        self.shutdown_timeout = config["SHUTDOWN_TIMEOUT"]
+        self._loop = None
+        self._queue = None
+        self._task = None
+
+    def _ensure_running(self):
+        # asyncio queues are bound to one loop; rebuild if the loop changed
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize=self.max_size)
+            self._task = None
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    async def add(self, chat_id, sender_id, content, seq=None, client_id=''):
+        self._ensure_running()
+        timestamp = timezone.now()
+        await self._queue.put({
+            "chat_id": chat_id,
+            "sender_id": sender_id,
+            "content": content,
+            "timestamp": timestamp,
+            "seq": seq,
+            "client_id": client_id,
+        })
+        return {
+            # The row id only exists once the batch is written; clients
+            # key read receipts by seq
+            "id": None,
+            "seq": seq,
+            "timestamp": to_epoch_ms(timestamp),
+        }
+
+    def qsize(self):
+        return self._queue.qsize() if self._queue else 0
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = self._loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._write(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    async def flush(self):
+        """Wait until everything queued so far has been written."""
+        if self._queue and self._loop is asyncio.get_running_loop():
+            await self._queue.join()
+
+    async def drain(self):
+        # flush() bounded by SHUTDOWN_TIMEOUT, for a server that is stopping
+        try:
+            await asyncio.wait_for(self.flush(), self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"[FAIL] message buffer drain -> {self.qsize()} messages still queued")
+
+    async def _write(self, batch):
+        # Same bounded thread pool as the consumers' own database calls
+        delay = self.retry_delay
+        for attempt in range(1, self.retries + 1):
+            try:
+                if attempt > 1:
+                    batch = await consumer_db.run(unwritten, batch)
+                    if not batch:
+                        return
+                await consumer_db.run(write_batch, batch)
+                return
+            except Exception:
+                logger.warning(f"[FAIL] message batch write -> {len(batch)} messages, attempt {attempt}", exc_info=True)
+            if attempt < self.retries:
+                await asyncio.sleep(delay)
+                delay *= 2
+        # Still failing: a bad row would sink the whole batch every time
+        try:
+            batch = await consumer_db.run(unwritten, batch)
+        except Exception:
+            pass
+        for item in batch:
+            try:
+                await consumer_db.run(write_batch, [item])
+            except Exception:
+                logger.error(
+                    f"[FAIL] message write -> chat_id={item['chat_id']} seq={item.get('seq')}", exc_info=True
+                )
+
+
+def write_batch(batch):
+    from django.db import transaction
+    from .models import Chat, Message
+    from .history import bump_history_versions
+    from .message_search import queue_indexing
+    from .summaries import record_messages
+
+    latest_per_chat = {}
+    for item in batch:
+        chat_id = item["chat_id"]
+        latest_per_chat[chat_id] = max(latest_per_chat.get(chat_id, item["timestamp"]), item["timestamp"])
+
+    with transaction.atomic():
+        messages = Message.objects.bulk_create([
+            Message(
+                chat_id=item["chat_id"],
+                sender_id=item["sender_id"],
+                content=item["content"],
+                timestamp=item["timestamp"],
+                seq=item.get("seq"),
+                client_id=item.get("client_id", ""),
+            )
+            for item in batch
+        ])
+        record_messages(messages)
+        bump_history_versions(latest_per_chat)
+        queue_indexing([message.id for message in messages])
+        # One timestamp bump per chat per batch
+        for chat_id, latest in latest_per_chat.items():
+            Chat.objects.filter(id=chat_id).update(updated_at=latest)
+
+
+def unwritten(batch):
+    """
+    The items of a batch not in the table yet.
+
+    A write can fail after its commit (an on_commit callback raising), so
+    retries skip the messages already stored, matched on (chat_id, seq).
+    """
+    from .models import Message
+
+    written = set(
+        Message.objects.filter(
+            chat_id__in={item["chat_id"] for item in batch},
+            seq__in={item["seq"] for item in batch if item.get("seq") is not None},
+        ).values_list("chat_id", "seq")
+    )
+    return [item for item in batch if (item["chat_id"], item.get("seq")) not in written]
+
+
+message_buffer = MessageBuffer()
+
+
+def drain_on_shutdown():
+    """
+    Write the queued messages before a daphne process exits.
+
+    On SIGTERM daphne cancels every application instance without sending
+    websocket.disconnect, so consumers never get a chance to. The Twisted
+    reactor waits for its "before shutdown" triggers while the event loop
+    still runs, and the buffer's flush task is not an application instance,
+    so it keeps writing until the queue is empty. Called from WebChat/asgi.py;
+    does nothing under a server without a Twisted reactor.
+    """
+    if "twisted.internet.reactor" not in sys.modules:
+        return
+    from twisted.internet import defer, reactor
+
+    def drain():
+        return defer.Deferred.fromFuture(asyncio.ensure_future(message_buffer.drain()))
+
+    reactor.addSystemEventTrigger("before", "shutdown", drain)
@@ -0,0 +1,161 @@
+import logging
+import re
+
+from django.db import connection, connections, router, transaction
+from django.utils.html import escape
+
+from .pagination import DEFAULT_PAGE_SIZE, decode_cursor, encode_cursor
+
+logger = logging.getLogger("Apps.ChatApp.message_search")
+
+# Postgres keeps a tsvector column on the message table, SQLite an FTS5
+# table next to it; both are created by migration 0007 and filled by the
+# chat.index_messages task, never on the send path.
+FTS_TABLE = "chatapp_message_fts"
+MESSAGE_TABLE = "ChatApp_message"
+MEMBER_TABLE = "ChatApp_chatmember"
+TS_CONFIG = "simple"
+
+# Snippet boundaries survive escaping and become <mark> afterwards
+MARK_START, MARK_END = "\x02", "\x03"
+MAX_TERMS = 8
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+def search_terms(query):
+    terms = re.findall(r"\w+", query.lower())[:MAX_TERMS]
+    if not terms:
+        raise InvalidQuery(query)
+    return terms
+
+
+def render_snippet(raw):
+    # Message text is user input: escape it, then turn the markers into tags
+    return escape(raw).replace(MARK_START, "<mark>").replace(MARK_END, "</mark>")
+
+
+def index_messages(message_ids):
+    """(Re)index the given messages; safe to repeat."""
+    message_ids = [int(message_id) for message_id in message_ids]
+    if not message_ids:
+        return 0
+    placeholders = ", ".join(["%s"] * len(message_ids))
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                f'UPDATE "{MESSAGE_TABLE}" SET search_vector = to_tsvector(%s, content) '
+                f"WHERE id IN ({placeholders})",
+                [TS_CONFIG, *message_ids],
+            )
+        else:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", message_ids)
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE}(rowid, content) SELECT id, content FROM "{MESSAGE_TABLE}" '
+                f"WHERE id IN ({placeholders})",
+                message_ids,
+            )
+    return len(message_ids)
+
+
+def unindex_messages(message_ids):
+    # Postgres keeps the vector on the row itself, so only SQLite has work here
+    message_ids = [int(message_id) for message_id in message_ids]
+    if not message_ids or connection.vendor == "postgresql":
+        return
+    placeholders = ", ".join(["%s"] * len(message_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", message_ids)
+
+
+def unindexed_message_ids(limit):
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                f'SELECT id FROM "{MESSAGE_TABLE}" WHERE search_vector IS NULL ORDER BY id LIMIT %s', [limit]
+            )
+        else:
+            cursor.execute(
+                f'SELECT id FROM "{MESSAGE_TABLE}" WHERE id NOT IN (SELECT rowid FROM {FTS_TABLE}) '
+                f"ORDER BY id LIMIT %s",
+                [limit],
+            )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def queue_indexing(message_ids):
+    """Hand freshly saved messages to the indexer once the transaction commits."""
+    from .tasks import index_messages as index_messages_task
+
+    message_ids = [message_id for message_id in message_ids if message_id]
+    if not message_ids:
+        return
+
+    def enqueue():
+        try:
+            index_messages_task.delay(message_ids)
+        except Exception:
+            # chat.index_unindexed_messages picks them up on its next run
+            logger.warning(f"[FAIL] Celery down, indexing deferred -> {len(message_ids)} messages")
+
+    transaction.on_commit(enqueue)
+
+
+def search_messages(user, query, chat_id=None, before=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Messages matching every term (as a prefix) in the user's own chats.
+
+    Newest first, keyset-paginated on (timestamp, id) with the same cursors
+    as the history API. Returns {"results": [(message, snippet)], "next"}.
+    """
+    from .models import Message
+
+    # Raw SQL skips the router; ask it, so searches can run on a replica
+    database = connections[router.db_for_read(Message)]
+    terms = search_terms(query)
+    params, conditions = [], [f'm.chat_id IN (SELECT chat_id FROM "{MEMBER_TABLE}" WHERE user_id = %s)']
+    params.append(user.id)
+    if chat_id is not None:
+        conditions.append("m.chat_id = %s")
+        params.append(chat_id)
+    if before:
+        timestamp, message_id = decode_cursor(before)
+        timestamp = database.ops.adapt_datetimefield_value(timestamp)
+        conditions.append("(m.timestamp < %s OR (m.timestamp = %s AND m.id < %s))")
+        params.extend([timestamp, timestamp, message_id])
+
+    if database.vendor == "postgresql":
+        tsquery = " & ".join(f"{term}:*" for term in terms)
+        sql = (
+            f"SELECT m.id, ts_headline(%s, m.content, to_tsquery(%s, %s), %s) "
+            f'FROM "{MESSAGE_TABLE}" m '
+            f"WHERE m.search_vector @@ to_tsquery(%s, %s) AND {' AND '.join(conditions)} "
+            f"ORDER BY m.timestamp DESC, m.id DESC LIMIT %s"
+        )
+        options = f"StartSel={MARK_START}, StopSel={MARK_END}, MaxWords=20, MinWords=5, MaxFragments=1"
+        params = [TS_CONFIG, TS_CONFIG, tsquery, options, TS_CONFIG, tsquery, *params, limit + 1]
+    else:
+        match = " ".join(f'"{term}"*' for term in terms)
+        sql = (
+            f"SELECT m.id, snippet({FTS_TABLE}, 0, %s, %s, '…', 12) "
+            f'FROM {FTS_TABLE} JOIN "{MESSAGE_TABLE}" m ON m.id = {FTS_TABLE}.rowid '
+            f"WHERE {FTS_TABLE} MATCH %s AND {' AND '.join(conditions)} "
+            f"ORDER BY m.timestamp DESC, m.id DESC LIMIT %s"
+        )
+        params = [MARK_START, MARK_END, match, *params, limit + 1]
+
+    with database.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    messages = Message.objects.using(database.alias).select_related("sender").in_bulk([row[0] for row in rows])
+    results = [(messages[message_id], render_snippet(snippet)) for message_id, snippet in rows if message_id in messages]
+    last = results[-1][0] if results else None
+    return {
+        "results": results,
+        "next": encode_cursor(last.timestamp, last.id) if has_more and last else None,
+    }
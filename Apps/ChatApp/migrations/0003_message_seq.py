@@ -0,0 +1,37 @@
+# Generated by Django 6.0.2 on 2026-10-18 19:44
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_seq(apps, schema_editor):
+    # Number existing messages per chat in send order
+    Message = apps.get_model('ChatApp', 'Message')
+    db_alias = schema_editor.connection.alias
+    chat_ids = Message.objects.using(db_alias).exclude(chat=None).values_list('chat_id', flat=True).distinct()
+    for chat_id in chat_ids.iterator():
+        messages = list(Message.objects.using(db_alias).filter(chat_id=chat_id).order_by('timestamp', 'id').only('id'))
+        for seq, message in enumerate(messages, start=1):
+            message.seq = seq
+        Message.objects.using(db_alias).bulk_update(messages, ['seq'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChatApp', '0002_message_timestamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'seq'], name='message_chat_seq_idx'),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+    ]
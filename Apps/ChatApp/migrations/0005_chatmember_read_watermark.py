@@ -0,0 +1,59 @@
+# Generated by Django 6.0.2 on 2026-10-18 19:49
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def collapse_reads_into_watermarks(apps, schema_editor):
+    # One member row per participant; the highest message each one has a
+    # MessageRead row for becomes their watermark (rooms were always read
+    # up to the newest message, so reads are contiguous).
+    Chat = apps.get_model('ChatApp', 'Chat')
+    ChatMember = apps.get_model('ChatApp', 'ChatMember')
+    MessageRead = apps.get_model('ChatApp', 'MessageRead')
+    db_alias = schema_editor.connection.alias
+
+    watermarks = {
+        (row['message__chat_id'], row['user_id']): row['last_read']
+        for row in MessageRead.objects.using(db_alias).values('message__chat_id', 'user_id').annotate(last_read=Max('message_id'))
+    }
+    participants = Chat.participants.through.objects.using(db_alias).values_list('chat_id', 'user_id')
+    ChatMember.objects.using(db_alias).bulk_create(
+        (
+            ChatMember(chat_id=chat_id, user_id=user_id, last_read_message_id=watermarks.get((chat_id, user_id), 0))
+            for chat_id, user_id in participants.iterator()
+        ),
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChatApp', '0004_message_chat_ts_id_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMember',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.PositiveBigIntegerField(default=0)),
+                ('last_read_at', models.DateTimeField(blank=True, null=True)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='members', to='ChatApp.chat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_members', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='chatmember',
+            constraint=models.UniqueConstraint(fields=('chat', 'user'), name='chatmember_chat_user_uniq'),
+        ),
+        migrations.RunPython(collapse_reads_into_watermarks, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name='MessageRead',
+        ),
+    ]
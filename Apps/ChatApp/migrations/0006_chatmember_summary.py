@@ -0,0 +1,75 @@
+# Generated by Django 6.0.2 on 2026-10-18 19:52
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_summaries(apps, schema_editor):
+    # Chat by chat: last message, the other side of private chats, and
+    # unread counts against each member's read watermark
+    Chat = apps.get_model('ChatApp', 'Chat')
+    ChatMember = apps.get_model('ChatApp', 'ChatMember')
+    Message = apps.get_model('ChatApp', 'Message')
+    db_alias = schema_editor.connection.alias
+
+    for chat in Chat.objects.using(db_alias).only('id', 'chat_type', 'created_at').iterator():
+        members = list(ChatMember.objects.using(db_alias).filter(chat_id=chat.id))
+        last = Message.objects.using(db_alias).filter(chat_id=chat.id).order_by('-timestamp', '-id').first()
+        for member in members:
+            if chat.chat_type == 'private' and len(members) == 2:
+                member.other_user_id = next(m.user_id for m in members if m is not member)
+            if last:
+                member.last_message_preview = last.content[:100]
+                member.last_message_sender_id = last.sender_id
+                member.last_activity_at = last.timestamp
+            else:
+                member.last_activity_at = chat.created_at
+            member.unread_count = Message.objects.using(db_alias).filter(
+                chat_id=chat.id, id__gt=member.last_read_message_id
+            ).exclude(sender_id=member.user_id).count()
+        ChatMember.objects.using(db_alias).bulk_update(members, [
+            'other_user', 'last_message_preview', 'last_message_sender', 'last_activity_at', 'unread_count',
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChatApp', '0005_chatmember_read_watermark'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmember',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='chatmember',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='chatmember',
+            name='last_message_sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='chatmember',
+            name='other_user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='chatmember',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='chatmember',
+            index=models.Index(fields=['user', '-last_activity_at', '-id'], name='chatmember_sidebar_idx'),
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
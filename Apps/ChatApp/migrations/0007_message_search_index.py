@@ -0,0 +1,38 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # Postgres: a tsvector column with a GIN index on the message table.
+    # SQLite: an FTS5 table keyed by message id. Both are kept out of the
+    # model state and filled by the chat.index_messages task; existing
+    # messages are indexed in batches by chat.index_unindexed_messages.
+    vendor = schema_editor.connection.vendor
+    table = schema_editor.quote_name(apps.get_model('ChatApp', 'Message')._meta.db_table)
+    if vendor == 'postgresql':
+        schema_editor.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector')
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS message_search_vector_idx ON {table} USING gin (search_vector)'
+        )
+    elif vendor == 'sqlite':
+        schema_editor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS chatapp_message_fts USING fts5(content)')
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    table = schema_editor.quote_name(apps.get_model('ChatApp', 'Message')._meta.db_table)
+    if vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS message_search_vector_idx')
+        schema_editor.execute(f'ALTER TABLE {table} DROP COLUMN IF EXISTS search_vector')
+    elif vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS chatapp_message_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChatApp', '0006_chatmember_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,113 @@
+# Generated by Django 6.0.2 on 2026-10-18 19:59
+
+import django.db.models.deletion
+from django.conf import settings
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def merge_duplicate_private_chats(apps, schema_editor):
+    # Private chats are keyed by their two participants. Where a pair has
+    # several chats (concurrent "start chat" clicks), the oldest one keeps
+    # everyone's messages and the highest read watermark, and the rest go.
+    Chat = apps.get_model('ChatApp', 'Chat')
+    ChatMember = apps.get_model('ChatApp', 'ChatMember')
+    Message = apps.get_model('ChatApp', 'Message')
+    Participant = Chat.participants.through
+    db_alias = schema_editor.connection.alias
+
+    participants = defaultdict(list)
+    rows = Participant.objects.using(db_alias).filter(chat__chat_type='private').values_list('chat_id', 'user_id')
+    for chat_id, user_id in rows.iterator():
+        participants[chat_id].append(user_id)
+
+    chats_by_pair = defaultdict(list)
+    for chat_id, user_ids in participants.items():
+        if len(user_ids) == 2:
+            chats_by_pair[tuple(sorted(user_ids))].append(chat_id)
+
+    touched_chats, touched_users = set(), set()
+    for (low_id, high_id), chat_ids in chats_by_pair.items():
+        keep, *duplicates = sorted(chat_ids)
+        if duplicates:
+            merge_into(Chat, ChatMember, Message, keep, duplicates, db_alias)
+            touched_chats.update(chat_ids)
+            touched_users.update((low_id, high_id))
+        Chat.objects.using(db_alias).filter(id=keep).update(low_user_id=low_id, high_user_id=high_id)
+
+    forget_cached_state(touched_chats, touched_users)
+
+
+def merge_into(Chat, ChatMember, Message, keep, duplicates, db_alias):
+    all_ids = [keep, *duplicates]
+    watermarks = dict(
+        ChatMember.objects.using(db_alias).filter(chat_id__in=all_ids).values('user_id')
+        .annotate(last_read=Max('last_read_message_id')).values_list('user_id', 'last_read')
+    )
+    Message.objects.using(db_alias).filter(chat_id__in=duplicates).update(chat_id=keep)
+    latest = Chat.objects.using(db_alias).filter(id__in=all_ids).aggregate(latest=Max('updated_at'))['latest']
+    Chat.objects.using(db_alias).filter(id__in=duplicates).delete()
+    Chat.objects.using(db_alias).filter(id=keep).update(updated_at=latest)
+
+    # Renumber resume sequence numbers in send order across the merged history
+    messages = list(Message.objects.using(db_alias).filter(chat_id=keep).order_by('timestamp', 'id').only('id'))
+    for seq, message in enumerate(messages, start=1):
+        message.seq = seq
+    Message.objects.using(db_alias).bulk_update(messages, ['seq'], batch_size=1000)
+
+    last = Message.objects.using(db_alias).filter(chat_id=keep).order_by('-timestamp', '-id').first()
+    members = list(ChatMember.objects.using(db_alias).filter(chat_id=keep))
+    for member in members:
+        member.last_read_message_id = watermarks.get(member.user_id, 0)
+        member.unread_count = Message.objects.using(db_alias).filter(
+            chat_id=keep, id__gt=member.last_read_message_id
+        ).exclude(sender_id=member.user_id).count()
+        if last:
+            member.last_message_preview = last.content[:100]
+            member.last_message_sender_id = last.sender_id
+            member.last_activity_at = last.timestamp
+    ChatMember.objects.using(db_alias).bulk_update(members, [
+        'last_read_message_id', 'unread_count', 'last_message_preview', 'last_message_sender', 'last_activity_at',
+    ])
+
+
+def forget_cached_state(chat_ids, user_ids):
+    # Seq counters, membership sets and sidebars of merged chats are stale
+    if not chat_ids:
+        return
+    from django.core.cache import cache
+
+    keys = [f'chat:{chat_id}:{suffix}' for chat_id in chat_ids for suffix in ('seq', 'members')]
+    keys += [f'sidebar:{user_id}:version' for user_id in user_ids]
+    try:
+        cache.delete_many(keys)
+    except Exception:
+        pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChatApp', '0007_message_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='high_user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='low_user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(merge_duplicate_private_chats, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chat',
+            constraint=models.UniqueConstraint(condition=models.Q(('chat_type', 'private')), fields=('low_user', 'high_user'), name='chat_private_pair_uniq'),
+        ),
+    ]
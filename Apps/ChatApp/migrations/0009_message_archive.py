@@ -0,0 +1,36 @@
+# Generated by Django 6.0.2 on 2026-10-18 20:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChatApp', '0008_chat_private_pair'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='message',
+            options={},
+        ),
+        migrations.CreateModel(
+            name='MessageArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255)),
+                ('first_timestamp', models.DateTimeField()),
+                ('first_message_id', models.PositiveBigIntegerField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('last_message_id', models.PositiveBigIntegerField()),
+                ('last_seq', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('message_count', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archive_segments', to='ChatApp.chat')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['chat', 'last_timestamp', 'last_message_id'], name='archive_chat_last_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-18 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChatApp', '0009_message_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='client_id',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+    ]
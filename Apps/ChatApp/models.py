@@ -55,9 +55,10 @@
 #     class Meta:
 #         ordering = ["created_at"]
 
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.utils import timezone
 
 
 class Chat(models.Model):
@@ -69,11 +70,27 @@ class Chat(models.Model):
     name = models.CharField(max_length=100, blank=True)
     chat_type = models.CharField(max_length=10, choices=CHAT_TYPES, default='private')
     participants = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name='chats')
+    # Private chats only: the two participants, lower id first, unique per pair.
+    # Deleting one of them keeps the chat (and the other side's history);
+    # NULLs never collide in the unique constraint.
+    low_user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    high_user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['-updated_at']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['low_user', 'high_user'],
+                condition=models.Q(chat_type='private'),
+                name='chat_private_pair_uniq',
+            ),
+        ]
 
     def __str__(self):
         if self.chat_type == 'private' and self.name == "":
@@ -93,25 +110,101 @@ class Chat(models.Model):
     def get_last_message(self):
         return self.messages.order_by('-timestamp').first()
 
+    @classmethod
+    def get_or_create_private(cls, user, other_user):
+        """
+        The private chat between two users, created on first use.
+
+        One lookup on the pair's unique index. Concurrent first calls race
+        on that index and the loser reads the winner's chat, so a pair never
+        ends up with two chats.
+        """
+        low_id, high_id = sorted((user.id, other_user.id))
+        with transaction.atomic():
+            chat, created = cls.objects.get_or_create(chat_type='private', low_user_id=low_id, high_user_id=high_id)
+            if created:
+                chat.participants.add(user, other_user)
+        return chat, created
+
 
 class Message(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages', null=True, blank=True)
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the message is received, not when it is written, so buffered
+    # (write-behind) messages keep the timestamp that was broadcast.
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     is_read = models.BooleanField(default=False)
+    # Per-chat, monotonically increasing; lets clients resume after a drop
+    seq = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
+    # Id the sending client gave the message; replays carry it so the
+    # sender stops retrying a message it missed the echo of
+    client_id = models.CharField(max_length=64, blank=True, default='', editable=False)
 
     class Meta:
-        ordering = ['timestamp']
+        # No default ordering: every query orders by the index it uses, and
+        # unqualified ones (counts, deletes) do not sort the table
+        indexes = [
+            models.Index(fields=['chat', 'seq'], name='message_chat_seq_idx'),
+            # Keyset pagination of a chat's history
+            models.Index(fields=['chat', 'timestamp', 'id'], name='message_chat_ts_id_idx'),
+        ]
 
     def __str__(self):
         return f"{self.sender.username}: {self.content[:50]}"
 
 
-class MessageRead(models.Model):
-    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='read_by')
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    read_at = models.DateTimeField(auto_now_add=True)
+class MessageArchiveSegment(models.Model):
+    """A run of a chat's oldest messages moved out of the message table, see archive.py."""
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='archive_segments')
+    # Name of the compressed file in the archive storage
+    path = models.CharField(max_length=255)
+    # (timestamp, id) of the first and last message, the history cursor keys
+    first_timestamp = models.DateTimeField()
+    first_message_id = models.PositiveBigIntegerField()
+    last_timestamp = models.DateTimeField()
+    last_message_id = models.PositiveBigIntegerField()
+    last_seq = models.PositiveBigIntegerField(null=True, blank=True)
+    message_count = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'last_timestamp', 'last_message_id'], name='archive_chat_last_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.chat} archive {self.first_message_id}-{self.last_message_id}"
+
+
+class ChatMember(models.Model):
+    """A participant's own state in a chat, kept in step with Chat.participants."""
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='members')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chat_members')
+    # Read watermark: every message with an id up to this one has been read
+    last_read_message_id = models.PositiveBigIntegerField(default=0)
+    last_read_at = models.DateTimeField(null=True, blank=True)
+
+    # Sidebar summary, maintained as messages are saved and read
+    other_user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    last_message_preview = models.CharField(max_length=100, blank=True)
+    last_message_sender = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    # Time of the last message, or when the user joined an empty chat
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    unread_count = models.PositiveIntegerField(default=0)
 
     class Meta:
-        unique_together = ('message', 'user')
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'user'], name='chatmember_chat_user_uniq'),
+        ]
+        indexes = [
+            # A user's sidebar, newest conversation first
+            models.Index(fields=['user', '-last_activity_at', '-id'], name='chatmember_sidebar_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} in {self.chat}"
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+from collections import Counter, deque
+
+from django.conf import settings
+
+logger = logging.getLogger("Apps.ChatApp.outbound")
+
+DEFAULT_OUTBOUND_CONFIG = {
+    "MAX_SIZE": 500,  # frames queued per connection before the overflow policy kicks in
+    "TYPING_HIGH_WATER": 50,  # typing frames are dropped once this many are queued
+    "OVERFLOW_POLICY": "disconnect",  # or "drop_oldest"
+}
+
+# Close code sent to slow consumers; clients reconnect and resume by seq
+SLOW_CONSUMER_CLOSE_CODE = 4008
+SLOW_CONSUMER_CLOSE_REASON = "slow_consumer:resume"
+
+# Process-wide counters: dropped_typing, dropped_messages, disconnects, max_depth
+outbound_stats = Counter()
+
+
+def get_outbound_config():
+    return {**DEFAULT_OUTBOUND_CONFIG, **getattr(settings, "CHAT_OUTBOUND", {})}
+
+
+class OutboundQueue:
+    """
+    Bounded per-connection send queue drained by one writer task.
+
+    Handlers only enqueue, so one stalled socket holds at most MAX_SIZE
+    frames instead of letting its channel-layer and server buffers grow.
+    When full, queued typing frames are shed first; after that the policy
+    either drops the oldest frame or asks the caller to disconnect.
+    """
+
+    def __init__(self, write, max_size=None, typing_high_water=None, policy=None):
+        config = get_outbound_config()
+        self.write = write
+        self.max_size = max_size or config["MAX_SIZE"]
+        self.typing_high_water = typing_high_water or config["TYPING_HIGH_WATER"]
+        self.policy = policy or config["OVERFLOW_POLICY"]
+        self.items = deque()  # (payload, droppable)
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.writing = False
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, payload, droppable=False):
+        """Queue a frame. False means the connection is too slow and must go."""
+        if droppable and len(self.items) >= self.typing_high_water:
+            outbound_stats["dropped_typing"] += 1
+            return True
+
+        if len(self.items) >= self.max_size:
+            self.drop_typing()
+            if len(self.items) >= self.max_size:
+                if self.policy != "drop_oldest":
+                    outbound_stats["disconnects"] += 1
+                    return False
+                self.items.popleft()
+                outbound_stats["dropped_messages"] += 1
+
+        self.items.append((payload, droppable))
+        if len(self.items) > outbound_stats["max_depth"]:
+            outbound_stats["max_depth"] = len(self.items)
+
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        self.wakeup.set()
+        return True
+
+    def drop_typing(self):
+        kept = deque(item for item in self.items if not item[1])
+        outbound_stats["dropped_typing"] += len(self.items) - len(kept)
+        self.items = kept
+
+    async def run(self):
+        while True:
+            if not self.items:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            payload, _ = self.items.popleft()
+            self.writing = True
+            try:
+                await self.write(payload)
+            except Exception:
+                logger.warning("[FAIL] outbound write", exc_info=True)
+            finally:
+                self.writing = False
+
+    async def drain(self):
+        while self.items or self.writing:
+            await asyncio.sleep(0)
+
+    def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        self.items.clear()
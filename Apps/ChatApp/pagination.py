@@ -0,0 +1,108 @@
+import base64
+import binascii
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .wire import to_epoch_ms
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# Messages rendered into the room page; older ones load on scroll
+ROOM_TAIL_SIZE = 30
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(timestamp, pk):
+    # Opaque to clients: exact (timestamp, id) of a row
+    raw = f"{timestamp.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(value):
+    try:
+        padded = value + "=" * (-len(value) % 4)
+        timestamp, pk = base64.urlsafe_b64decode(padded.encode()).decode().rsplit("|", 1)
+        parsed = parse_datetime(timestamp)
+        if parsed is None:
+            raise ValueError(timestamp)
+        return parsed, int(pk)
+    except (ValueError, binascii.Error, UnicodeDecodeError) as exc:
+        raise InvalidCursor(value) from exc
+
+
+def parse_limit(value, default=DEFAULT_PAGE_SIZE):
+    try:
+        limit = int(value) if value else default
+    except (TypeError, ValueError):
+        limit = default
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def keyset_page(queryset, field, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    One page of queryset ordered by (field, id), plus cursors either side.
+
+    Rows come back newest first for `before` (and with no cursor), oldest
+    first for `after`.
+    """
+    if before:
+        timestamp, pk = decode_cursor(before)
+        queryset = queryset.filter(**{f'{field}__lte': timestamp}).filter(
+            Q(**{f'{field}__lt': timestamp}) | Q(id__lt=pk)
+        ).order_by(f'-{field}', '-id')
+    elif after:
+        timestamp, pk = decode_cursor(after)
+        queryset = queryset.filter(**{f'{field}__gte': timestamp}).filter(
+            Q(**{f'{field}__gt': timestamp}) | Q(id__gt=pk)
+        ).order_by(field, 'id')
+    else:
+        queryset = queryset.order_by(f'-{field}', '-id')
+
+    rows = list(queryset[:limit + 1])
+    return rows[:limit], len(rows) > limit
+
+
+def paginate_messages(queryset, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Keyset page over (timestamp, id), returned oldest first.
+
+    No cursor gives the newest `limit` messages. Every page is one range
+    scan on the (chat, timestamp, id) index, however long the chat is.
+    """
+    rows, has_more = keyset_page(queryset, 'timestamp', before, after, limit)
+    if not after:
+        rows.reverse()
+
+    # Paging from a cursor means the other direction is not exhausted
+    return message_page(
+        rows,
+        has_older=has_more if not after else True,
+        has_newer=has_more if after else bool(before),
+    )
+
+
+def message_page(rows, has_older, has_newer):
+    # rows oldest first
+    return {
+        'messages': rows,
+        'has_older': has_older,
+        'has_newer': has_newer,
+        'before': encode_cursor(rows[0].timestamp, rows[0].id) if rows else None,
+        'after': encode_cursor(rows[-1].timestamp, rows[-1].id) if rows else None,
+    }
+
+
+def serialize_message(message, user):
+    return {
+        'id': message.id,
+        'seq': message.seq,
+        'sender': message.sender.username,
+        'sender_id': message.sender_id,
+        'content': message.content,
+        'timestamp': to_epoch_ms(message.timestamp),
+        'is_own': message.sender_id == user.id,
+    }
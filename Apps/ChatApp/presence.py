@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.functional import cached_property
+
+logger = logging.getLogger("Apps.ChatApp.presence")
+
+DEFAULT_PRESENCE_CONFIG = {
+    "BACKEND": "redis",  # "redis" in production, "local" for tests/dev
+    "CACHE_ALIAS": "default",  # django-redis cache whose connection is used
+    "TTL": 60,  # seconds a connection counts as alive after its last heartbeat
+    "HEARTBEAT_INTERVAL": 20,  # seconds between heartbeats for local sockets
+}
+
+LAST_SEEN_KEY = "presence:last_seen"
+# Member used for page views that have no socket (e.g. the home page)
+HTTP_CONNECTION = "http"
+
+
+def get_presence_config():
+    return {**DEFAULT_PRESENCE_CONFIG, **getattr(settings, "CHAT_PRESENCE", {})}
+
+
+class RedisPresenceStore:
+    """
+    One sorted set per user: member = connection id, score = expiry time.
+
+    A user is online while any member has a score in the future, so
+    connections of a node that died without disconnecting simply expire.
+    Pending last_seen values live in one hash until they are flushed.
+    """
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    @property
+    def client(self):
+        from django_redis import get_redis_connection
+        return get_redis_connection(self.alias)
+
+    def user_key(self, user_id):
+        return f"presence:user:{user_id}"
+
+    def add(self, entries, now, ttl):
+        pipe = self.client.pipeline(transaction=False)
+        for user_id, conn_id in entries:
+            key = self.user_key(user_id)
+            pipe.zremrangebyscore(key, "-inf", now)
+            pipe.zadd(key, {conn_id: now + ttl})
+            pipe.expire(key, int(ttl) + 1)
+            pipe.hset(LAST_SEEN_KEY, user_id, now)
+        pipe.execute()
+
+    def remove(self, user_id, conn_id, now):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zrem(self.user_key(user_id), conn_id)
+        pipe.hset(LAST_SEEN_KEY, user_id, now)
+        pipe.execute()
+
+    def online_ids(self, user_ids, now):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zcount(self.user_key(user_id), now, "+inf")
+        return {user_id for user_id, count in zip(user_ids, pipe.execute()) if count}
+
+    def pop_last_seen(self):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hgetall(LAST_SEEN_KEY)
+        pipe.delete(LAST_SEEN_KEY)
+        pending, _ = pipe.execute()
+        return {int(user_id): float(ts) for user_id, ts in pending.items()}
+
+
+class LocalPresenceStore:
+    """Same contract as RedisPresenceStore, kept in process memory."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}  # user_id -> {conn_id: expires_at}
+        self.last_seen = {}
+
+    def add(self, entries, now, ttl):
+        with self.lock:
+            for user_id, conn_id in entries:
+                conns = self.connections.setdefault(user_id, {})
+                for stale in [c for c, expires in conns.items() if expires <= now]:
+                    del conns[stale]
+                conns[conn_id] = now + ttl
+                self.last_seen[user_id] = now
+
+    def remove(self, user_id, conn_id, now):
+        with self.lock:
+            self.connections.get(user_id, {}).pop(conn_id, None)
+            self.last_seen[user_id] = now
+
+    def online_ids(self, user_ids, now):
+        with self.lock:
+            return {
+                user_id for user_id in user_ids
+                if any(expires > now for expires in self.connections.get(user_id, {}).values())
+            }
+
+    def pop_last_seen(self):
+        with self.lock:
+            pending, self.last_seen = self.last_seen, {}
+        return pending
+
+
+class Presence:
+    """
+    Per-user connection counting for the whole cluster.
+
+    Each socket registers itself with connect() and leaves with disconnect(),
+    so closing one of two tabs keeps the user online. Sockets of this
+    process are re-announced every HEARTBEAT_INTERVAL by a single task.
+    """
+
+    def __init__(self):
+        self.local_connections = {}  # conn_id -> user_id, sockets of this process
+        self._loop = None
+        self._task = None
+
+    @cached_property
+    def config(self):
+        return get_presence_config()
+
+    @cached_property
+    def store(self):
+        if self.config["BACKEND"] == "local":
+            return LocalPresenceStore()
+        return RedisPresenceStore(self.config["CACHE_ALIAS"])
+
+    def connect(self, user_id, conn_id):
+        self.local_connections[conn_id] = user_id
+        self.store.add([(user_id, conn_id)], time.time(), self.config["TTL"])
+
+    def disconnect(self, user_id, conn_id):
+        self.local_connections.pop(conn_id, None)
+        self.store.remove(user_id, conn_id, time.time())
+
+    def touch(self, user_id):
+        # A page view keeps the user online for one TTL, without a socket
+        self.store.add([(user_id, HTTP_CONNECTION)], time.time(), self.config["TTL"])
+
+    def heartbeat(self):
+        entries = [(user_id, conn_id) for conn_id, user_id in list(self.local_connections.items())]
+        if entries:
+            self.store.add(entries, time.time(), self.config["TTL"])
+
+    def online_ids(self, user_ids):
+        return self.store.online_ids(user_ids, time.time())
+
+    def is_online(self, user_id):
+        return user_id in self.online_ids([user_id])
+
+    def pop_last_seen(self):
+        return self.store.pop_last_seen()
+
+    async def aconnect(self, user_id, conn_id):
+        await sync_to_async(self.connect, thread_sensitive=False)(user_id, conn_id)
+        self._ensure_heartbeat()
+
+    async def adisconnect(self, user_id, conn_id):
+        await sync_to_async(self.disconnect, thread_sensitive=False)(user_id, conn_id)
+
+    async def atouch(self, user_id):
+        await sync_to_async(self.touch, thread_sensitive=False)(user_id)
+
+    async def aonline_ids(self, user_ids):
+        return await sync_to_async(self.online_ids, thread_sensitive=False)(user_ids)
+
+    def _ensure_heartbeat(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._heartbeat_loop())
+
+    async def _heartbeat_loop(self):
+        while self.local_connections:
+            await asyncio.sleep(self.config["HEARTBEAT_INTERVAL"])
+            try:
+                await sync_to_async(self.heartbeat, thread_sensitive=False)()
+            except Exception:
+                logger.warning("[FAIL] presence heartbeat", exc_info=True)
+
+
+presence = Presence()
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+
+from django.conf import settings
+from django.db.models import Count, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .sidebar_cache import bump_sidebar_versions
+
+logger = logging.getLogger("Apps.ChatApp.read_state")
+
+DEFAULT_READ_RECEIPTS_CONFIG = {
+    "INTERVAL": 1,  # seconds read frames are coalesced before one write + broadcast
+}
+
+
+def mark_read(chat_id, user_id, message_id):
+    """
+    Move the user's read watermark forward to message_id in one UPDATE.
+
+    Never moves it back, so late or replayed receipts are harmless. The
+    sidebar's unread count is recounted from the new watermark in the same
+    statement. Returns True when the watermark advanced.
+    """
+    from .models import ChatMember, Message
+
+    unread = (
+        Message.objects.filter(chat_id=chat_id, id__gt=message_id)
+        .exclude(sender_id=user_id)
+        .order_by()
+        .values('chat_id')
+        .annotate(unread=Count('id'))
+        .values('unread')
+    )
+    advanced = ChatMember.objects.filter(
+        chat_id=chat_id, user_id=user_id, last_read_message_id__lt=message_id
+    ).update(
+        last_read_message_id=message_id,
+        last_read_at=timezone.now(),
+        unread_count=Coalesce(Subquery(unread), 0),
+    ) > 0
+    if advanced:
+        bump_sidebar_versions([user_id])
+    return advanced
+
+
+def mark_read_seq(chat_id, user_id, seq):
+    """
+    mark_read up to the newest stored message at or before seq, one UPDATE.
+
+    Sockets report reads by seq: write-behind messages are broadcast before
+    their row (and id) exists. A message still queued is skipped until a
+    later receipt, it is not in the unread count yet either.
+    """
+    from .models import ChatMember, Message
+
+    message_id = Subquery(
+        Message.objects.filter(chat_id=chat_id, seq__lte=seq).order_by('-seq').values('id')[:1]
+    )
+    unread = (
+        Message.objects.filter(chat_id=chat_id, seq__gt=seq)
+        .exclude(sender_id=user_id)
+        .order_by()
+        .values('chat_id')
+        .annotate(unread=Count('id'))
+        .values('unread')
+    )
+    advanced = ChatMember.objects.filter(
+        chat_id=chat_id, user_id=user_id, last_read_message_id__lt=message_id
+    ).update(
+        last_read_message_id=message_id,
+        last_read_at=timezone.now(),
+        unread_count=Coalesce(Subquery(unread), 0),
+    ) > 0
+    if advanced:
+        bump_sidebar_versions([user_id])
+    return advanced
+
+
+class ReadReceiptBatcher:
+    """
+    Coalesces one socket's read frames.
+
+    Clients report every message that scrolls into view; only the highest
+    seq per chat is kept and handed to `publish(chat_id, seq)`
+    once per INTERVAL, so a burst of reads costs one UPDATE and one
+    broadcast per chat.
+    """
+
+    def __init__(self, publish, interval=None):
+        config = {**DEFAULT_READ_RECEIPTS_CONFIG, **getattr(settings, "CHAT_READ_RECEIPTS", {})}
+        self.publish = publish
+        self.interval = interval if interval is not None else config["INTERVAL"]
+        self.pending = {}  # chat_id -> highest seq reported
+        self.flush_handle = None
+        self._tasks = set()
+
+    def mark(self, chat_id, seq):
+        if seq <= self.pending.get(chat_id, 0):
+            return
+        self.pending[chat_id] = seq
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.interval, self._deferred_flush)
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        for chat_id, seq in pending.items():
+            try:
+                await self.publish(chat_id, seq)
+            except Exception:
+                logger.warning(f"[FAIL] read receipt -> chat_id={chat_id}", exc_info=True)
+
+    async def close(self):
+        # Called on disconnect: whatever was read still gets recorded
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        await self.flush()
+
+    def _deferred_flush(self):
+        self.flush_handle = None
+        task = asyncio.get_running_loop().create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
@@ -0,0 +1,83 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from WebChat.db_router import pin_users
+
+DEFAULT_SIDEBAR_CACHE_CONFIG = {
+    "CACHE_ALIAS": "default",
+    "TIMEOUT": 300,  # seconds a rendered sidebar lives without being invalidated
+}
+
+
+def get_sidebar_cache_config():
+    return {**DEFAULT_SIDEBAR_CACHE_CONFIG, **getattr(settings, "CHAT_SIDEBAR_CACHE", {})}
+
+
+def get_cache():
+    return caches[get_sidebar_cache_config()["CACHE_ALIAS"]]
+
+
+def version_key(user_id):
+    return f"sidebar:{user_id}:version"
+
+
+def bump_sidebar_versions(user_ids):
+    """
+    Invalidate the cached sidebar of every given user.
+
+    A fresh random version per user, written in one round trip once the
+    surrounding transaction commits, so a render racing the write cannot
+    cache the old rows under the new version.
+    """
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+
+    def bump():
+        version = uuid.uuid4().hex[:12]
+        get_cache().set_many({version_key(user_id): version for user_id in user_ids}, timeout=None)
+        # Their next renders must not come from a replica that lacks the change
+        pin_users(user_ids)
+
+    transaction.on_commit(bump)
+
+
+def current_version(user_id):
+    cache = get_cache()
+    version = cache.get(version_key(user_id))
+    if version is None:
+        # Lost or never set: start a new version rather than trusting old entries
+        cache.add(version_key(user_id), uuid.uuid4().hex[:12], timeout=None)
+        version = cache.get(version_key(user_id))
+    return version
+
+
+def profile_changed(user_id, fingerprint):
+    """True when the parts of a profile shown in other sidebars changed."""
+    cache = get_cache()
+    key = f"sidebar:profile:{user_id}"
+    previous = cache.get(key)
+    cache.set(key, fingerprint, timeout=None)
+    return previous != fingerprint
+
+
+def cached_sidebar(user_id, build, online_ids):
+    """
+    The user's rendered first sidebar page, rebuilt only when stale.
+
+    `build()` returns {"html", "next", "user_ids", "online"}; the entry is
+    reused while the user's version holds and the people on it are still
+    online (or offline) as rendered. `online_ids(user_ids)` checks that.
+    """
+    cache = get_cache()
+    key = f"sidebar:{user_id}:{current_version(user_id)}"
+    entry = cache.get(key)
+    if entry is not None and online_ids(entry["user_ids"]) == entry["online"]:
+        return entry
+
+    entry = build()
+    cache.set(key, entry, timeout=get_sidebar_cache_config()["TIMEOUT"])
+    return entry
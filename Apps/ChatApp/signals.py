@@ -0,0 +1,106 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from Apps.Account.models import User, UserProfile
+from Apps.ChatApp.membership import chat_membership
+from django.db import transaction
+from Apps.ChatApp.archive import get_storage
+from Apps.ChatApp.models import Chat, ChatMember, MessageArchiveSegment
+from Apps.ChatApp.sidebar_cache import bump_sidebar_versions, profile_changed
+from Apps.ChatApp.summaries import refresh_other_users
+from Apps.ChatApp.user_search import bump_search_version, prefix_index
+from django.db.backends.signals import connection_created
+from WebChat.db_pool import pool_metrics
+
+
+def invalidate_membership_on_commit(chat_ids):
+    # Once committed: a load in between would otherwise cache the old
+    # member set again, for the whole TTL
+    chat_ids = list(chat_ids)
+    transaction.on_commit(lambda: chat_membership.invalidate(*chat_ids))
+
+
+@receiver(m2m_changed, sender=Chat.participants.through)
+def invalidate_chat_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "pre_clear", "post_clear"):
+        return
+
+    if not reverse:
+        # chat.participants.add/remove/clear(...)
+        invalidate_membership_on_commit([instance.pk])
+    elif pk_set:
+        # user.chats.add/remove(...)
+        invalidate_membership_on_commit(pk_set)
+    elif action == "pre_clear":
+        # user.chats.clear() does not pass the chat ids
+        invalidate_membership_on_commit(instance.chats.values_list("id", flat=True))
+
+
+@receiver(m2m_changed, sender=Chat.participants.through)
+def sync_chat_members(sender, instance, action, reverse, pk_set, **kwargs):
+    # ChatMember rows mirror Chat.participants and carry read state and the
+    # sidebar summary
+    if action == "post_add":
+        pairs = [(pk, instance.pk) for pk in pk_set] if reverse else [(instance.pk, pk) for pk in pk_set]
+        ChatMember.objects.bulk_create(
+            [ChatMember(chat_id=chat_id, user_id=user_id) for chat_id, user_id in pairs],
+            ignore_conflicts=True,
+        )
+    elif action == "post_remove":
+        if reverse:
+            ChatMember.objects.filter(user_id=instance.pk, chat_id__in=pk_set).delete()
+            bump_sidebar_versions([instance.pk])
+        else:
+            ChatMember.objects.filter(chat_id=instance.pk, user_id__in=pk_set).delete()
+            bump_sidebar_versions(pk_set)
+    elif action == "pre_clear":
+        # Before the clear, while the user's chat ids are still known
+        members = ChatMember.objects.filter(**{"user_id" if reverse else "chat_id": instance.pk})
+        pk_set = set(members.values_list("chat_id", flat=True)) if reverse else None
+        bump_sidebar_versions(members.values_list("user_id", flat=True))
+        members.delete()
+    else:
+        return
+
+    if action != "pre_clear" or reverse:
+        refresh_other_users(list(pk_set) if reverse else [instance.pk])
+
+
+@receiver(post_delete, sender=Chat)
+def drop_chat_membership(sender, instance, **kwargs):
+    invalidate_membership_on_commit([instance.pk])
+
+
+@receiver(post_delete, sender=MessageArchiveSegment)
+def delete_archive_file(sender, instance, **kwargs):
+    # Segments go with their chat; the file only once that is committed
+    transaction.on_commit(lambda: get_storage().delete(instance.path))
+
+
+@receiver(post_save, sender=UserProfile)
+def refresh_contact_sidebars(sender, instance, created, **kwargs):
+    # Profiles are saved on every login too; only a change to what other
+    # sidebars show (name, username, avatar) invalidates them
+    if created:
+        return
+    user = instance.user
+    fingerprint = (user.username, user.get_full_name(), instance.profile_image.name or "")
+    if profile_changed(user.pk, fingerprint):
+        bump_sidebar_versions(ChatMember.objects.filter(other_user_id=user.pk).values_list("user_id", flat=True))
+        # Search results show the same name and avatar
+        bump_search_version()
+
+
+@receiver(post_save, sender=User)
+def refresh_user_search(sender, instance, created, update_fields, **kwargs):
+    # Logins only touch last_login, which search does not index
+    if update_fields and set(update_fields) <= {"last_login"}:
+        return
+    prefix_index.invalidate()
+    bump_search_version()
+
+
+@receiver(connection_created)
+def publish_pool_metrics(sender, connection, **kwargs):
+    # With pooling this fires on every checkout; publishing is throttled
+    pool_metrics.connected_to(connection.alias)
+    pool_metrics.maybe_publish()
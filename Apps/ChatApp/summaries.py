@@ -0,0 +1,85 @@
+from collections import Counter, defaultdict
+
+from django.db.models import F, Q
+
+from .pagination import encode_cursor, keyset_page
+from .sidebar_cache import bump_sidebar_versions
+
+PREVIEW_LENGTH = 100
+SIDEBAR_PAGE_SIZE = 50
+
+
+def record_messages(messages):
+    """
+    Fold newly saved messages into every member's conversation summary.
+
+    Takes anything with chat_id, sender_id, content and timestamp. Costs two
+    UPDATEs per chat (three or more when a batch mixes senders), no matter
+    how many members the chat has; call it in the transaction that saved
+    the messages so unread counts and watermarks stay in step.
+    """
+    from .models import ChatMember
+
+    by_chat = defaultdict(list)
+    for message in messages:
+        by_chat[message.chat_id].append(message)
+
+    for chat_id, chat_messages in by_chat.items():
+        latest = max(chat_messages, key=lambda message: message.timestamp)
+        members = ChatMember.objects.filter(chat_id=chat_id)
+        bump_sidebar_versions(members.values_list('user_id', flat=True))
+
+        # Out-of-order batches never move the preview back
+        members.filter(
+            Q(last_activity_at__lte=latest.timestamp) | Q(last_message_sender__isnull=True)
+        ).update(
+            last_message_preview=latest.content[:PREVIEW_LENGTH],
+            last_message_sender_id=latest.sender_id,
+            last_activity_at=latest.timestamp,
+        )
+
+        sent = Counter(message.sender_id for message in chat_messages)
+        if len(sent) == 1:
+            (sender_id,) = sent
+            members.exclude(user_id=sender_id).update(unread_count=F('unread_count') + len(chat_messages))
+            continue
+        members.update(unread_count=F('unread_count') + len(chat_messages))
+        for sender_id, count in sent.items():
+            # Nobody has unread messages of their own
+            members.filter(user_id=sender_id).update(unread_count=F('unread_count') - count)
+
+
+def refresh_other_users(chat_ids):
+    """Point each member of a two-person private chat at the other one."""
+    from .models import ChatMember
+
+    user_ids = defaultdict(list)
+    rows = ChatMember.objects.filter(chat_id__in=chat_ids, chat__chat_type='private').values_list('chat_id', 'user_id')
+    for chat_id, user_id in rows:
+        user_ids[chat_id].append(user_id)
+
+    for chat_id in chat_ids:
+        members = ChatMember.objects.filter(chat_id=chat_id)
+        bump_sidebar_versions(members.values_list('user_id', flat=True))
+        pair = user_ids.get(chat_id, [])
+        if len(pair) != 2:
+            members.exclude(other_user=None).update(other_user=None)
+            continue
+        members.filter(user_id=pair[0]).update(other_user_id=pair[1])
+        members.filter(user_id=pair[1]).update(other_user_id=pair[0])
+
+
+def conversation_page(user, before=None, limit=SIDEBAR_PAGE_SIZE):
+    """One sidebar page of the user's conversations, newest first, one query."""
+    from .models import ChatMember
+
+    rows, has_more = keyset_page(
+        ChatMember.objects.filter(user=user).select_related('chat', 'other_user__profile'),
+        'last_activity_at',
+        before=before,
+        limit=limit,
+    )
+    return {
+        'conversations': rows,
+        'next_cursor': encode_cursor(rows[-1].last_activity_at, rows[-1].id) if has_more else None,
+    }
@@ -0,0 +1,58 @@
+from datetime import datetime, timezone as dt_timezone
+
+from celery import shared_task
+import logging
+
+from .presence import presence
+
+logger = logging.getLogger("Apps.ChatApp.tasks")
+
+
+@shared_task(name="chat.flush_presence")
+def flush_presence():
+    """Write the last_seen/is_online values collected by presence back in one batch."""
+    from Apps.Account.models import UserProfile
+
+    pending = presence.pop_last_seen()
+    if not pending:
+        return 0
+
+    online_ids = presence.online_ids(pending.keys())
+    profiles = list(UserProfile.objects.filter(user_id__in=pending.keys()).only("id", "user_id"))
+    for profile in profiles:
+        profile.last_seen = datetime.fromtimestamp(pending[profile.user_id], tz=dt_timezone.utc)
+        profile.is_online = profile.user_id in online_ids
+
+    UserProfile.objects.bulk_update(profiles, ["last_seen", "is_online"], batch_size=500)
+    logger.info(f"[SUCCESS] presence flushed -> {len(profiles)} profiles")
+    return len(profiles)
+
+
+@shared_task(name="chat.index_messages")
+def index_messages(message_ids):
+    """Add freshly saved messages to the full-text index."""
+    from .message_search import index_messages as index
+
+    return index(message_ids)
+
+
+@shared_task(name="chat.index_unindexed_messages")
+def index_unindexed_messages(batch_size=1000):
+    """Catch up on messages the indexer missed (old rows, or Celery was down)."""
+    from .message_search import index_messages as index, unindexed_message_ids
+
+    indexed = index(unindexed_message_ids(batch_size))
+    if indexed:
+        logger.info(f"[SUCCESS] search index caught up -> {indexed} messages")
+    return indexed
+
+
+@shared_task(name="chat.archive_cold_messages")
+def archive_cold_messages():
+    """Move messages older than CHAT_ARCHIVE["AFTER_DAYS"] into compressed segments."""
+    from .archive import archive_cold_messages as archive
+
+    archived = archive()
+    if archived:
+        logger.info(f"[SUCCESS] messages archived -> {archived}")
+    return archived
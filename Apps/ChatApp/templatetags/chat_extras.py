@@ -3,6 +3,8 @@ from datetime import datetime
 from django import template
 from django.utils.dateparse import parse_datetime
 
+from Apps.ChatApp.wire import to_epoch_ms
+
 register = template.Library()
 
 @register.filter
@@ -32,4 +34,9 @@ def format_message_time(value):
             return parsed_date.strftime("%b %d")
 
     # Fallback: return the original value if it's not a date/formattable string
-    return value
\ No newline at end of file
+    return value
+
+@register.filter
+def epoch_ms(value):
+    # For data attributes; room.js formats it in the reader's timezone
+    return to_epoch_ms(value) if value else ""
@@ -1,3 +1,2033 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import sys
+import threading
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
 
-# Create your tests here.
+import msgpack
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.asgi import ASGIHandler
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.storage import storages
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from WebChat.db_pool import collect, pool_metrics, summarize
+from WebChat.db_router import pin_key, replica_health, request_routing
+
+from .archive import archive_cold_messages, segment_cache
+from .consumer_db import consumer_db
+from .consumers import ChatConsumer
+from .history import next_seq, recent_history
+from .membership import chat_membership
+from .message_buffer import MessageBuffer, drain_on_shutdown, message_buffer, write_batch
+from .message_search import index_messages, queue_indexing, search_messages
+from .models import Chat, ChatMember, Message, MessageArchiveSegment
+from .outbound import OutboundQueue, outbound_stats
+from .pagination import ROOM_TAIL_SIZE
+from .presence import presence
+from .read_state import mark_read
+from .routing import websocket_urlpatterns
+from .summaries import conversation_page, record_messages
+from .tasks import flush_presence, index_unindexed_messages
+from .typing_indicators import TypingTracker
+from .views import ChatHomeView, ChatMessagesAPIView, ChatRoomView, SearchUsersAPIView
+from .user_search import prefix_index, search_user_ids
+from .wire import JSON_PROTOCOL, MSGPACK_PROTOCOL, encode_frame, to_epoch_ms
+
+User = get_user_model()
+
+
+def make_communicator(user, path="/ws/chat/", subprotocols=None):
+    communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path, subprotocols=subprotocols)
+    communicator.scope["user"] = user
+    return communicator
+
+
+class ChatConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.amit = User.objects.create_user(
+            username="amit", email="amit@gmail.com", password="StrongPass123!"
+        )
+        self.chat = Chat.objects.create(chat_type="private")
+        self.chat.participants.add(self.khetu, self.ravi)
+        self.other_chat = Chat.objects.create(chat_type="private")
+        self.other_chat.participants.add(self.khetu, self.amit)
+
+    async def test_subscribe_routes_messages_by_chat_id(self):
+        khetu = make_communicator(self.khetu)
+        ravi = make_communicator(self.ravi)
+        self.assertTrue((await khetu.connect())[0])
+        self.assertTrue((await ravi.connect())[0])
+
+        for chat_id in (self.chat.id, self.other_chat.id):
+            await khetu.send_json_to({"type": "subscribe", "chat_id": chat_id})
+            self.assertEqual(
+                await khetu.receive_json_from(), {"type": "subscribed", "chat_id": chat_id}
+            )
+        await ravi.send_json_to({"type": "subscribe", "chat_id": self.chat.id})
+        await ravi.receive_json_from()
+
+        await ravi.send_json_to({"type": "chat_message", "chat_id": self.chat.id, "message": "hi"})
+        event = await khetu.receive_json_from()
+        self.assertEqual(event["chat_id"], self.chat.id)
+        self.assertEqual(event["message"], "hi")
+        self.assertEqual(event["sender_id"], self.ravi.id)
+        # The sender gets its own echo on the same group
+        self.assertEqual((await ravi.receive_json_from())["message"], "hi")
+
+        await khetu.disconnect()
+        await ravi.disconnect()
+
+    @override_settings(CHAT_SUBSCRIPTIONS={"MAX_PER_SOCKET": 1})
+    async def test_subscriptions_per_socket_are_capped(self):
+        khetu = make_communicator(self.khetu)
+        await khetu.connect()
+
+        await khetu.send_json_to({"type": "subscribe", "chat_id": self.chat.id})
+        self.assertEqual((await khetu.receive_json_from())["type"], "subscribed")
+        await khetu.send_json_to({"type": "subscribe", "chat_id": self.other_chat.id})
+        self.assertEqual((await khetu.receive_json_from())["error"], "subscribe_denied")
+
+        await khetu.disconnect()
+
+    async def test_subscribe_denied_for_non_participant(self):
+        ravi = make_communicator(self.ravi)
+        await ravi.connect()
+
+        await ravi.send_json_to({"type": "subscribe", "chat_id": self.other_chat.id})
+        self.assertEqual((await ravi.receive_json_from())["error"], "subscribe_denied")
+
+        # Frames for chats the socket is not subscribed to are dropped
+        await ravi.send_json_to({"type": "chat_message", "chat_id": self.other_chat.id, "message": "x"})
+        self.assertTrue(await ravi.receive_nothing())
+        self.assertFalse(await Message.objects.filter(chat=self.other_chat).aexists())
+
+        await ravi.disconnect()
+
+    async def test_unsubscribe_stops_delivery(self):
+        khetu = make_communicator(self.khetu)
+        ravi = make_communicator(self.ravi)
+        await khetu.connect()
+        await ravi.connect()
+        for communicator in (khetu, ravi):
+            await communicator.send_json_to({"type": "subscribe", "chat_id": self.chat.id})
+            await communicator.receive_json_from()
+
+        await khetu.send_json_to({"type": "unsubscribe", "chat_id": self.chat.id})
+        self.assertEqual((await khetu.receive_json_from())["type"], "unsubscribed")
+
+        await ravi.send_json_to({"type": "chat_message", "chat_id": self.chat.id, "message": "hi"})
+        await ravi.receive_json_from()
+        self.assertTrue(await khetu.receive_nothing())
+
+        await khetu.disconnect()
+        await ravi.disconnect()
+
+    async def test_legacy_per_chat_endpoint_still_works(self):
+        khetu = make_communicator(self.khetu, f"/ws/chat/{self.chat.id}/")
+        self.assertTrue((await khetu.connect())[0])
+
+        await khetu.send_json_to({"type": "chat_message", "message": "hello"})
+        event = await khetu.receive_json_from()
+        self.assertEqual(event["chat_id"], self.chat.id)
+        self.assertEqual(event["message"], "hello")
+
+        await khetu.disconnect()
+
+    async def test_msgpack_subprotocol_is_negotiated(self):
+        khetu = make_communicator(self.khetu, subprotocols=[MSGPACK_PROTOCOL, JSON_PROTOCOL])
+        ravi = make_communicator(self.ravi, subprotocols=[JSON_PROTOCOL])
+        _, khetu_protocol = await khetu.connect()
+        _, ravi_protocol = await ravi.connect()
+        self.assertEqual(khetu_protocol, MSGPACK_PROTOCOL)
+        self.assertEqual(ravi_protocol, JSON_PROTOCOL)
+
+        await khetu.send_to(bytes_data=msgpack.packb({"type": "subscribe", "chat_id": self.chat.id}))
+        self.assertEqual(msgpack.unpackb(await khetu.receive_from())["type"], "subscribed")
+        await ravi.send_json_to({"type": "subscribe", "chat_id": self.chat.id})
+        await ravi.receive_json_from()
+
+        await ravi.send_json_to({"type": "chat_message", "chat_id": self.chat.id, "message": "hi"})
+        binary_event = msgpack.unpackb(await khetu.receive_from())
+        json_event = await ravi.receive_json_from()
+        self.assertEqual(binary_event, json_event)
+        self.assertIsInstance(json_event["timestamp"], int)
+
+        await khetu.disconnect()
+        await ravi.disconnect()
+
+    async def test_repeated_typing_frames_send_one_indicator(self):
+        khetu = make_communicator(self.khetu, f"/ws/chat/{self.chat.id}/")
+        ravi = make_communicator(self.ravi, f"/ws/chat/{self.chat.id}/")
+        await khetu.connect()
+        await ravi.connect()
+
+        for _ in range(5):
+            await ravi.send_json_to({"type": "typing", "is_typing": True})
+        event = await khetu.receive_json_from()
+        self.assertEqual(event["type"], "typing_indicator")
+        self.assertTrue(event["is_typing"])
+        self.assertTrue(await khetu.receive_nothing())
+
+        # Dropping the connection clears the indicator for everyone else
+        await ravi.disconnect()
+        self.assertFalse((await khetu.receive_json_from())["is_typing"])
+
+        await khetu.disconnect()
+
+    async def test_legacy_endpoint_rejects_non_participant(self):
+        amit = make_communicator(self.amit, f"/ws/chat/{self.chat.id}/")
+        connected, _ = await amit.connect()
+        self.assertFalse(connected)
+
+
+@override_settings(CHAT_MESSAGE_PERSISTENCE="write_behind")
+class WriteBehindPersistenceTests(TransactionTestCase):
+    def setUp(self):
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.chat = Chat.objects.create(chat_type="private")
+        self.chat.participants.add(self.khetu, self.ravi)
+
+    async def test_messages_are_broadcast_then_written_in_batches(self):
+        khetu = make_communicator(self.khetu, f"/ws/chat/{self.chat.id}/")
+        await khetu.connect()
+
+        for text in ("one", "two", "three"):
+            await khetu.send_json_to({"type": "chat_message", "message": text})
+            event = await khetu.receive_json_from()
+            self.assertEqual(event["message"], text)
+            self.assertIsNone(event["message_id"])
+
+        await message_buffer.flush()
+        contents = [m.content async for m in Message.objects.filter(chat=self.chat).order_by("id")]
+        self.assertEqual(contents, ["one", "two", "three"])
+
+        await khetu.disconnect()
+
+    def test_write_batch_bumps_chat_once_with_latest_timestamp(self):
+        now = timezone.now()
+        write_batch([
+            {"chat_id": self.chat.id, "sender_id": self.khetu.id, "content": "a", "timestamp": now},
+            {"chat_id": self.chat.id, "sender_id": self.ravi.id, "content": "b",
+             "timestamp": now + timedelta(seconds=1)},
+        ])
+
+        self.assertEqual(Message.objects.filter(chat=self.chat).count(), 2)
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.updated_at, now + timedelta(seconds=1))
+
+    async def test_server_shutdown_drains_queued_messages(self):
+        triggers = []
+        reactor = SimpleNamespace(addSystemEventTrigger=lambda *args: triggers.append(args))
+        with patch.dict(sys.modules, {"twisted.internet.reactor": reactor}), \
+                patch("twisted.internet.reactor", reactor, create=True):
+            drain_on_shutdown()
+        [(phase, event, drain)] = triggers
+        self.assertEqual((phase, event), ("before", "shutdown"))
+
+        khetu = make_communicator(self.khetu, f"/ws/chat/{self.chat.id}/")
+        await khetu.connect()
+        with patch.object(message_buffer, "flush_interval", 0.5):
+            await khetu.send_json_to({"type": "chat_message", "message": "bye"})
+            await khetu.receive_json_from()
+            # What daphne does on SIGTERM: cancel the application, no disconnect
+            khetu.future.cancel()
+            self.assertEqual(await Message.objects.filter(chat=self.chat).acount(), 0)
+
+            await drain().asFuture(asyncio.get_running_loop())
+
+        self.assertEqual(await Message.objects.filter(chat=self.chat).acount(), 1)
+
+    @override_settings(CHAT_READ_RECEIPTS={"INTERVAL": 0})
+    async def test_read_receipts_work_by_seq_before_the_row_exists(self):
+        khetu = make_communicator(self.khetu, f"/ws/chat/{self.chat.id}/")
+        ravi = make_communicator(self.ravi, f"/ws/chat/{self.chat.id}/")
+        await khetu.connect()
+        await ravi.connect()
+        await khetu.send_json_to({"type": "chat_message", "message": "hi"})
+        seq = (await ravi.receive_json_from())["seq"]
+        await khetu.receive_json_from()
+        await message_buffer.flush()
+
+        await ravi.send_json_to({"type": "read", "seq": seq})
+
+        self.assertEqual((await khetu.receive_json_from())["seq"], seq)
+        member = await ChatMember.objects.aget(chat=self.chat, user=self.ravi)
+        self.assertEqual(member.last_read_message_id, (await Message.objects.aget(chat=self.chat, seq=seq)).id)
+        await khetu.disconnect()
+        await ravi.disconnect()
+
+    async def test_failed_batch_is_retried_then_written_one_by_one(self):
+        buffer = MessageBuffer(flush_interval=0)
+        buffer.retry_delay = 0
+        now = timezone.now()
+        good = {"chat_id": self.chat.id, "sender_id": self.khetu.id, "content": "ok", "timestamp": now, "seq": 1}
+        # NOT NULL content: the whole batch fails on every attempt
+        bad = {"chat_id": self.chat.id, "sender_id": self.khetu.id, "content": None, "timestamp": now, "seq": 2}
+
+        with self.assertLogs("Apps.ChatApp.message_buffer") as logs:
+            await buffer._write([good, bad])
+
+        self.assertEqual([m.content async for m in Message.objects.filter(chat=self.chat)], ["ok"])
+        self.assertEqual(sum("attempt" in line for line in logs.output), buffer.retries)
+        self.assertTrue(any("seq=2" in line for line in logs.output))
+
+    async def test_retry_skips_messages_already_written(self):
+        buffer = MessageBuffer(flush_interval=0)
+        buffer.retry_delay = 0
+        batch = [{"chat_id": self.chat.id, "sender_id": self.khetu.id, "content": "once",
+                  "timestamp": timezone.now(), "seq": 1}]
+        calls = []
+
+        def commit_then_fail(items):
+            # Stored, then an on_commit callback raises
+            calls.append(len(items))
+            write_batch(items)
+            if len(calls) == 1:
+                raise OperationalError("cache down")
+
+        with patch("Apps.ChatApp.message_buffer.write_batch", commit_then_fail), self.assertLogs("Apps.ChatApp.message_buffer"):
+            await buffer._write(batch)
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(await Message.objects.filter(chat=self.chat).acount(), 1)
+
+
+class TypingTrackerTests(SimpleTestCase):
+    def setUp(self):
+        self.published = []
+
+    async def publish(self, chat_id, is_typing):
+        self.published.append((chat_id, is_typing))
+
+    async def test_only_transitions_are_published(self):
+        tracker = TypingTracker(self.publish, ttl=10, interval=0)
+        for _ in range(5):
+            await tracker.update(1, True)
+        await tracker.update(1, False)
+        await tracker.update(1, False)
+
+        self.assertEqual(self.published, [(1, True), (1, False)])
+
+    async def test_transitions_within_interval_are_coalesced(self):
+        tracker = TypingTracker(self.publish, ttl=10, interval=0.05)
+        await tracker.update(1, True)
+        await tracker.update(1, False)
+        await tracker.update(1, True)
+        await asyncio.sleep(0.1)
+
+        # The false/true flap never left the server
+        self.assertEqual(self.published, [(1, True)])
+
+        await tracker.update(1, False)
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.published, [(1, True), (1, False)])
+
+    async def test_stale_typing_flag_expires(self):
+        tracker = TypingTracker(self.publish, ttl=0.05, interval=0)
+        await tracker.update(1, True)
+        await asyncio.sleep(0.1)
+
+        self.assertEqual(self.published, [(1, True), (1, False)])
+
+    async def test_clear_resets_active_indicator(self):
+        tracker = TypingTracker(self.publish, ttl=10, interval=0)
+        await tracker.update(1, True)
+        await tracker.clear(1)
+        await tracker.clear(2)
+
+        self.assertEqual(self.published, [(1, True), (1, False)])
+        self.assertEqual(tracker.states, {})
+
+
+def reset_presence():
+    presence.local_connections.clear()
+    presence.__dict__.pop("store", None)
+
+
+def login_client(client, user):
+    client.cookies["access"] = str(AccessToken.for_user(user))
+
+
+class PresenceTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        reset_presence()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.chat = Chat.objects.create(chat_type="private")
+        self.chat.participants.add(self.khetu, self.ravi)
+
+    async def test_closing_one_of_two_tabs_keeps_user_online(self):
+        first_tab = make_communicator(self.khetu)
+        second_tab = make_communicator(self.khetu)
+        await first_tab.connect()
+        await second_tab.connect()
+        self.assertTrue(presence.is_online(self.khetu.id))
+
+        await first_tab.disconnect()
+        self.assertTrue(presence.is_online(self.khetu.id))
+
+        await second_tab.disconnect()
+        self.assertFalse(presence.is_online(self.khetu.id))
+
+    def test_connections_without_heartbeat_expire(self):
+        presence.store.add([(self.khetu.id, "dead-node-conn")], time.time() - 120, ttl=60)
+
+        self.assertEqual(presence.online_ids([self.khetu.id, self.ravi.id]), set())
+
+    def test_flush_presence_writes_last_seen_in_one_batch(self):
+        presence.connect(self.khetu.id, "conn-1")
+        presence.connect(self.ravi.id, "conn-2")
+        presence.disconnect(self.ravi.id, "conn-2")
+
+        self.assertEqual(flush_presence(), 2)
+
+        self.khetu.profile.refresh_from_db()
+        self.ravi.profile.refresh_from_db()
+        self.assertTrue(self.khetu.profile.is_online)
+        self.assertFalse(self.ravi.profile.is_online)
+        self.assertEqual(presence.pop_last_seen(), {})
+
+    def test_home_page_does_not_write_profile(self):
+        login_client(self.client, self.khetu)
+        presence.connect(self.ravi.id, "conn-1")
+        before = self.khetu.profile.last_seen
+
+        response = self.client.get(reverse("ChatApp:home"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["online_user_ids"], {self.ravi.id})
+        self.khetu.profile.refresh_from_db()
+        self.assertEqual(self.khetu.profile.last_seen, before)
+        self.assertTrue(presence.is_online(self.khetu.id))
+
+    def test_search_reports_presence(self):
+        login_client(self.client, self.khetu)
+        presence.connect(self.ravi.id, "conn-1")
+
+        response = self.client.get(reverse("ChatApp:search_users"), {"q": "ravi"})
+
+        self.assertEqual(response.json()["users"][0]["is_online"], True)
+
+
+class ChatMembershipCacheTests(TestCase):
+    def setUp(self):
+        chat_membership.clear_local()
+        cache.clear()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.chat = Chat.objects.create(chat_type="private")
+        self.chat.participants.add(self.khetu)
+
+    def test_repeated_checks_hit_no_database(self):
+        self.assertTrue(chat_membership.is_member(self.chat.id, self.khetu.id))
+
+        with self.assertNumQueries(0):
+            self.assertTrue(chat_membership.is_member(self.chat.id, self.khetu.id))
+            self.assertFalse(chat_membership.is_member(self.chat.id, self.ravi.id))
+
+    def test_shared_cache_is_used_after_local_miss(self):
+        chat_membership.is_member(self.chat.id, self.khetu.id)
+        chat_membership.clear_local()
+
+        with self.assertNumQueries(0):
+            self.assertTrue(chat_membership.is_member(self.chat.id, self.khetu.id))
+
+    def test_participant_changes_invalidate(self):
+        self.assertFalse(chat_membership.is_member(self.chat.id, self.ravi.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chat.participants.add(self.ravi)
+        self.assertTrue(chat_membership.is_member(self.chat.id, self.ravi.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ravi.chats.remove(self.chat)
+        self.assertFalse(chat_membership.is_member(self.chat.id, self.ravi.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.khetu.chats.clear()
+        self.assertFalse(chat_membership.is_member(self.chat.id, self.khetu.id))
+
+    def test_load_before_commit_is_dropped_at_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chat.participants.add(self.ravi)
+            # Cached mid-transaction, as a concurrent reader could with the old set
+            chat_membership.is_member(self.chat.id, self.ravi.id)
+
+        with self.assertNumQueries(1):
+            self.assertTrue(chat_membership.is_member(self.chat.id, self.ravi.id))
+
+    def test_room_and_history_404_for_non_member(self):
+        login_client(self.client, self.ravi)
+
+        self.assertEqual(self.client.get(reverse("ChatApp:room", args=[self.chat.id])).status_code, 404)
+        self.assertEqual(
+            self.client.get(reverse("ChatApp:get_chat_messages", args=[self.chat.id])).status_code, 404
+        )
+
+
+class SerializeOnceFanoutTests(SimpleTestCase):
+    def make_consumer(self, user_id):
+        consumer = ChatConsumer()
+        consumer.user = SimpleNamespace(id=user_id)
+        consumer.binary = False
+        consumer.send = AsyncMock()
+        consumer.outbound = OutboundQueue(consumer.write)
+        return consumer
+
+    async def test_chat_message_forwards_pre_encoded_text(self):
+        consumer = self.make_consumer(2)
+        encoded = encode_frame({"type": "chat_message", "chat_id": 1, "message": "hi"})
+
+        await consumer.chat_message({"type": "chat_message", **encoded})
+        await consumer.outbound.drain()
+
+        consumer.send.assert_awaited_once_with(text_data=encoded["text"])
+
+    async def test_typing_indicator_skips_sender(self):
+        sender, other = self.make_consumer(1), self.make_consumer(2)
+        event = {"type": "typing_indicator", "user_id": 1, "text": "{}"}
+
+        await sender.typing_indicator(event)
+        await other.typing_indicator(event)
+        await other.outbound.drain()
+
+        sender.send.assert_not_awaited()
+        other.send.assert_awaited_once_with(text_data="{}")
+
+
+class ResumableSessionTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        recent_history.chats.clear()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.chat = Chat.objects.create(chat_type="private")
+        self.chat.participants.add(self.khetu, self.ravi)
+
+    async def send_messages(self, *texts):
+        khetu = make_communicator(self.khetu, f"/ws/chat/{self.chat.id}/")
+        await khetu.connect()
+        for text in texts:
+            await khetu.send_json_to({"type": "chat_message", "message": text})
+            await khetu.receive_json_from()
+        await khetu.disconnect()
+
+    async def resume(self, last_seq):
+        ravi = make_communicator(self.ravi)
+        await ravi.connect()
+        await ravi.send_json_to({"type": "resume", "chat_id": self.chat.id, "last_seq": last_seq})
+        frames = []
+        while True:
+            frame = await ravi.receive_json_from()
+            frames.append(frame)
+            if frame["type"] != "chat_message":
+                break
+        await ravi.disconnect()
+        return frames
+
+    async def test_messages_get_increasing_seq(self):
+        await self.send_messages("one", "two", "three")
+
+        seqs = [m.seq async for m in Message.objects.filter(chat=self.chat).order_by("id")]
+        self.assertEqual(seqs, [1, 2, 3])
+
+    async def test_resume_replays_only_the_gap(self):
+        await self.send_messages("one", "two", "three")
+
+        frames = await self.resume(1)
+
+        self.assertEqual([f.get("message") for f in frames[:-1]], ["two", "three"])
+        self.assertEqual([f["seq"] for f in frames[:-1]], [2, 3])
+        self.assertEqual(frames[-1], {"type": "resumed", "chat_id": self.chat.id})
+
+    async def test_resume_falls_back_to_database(self):
+        await self.send_messages("one", "two")
+        recent_history.chats.clear()
+
+        frames = await self.resume(0)
+
+        self.assertEqual([f.get("message") for f in frames[:-1]], ["one", "two"])
+
+    @override_settings(CHAT_RESUME={"MAX_REPLAY": 1})
+    async def test_large_gap_requires_resync(self):
+        await self.send_messages("one", "two", "three")
+
+        frames = await self.resume(0)
+
+        self.assertEqual(frames, [{"type": "error", "chat_id": self.chat.id, "error": "resync_required"}])
+
+    async def test_retried_send_with_same_client_id_is_dropped(self):
+        khetu = make_communicator(self.khetu, f"/ws/chat/{self.chat.id}/")
+        await khetu.connect()
+
+        frame = {"type": "chat_message", "message": "hi", "client_id": "c1f0"}
+        await khetu.send_json_to(frame)
+        self.assertEqual((await khetu.receive_json_from())["client_id"], "c1f0")
+        await khetu.send_json_to(frame)
+        self.assertTrue(await khetu.receive_nothing())
+
+        self.assertEqual(await Message.objects.filter(chat=self.chat).acount(), 1)
+        await khetu.disconnect()
+
+    async def test_replay_from_database_carries_client_id(self):
+        # The sender missed its own echo: the replay must clear its outbox
+        khetu = make_communicator(self.khetu, f"/ws/chat/{self.chat.id}/")
+        await khetu.connect()
+        await khetu.send_json_to({"type": "chat_message", "message": "hi", "client_id": "c1f0"})
+        await khetu.receive_json_from()
+        await khetu.disconnect()
+        recent_history.chats.clear()
+
+        frames = await self.resume(0)
+
+        self.assertEqual(frames[0]["client_id"], "c1f0")
+
+    def test_recent_history_requires_contiguous_gap(self):
+        recent_history.add(self.chat.id, 2, {"seq": 2})
+        recent_history.add(self.chat.id, 2, {"seq": 2, "duplicate": True})
+
+        self.assertEqual(recent_history.since(self.chat.id, 1, 2), [{"seq": 2}])
+        self.assertIsNone(recent_history.since(self.chat.id, 0, 2))
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def setUp(self):
+        outbound_stats.clear()
+        self.written = []
+
+    async def write(self, payload):
+        self.written.append(payload)
+
+    async def test_frames_are_written_in_order(self):
+        queue = OutboundQueue(self.write, max_size=10)
+        for n in range(3):
+            self.assertTrue(queue.put(f"m{n}"))
+        await queue.drain()
+
+        self.assertEqual(self.written, ["m0", "m1", "m2"])
+        queue.close()
+
+    async def test_typing_frames_are_shed_before_messages(self):
+        queue = OutboundQueue(self.write, max_size=3, typing_high_water=2)
+        queue.put("m0")
+        queue.put("t0", droppable=True)
+        # Above the typing high-water mark new typing frames are dropped
+        queue.put("t1", droppable=True)
+        self.assertEqual(outbound_stats["dropped_typing"], 1)
+
+        # Full: queued typing frames make room for the message
+        queue.put("m1")
+        self.assertTrue(queue.put("m2"))
+        self.assertEqual([payload for payload, _ in queue.items], ["m0", "m1", "m2"])
+        self.assertEqual(outbound_stats["dropped_typing"], 2)
+        queue.close()
+
+    async def test_overflow_asks_for_disconnect(self):
+        queue = OutboundQueue(self.write, max_size=2)
+        queue.put("m0")
+        queue.put("m1")
+
+        self.assertFalse(queue.put("m2"))
+        self.assertEqual(outbound_stats["disconnects"], 1)
+        queue.close()
+
+    async def test_drop_oldest_policy(self):
+        queue = OutboundQueue(self.write, max_size=2, policy="drop_oldest")
+        queue.put("m0")
+        queue.put("m1")
+
+        self.assertTrue(queue.put("m2"))
+        self.assertEqual([payload for payload, _ in queue.items], ["m1", "m2"])
+        self.assertEqual(outbound_stats["dropped_messages"], 1)
+        queue.close()
+
+    async def test_slow_consumer_is_closed_with_resume_hint(self):
+        consumer = ChatConsumer()
+        consumer.binary = False
+        consumer.outbound = OutboundQueue(consumer.write, max_size=1)
+        consumer.outbound.put("stuck")
+        consumer.close = AsyncMock()
+
+        await consumer.send_encoded({"text": "{}", "bytes": b""})
+
+        consumer.close.assert_awaited_once_with(code=4008, reason="slow_consumer:resume")
+        consumer.outbound.close()
+
+
+class ChatMessagesAPIViewTests(TestCase):
+    def setUp(self):
+        chat_membership.clear_local()
+        cache.clear()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.chat = Chat.objects.create(chat_type="private")
+        self.chat.participants.add(self.khetu, self.ravi)
+        start = timezone.now() - timedelta(hours=1)
+        self.messages = [
+            Message.objects.create(
+                chat=self.chat,
+                sender=self.khetu if n % 2 else self.ravi,
+                content=f"m{n}",
+                # Pairs share a timestamp so the id tiebreaker matters
+                timestamp=start + timedelta(seconds=n // 2),
+                seq=n + 1,
+            )
+            for n in range(7)
+        ]
+        login_client(self.client, self.khetu)
+        self.url = reverse("ChatApp:get_chat_messages", args=[self.chat.id])
+
+    def test_default_page_is_newest_messages_oldest_first(self):
+        data = self.client.get(self.url, {"limit": 3}).json()
+
+        self.assertEqual([m["content"] for m in data["messages"]], ["m4", "m5", "m6"])
+        self.assertTrue(data["has_older"])
+        self.assertFalse(data["has_newer"])
+        self.assertEqual([m["is_own"] for m in data["messages"]], [False, True, False])
+
+    def test_before_cursor_walks_whole_history_without_gaps(self):
+        seen, params = [], {"limit": 3}
+        while True:
+            data = self.client.get(self.url, params).json()
+            seen = [m["content"] for m in data["messages"]] + seen
+            if not data["has_older"]:
+                break
+            params = {"limit": 3, "before": data["before"]}
+
+        self.assertEqual(seen, [f"m{n}" for n in range(7)])
+
+    def test_after_cursor_returns_newer_messages(self):
+        data = self.client.get(self.url, {"limit": 2}).json()
+        older = self.client.get(self.url, {"limit": 2, "before": data["before"]}).json()
+
+        newer = self.client.get(self.url, {"limit": 5, "after": older["after"]}).json()
+
+        self.assertEqual([m["content"] for m in newer["messages"]], ["m5", "m6"])
+        self.assertFalse(newer["has_newer"])
+
+    def test_query_count_does_not_depend_on_page_size(self):
+        self.client.get(self.url)  # warm the membership cache
+
+        with self.assertNumQueries(2):  # JWT user + one page query
+            self.client.get(self.url, {"limit": 2})
+        with self.assertNumQueries(2):
+            self.client.get(self.url, {"limit": 200})
+
+    def test_invalid_cursor_returns_400(self):
+        response = self.client.get(self.url, {"before": "not-a-cursor"})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "Invalid cursor")
+
+
+class ChatRoomTailTests(TestCase):
+    def setUp(self):
+        chat_membership.clear_local()
+        cache.clear()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.chat = Chat.objects.create(chat_type="group")
+        self.chat.participants.add(self.khetu)
+        start = timezone.now() - timedelta(hours=1)
+        Message.objects.bulk_create([
+            Message(chat=self.chat, sender=self.khetu, content=f"m{n}",
+                    timestamp=start + timedelta(seconds=n), seq=n + 1)
+            for n in range(ROOM_TAIL_SIZE + 5)
+        ])
+        login_client(self.client, self.khetu)
+
+    def test_room_renders_only_the_newest_messages(self):
+        response = self.client.get(reverse("ChatApp:room", args=[self.chat.id]))
+
+        rendered = [m.content for m in response.context["messages"]]
+        self.assertEqual(rendered, [f"m{n}" for n in range(5, ROOM_TAIL_SIZE + 5)])
+        self.assertTrue(response.context["has_older"])
+
+    def test_tail_times_are_epoch_ms_for_the_client_to_format(self):
+        response = self.client.get(reverse("ChatApp:room", args=[self.chat.id]))
+
+        newest = response.context["messages"][-1]
+        self.assertContains(response, f'data-timestamp="{to_epoch_ms(newest.timestamp)}"')
+        self.assertEqual(response.context["last_seq"], ROOM_TAIL_SIZE + 5)
+
+    def test_older_page_continues_from_the_rendered_tail(self):
+        response = self.client.get(reverse("ChatApp:room", args=[self.chat.id]))
+
+        older = self.client.get(
+            reverse("ChatApp:get_chat_messages", args=[self.chat.id]),
+            {"before": response.context["before_cursor"]},
+        ).json()
+
+        self.assertEqual([m["content"] for m in older["messages"]], [f"m{n}" for n in range(5)])
+        self.assertFalse(older["has_older"])
+
+
+class ReadWatermarkTests(TestCase):
+    def setUp(self):
+        chat_membership.clear_local()
+        cache.clear()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.chat = Chat.objects.create(chat_type="private")
+        self.chat.participants.add(self.khetu, self.ravi)
+        self.messages = [
+            Message.objects.create(chat=self.chat, sender=self.ravi, content=f"m{n}") for n in range(5)
+        ]
+
+    def watermark(self, user):
+        return ChatMember.objects.get(chat=self.chat, user=user).last_read_message_id
+
+    def test_member_rows_follow_participants(self):
+        self.assertEqual(ChatMember.objects.filter(chat=self.chat).count(), 2)
+
+        self.ravi.chats.remove(self.chat)
+        self.assertFalse(ChatMember.objects.filter(chat=self.chat, user=self.ravi).exists())
+
+        self.ravi.chats.add(self.chat)
+        self.chat.participants.clear()
+        self.assertFalse(ChatMember.objects.filter(chat=self.chat).exists())
+
+    def test_mark_read_is_one_update_and_never_moves_back(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(mark_read(self.chat.id, self.khetu.id, self.messages[3].id))
+        self.assertFalse(mark_read(self.chat.id, self.khetu.id, self.messages[1].id))
+
+        self.assertEqual(self.watermark(self.khetu), self.messages[3].id)
+
+    def test_opening_room_reads_to_newest_message(self):
+        login_client(self.client, self.khetu)
+
+        self.client.get(reverse("ChatApp:room", args=[self.chat.id]))
+
+        self.assertEqual(self.watermark(self.khetu), self.messages[-1].id)
+        self.assertEqual(ChatMember.objects.get(chat=self.chat, user=self.khetu).unread_count, 0)
+
+
+class ReadReceiptTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.chat = Chat.objects.create(chat_type="private")
+        self.chat.participants.add(self.khetu, self.ravi)
+        self.message_ids = [
+            Message.objects.create(chat=self.chat, sender=self.khetu, content=f"m{n}", seq=n + 1).id for n in range(3)
+        ]
+
+    @override_settings(CHAT_READ_RECEIPTS={"INTERVAL": 0.05})
+    async def test_read_frames_are_coalesced_into_one_receipt(self):
+        khetu = make_communicator(self.khetu, f"/ws/chat/{self.chat.id}/")
+        ravi = make_communicator(self.ravi, f"/ws/chat/{self.chat.id}/")
+        await khetu.connect()
+        await ravi.connect()
+
+        for seq in (1, 2, 3):
+            await ravi.send_json_to({"type": "read", "seq": seq})
+
+        self.assertEqual(await khetu.receive_json_from(), {
+            "type": "read_receipt",
+            "chat_id": self.chat.id,
+            "user_id": self.ravi.id,
+            "seq": 3,
+        })
+        self.assertTrue(await khetu.receive_nothing(0.1))
+
+        member = await ChatMember.objects.aget(chat=self.chat, user=self.ravi)
+        self.assertEqual(member.last_read_message_id, self.message_ids[-1])
+        await khetu.disconnect()
+        await ravi.disconnect()
+
+
+class ConversationSummaryTests(TestCase):
+    def setUp(self):
+        chat_membership.clear_local()
+        cache.clear()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.chat = Chat.objects.create(chat_type="private")
+        self.chat.participants.add(self.khetu, self.ravi)
+
+    def member(self, user, chat=None):
+        return ChatMember.objects.get(chat=chat or self.chat, user=user)
+
+    def save(self, sender, content, chat=None):
+        # Sidebar versions are bumped on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            message = Message.objects.create(chat=chat or self.chat, sender=sender, content=content)
+            record_messages([message])
+        return message
+
+    def start_chat_with(self, username):
+        other = User.objects.create_user(username=username, email=f"{username}@gmail.com", password="StrongPass123!")
+        chat = Chat.objects.create(chat_type="private")
+        chat.participants.add(self.khetu, other)
+        self.save(other, f"hi from {username}", chat)
+        return chat
+
+    def test_private_members_point_at_each_other(self):
+        self.assertEqual(self.member(self.khetu).other_user, self.ravi)
+        self.assertEqual(self.member(self.ravi).other_user, self.khetu)
+
+        self.chat.participants.remove(self.ravi)
+        self.assertIsNone(self.member(self.khetu).other_user)
+
+    def test_new_message_updates_preview_and_unread(self):
+        self.save(self.ravi, "first")
+        message = self.save(self.ravi, "second")
+
+        khetu = self.member(self.khetu)
+        self.assertEqual(khetu.last_message_preview, "second")
+        self.assertEqual(khetu.last_message_sender_id, self.ravi.id)
+        self.assertEqual(khetu.last_activity_at, message.timestamp)
+        self.assertEqual(khetu.unread_count, 2)
+        self.assertEqual(self.member(self.ravi).unread_count, 0)
+
+    def test_mark_read_recounts_unread(self):
+        first = self.save(self.ravi, "first")
+        self.save(self.ravi, "second")
+
+        mark_read(self.chat.id, self.khetu.id, first.id)
+
+        self.assertEqual(self.member(self.khetu).unread_count, 1)
+
+    def test_write_behind_batch_with_mixed_senders(self):
+        now = timezone.now()
+        write_batch([
+            {"chat_id": self.chat.id, "sender_id": self.ravi.id, "content": "a", "timestamp": now, "seq": 1},
+            {"chat_id": self.chat.id, "sender_id": self.khetu.id, "content": "b", "timestamp": now, "seq": 2},
+            {"chat_id": self.chat.id, "sender_id": self.ravi.id, "content": "c",
+             "timestamp": now + timedelta(seconds=1), "seq": 3},
+        ])
+
+        self.assertEqual(self.member(self.khetu).unread_count, 2)
+        self.assertEqual(self.member(self.ravi).unread_count, 1)
+        self.assertEqual(self.member(self.ravi).last_message_preview, "c")
+
+    def test_sidebar_is_paginated_newest_first(self):
+        self.save(self.ravi, "old")
+        newer = [self.start_chat_with(f"user{n}") for n in range(3)]
+
+        page = conversation_page(self.khetu, limit=2)
+        self.assertEqual([m.chat_id for m in page["conversations"]], [newer[2].id, newer[1].id])
+
+        rest = conversation_page(self.khetu, before=page["next_cursor"], limit=2)
+        self.assertEqual([m.chat_id for m in rest["conversations"]], [newer[0].id, self.chat.id])
+        self.assertIsNone(rest["next_cursor"])
+
+    def test_home_page_queries_do_not_grow_with_chats(self):
+        login_client(self.client, self.khetu)
+        self.start_chat_with("user0")
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(reverse("ChatApp:home"))
+
+        for n in range(1, 6):
+            self.start_chat_with(f"user{n}")
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(reverse("ChatApp:home"))
+
+        self.assertContains(response, "hi from user5")
+        self.assertEqual(len(many), len(few))
+
+    def test_conversations_api_renders_next_page(self):
+        login_client(self.client, self.khetu)
+        self.save(self.ravi, "older chat")
+        self.start_chat_with("user0")
+        cursor = conversation_page(self.khetu, limit=1)["next_cursor"]
+
+        data = self.client.get(reverse("ChatApp:conversations"), {"before": cursor}).json()
+
+        self.assertIn("older chat", data["html"])
+        self.assertIsNone(data["next"])
+
+
+class SidebarCacheTests(TestCase):
+    def setUp(self):
+        chat_membership.clear_local()
+        cache.clear()
+        reset_presence()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.chat = Chat.objects.create(chat_type="private")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chat.participants.add(self.khetu, self.ravi)
+        login_client(self.client, self.khetu)
+
+    def render_home(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("ChatApp:home"))
+        sidebar_queries = [q for q in queries if "last_activity_at" in q["sql"] and "SELECT" in q["sql"]]
+        return response, bool(sidebar_queries)
+
+    def test_unchanged_sidebar_is_served_from_cache(self):
+        _, rebuilt = self.render_home()
+        self.assertTrue(rebuilt)
+
+        response, rebuilt = self.render_home()
+        self.assertFalse(rebuilt)
+        self.assertContains(response, "ravi")
+
+    def test_new_message_invalidates(self):
+        self.render_home()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            record_messages([Message.objects.create(chat=self.chat, sender=self.ravi, content="fresh news")])
+
+        response, rebuilt = self.render_home()
+        self.assertTrue(rebuilt)
+        self.assertContains(response, "fresh news")
+
+    def test_read_state_change_invalidates(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            message = Message.objects.create(chat=self.chat, sender=self.ravi, content="unread")
+            record_messages([message])
+        self.assertContains(self.render_home()[0], 'class="unread-count"')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            mark_read(self.chat.id, self.khetu.id, message.id)
+
+        self.assertNotContains(self.render_home()[0], 'class="unread-count"')
+
+    def test_profile_change_invalidates_contacts_only_when_visible_fields_change(self):
+        self.render_home()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ravi.save(update_fields=["last_login"])  # what a login does
+        self.assertFalse(self.render_home()[1])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ravi.first_name, self.ravi.last_name = "Ravi", "Patel"
+            self.ravi.save()
+
+        response, rebuilt = self.render_home()
+        self.assertTrue(rebuilt)
+        self.assertContains(response, "Ravi Patel")
+
+    def test_presence_change_rerenders(self):
+        self.render_home()
+
+        presence.connect(self.ravi.id, "ravi-socket")
+
+        response, rebuilt = self.render_home()
+        self.assertTrue(rebuilt)
+        self.assertContains(response, 'class="online-indicator"')
+
+
+class UserSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        prefix_index.invalidate()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        for username, first_name, last_name in [
+            ("ravindra", "", ""),
+            ("ravi", "", ""),
+            ("kp", "Ravi", "Patel"),
+            ("aravind", "", ""),
+        ]:
+            User.objects.create_user(
+                username=username, email=f"{username}@gmail.com", password="StrongPass123!",
+                first_name=first_name, last_name=last_name,
+            )
+        login_client(self.client, self.khetu)
+
+    def search(self, q):
+        response = self.client.get(reverse("ChatApp:search_users"), {"q": q})
+        return [user["username"] for user in response.json()["users"]]
+
+    def test_username_prefix_ranks_first(self):
+        self.assertEqual(self.search("Ravi"), ["ravi", "ravindra", "kp"])
+
+    def test_full_name_and_last_name_prefixes_match(self):
+        self.assertEqual(self.search("ravi  pat"), ["kp"])
+        self.assertEqual(self.search("patel"), ["kp"])
+
+    def test_requester_is_excluded(self):
+        self.assertEqual(self.search("khe"), [])
+
+    def test_repeated_query_is_served_from_cache(self):
+        search_user_ids("rav")
+
+        with self.assertNumQueries(0):
+            self.assertEqual(search_user_ids("RAV "), search_user_ids("rav"))
+
+    def test_renames_reach_the_index(self):
+        self.assertEqual(self.search("zed"), [])
+        cache.clear()
+
+        kp = User.objects.get(username="kp")
+        kp.first_name = "Zed"
+        kp.save()
+
+        self.assertEqual(self.search("zed"), ["kp"])
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        chat_membership.clear_local()
+        cache.clear()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.chat = Chat.objects.create(chat_type="private")
+        self.chat.participants.add(self.khetu, self.ravi)
+        self.other_chat = Chat.objects.create(chat_type="group")
+        self.other_chat.participants.add(self.ravi)
+        login_client(self.client, self.khetu)
+        self.url = reverse("ChatApp:search_messages")
+
+    def post(self, content, chat=None, sender=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            message = Message.objects.create(chat=chat or self.chat, sender=sender or self.ravi, content=content)
+            queue_indexing([message.id])
+        return message
+
+    def search(self, **params):
+        return self.client.get(self.url, params).json()
+
+    def test_matches_prefixes_in_own_chats_only(self):
+        self.post("Standup moved to ten tomorrow")
+        self.post("standup notes are in the doc", chat=self.other_chat)
+        self.post("lunch?")
+
+        results = self.search(q="stand tomor")["results"]
+
+        self.assertEqual([r["content"] for r in results], ["Standup moved to ten tomorrow"])
+        self.assertIn("<mark>Standup</mark>", results[0]["snippet"])
+
+    def test_snippet_escapes_message_html(self):
+        self.post("<script>alert(1)</script> deploy")
+
+        snippet = self.search(q="deploy")["results"][0]["snippet"]
+
+        self.assertNotIn("<script>", snippet)
+        self.assertIn("&lt;script&gt;", snippet)
+        self.assertIn("<mark>deploy</mark>", snippet)
+
+    def test_results_are_keyset_paginated_newest_first(self):
+        for n in range(5):
+            self.post(f"release {n}")
+
+        first = self.search(q="release", limit=2)
+        second = self.search(q="release", limit=2, before=first["next"])
+        third = self.search(q="release", limit=2, before=second["next"])
+
+        seen = [r["content"] for page in (first, second, third) for r in page["results"]]
+        self.assertEqual(seen, [f"release {n}" for n in reversed(range(5))])
+        self.assertIsNone(third["next"])
+
+    def test_chat_filter_and_empty_query(self):
+        self.post("release party")
+        third = User.objects.create_user(username="mira", email="mira@gmail.com", password="StrongPass123!")
+        chat = Chat.objects.create(chat_type="private")
+        chat.participants.add(self.khetu, third)
+        self.post("release notes", chat=chat, sender=third)
+
+        results = self.search(q="release", chat=chat.id)["results"]
+
+        self.assertEqual([r["content"] for r in results], ["release notes"])
+        self.assertEqual(self.search(q="  ")["results"], [])
+
+    def test_catch_up_task_indexes_missed_messages(self):
+        Message.objects.create(chat=self.chat, sender=self.ravi, content="backfilled message")
+        self.assertEqual(self.search(q="backfilled")["results"], [])
+
+        self.assertEqual(index_unindexed_messages(), 1)
+
+        self.assertEqual(len(self.search(q="backfilled")["results"]), 1)
+
+
+class PrivateChatPairTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        login_client(self.client, self.khetu)
+
+    def test_start_chat_reuses_the_pair_chat_from_either_side(self):
+        response = self.client.get(reverse("ChatApp:start_chat", args=[self.ravi.id]))
+        chat = Chat.objects.get()
+        self.assertRedirects(response, reverse("ChatApp:room", args=[chat.id]), fetch_redirect_response=False)
+        self.assertEqual((chat.low_user_id, chat.high_user_id), tuple(sorted((self.khetu.id, self.ravi.id))))
+
+        login_client(self.client, self.ravi)
+        self.client.get(reverse("ChatApp:start_chat", args=[self.khetu.id]))
+
+        self.assertEqual(Chat.objects.count(), 1)
+        self.assertEqual(set(chat.participants.values_list("id", flat=True)), {self.khetu.id, self.ravi.id})
+
+    def test_existing_pair_is_one_indexed_lookup(self):
+        Chat.get_or_create_private(self.khetu, self.ravi)
+
+        with CaptureQueriesContext(connection) as queries:
+            chat, created = Chat.get_or_create_private(self.ravi, self.khetu)
+        self.assertFalse(created)
+        selects = [query["sql"] for query in queries.captured_queries if query["sql"].startswith("SELECT")]
+        self.assertEqual(len(selects), 1)
+        self.assertIn('"low_user_id" =', selects[0])
+
+    def test_database_rejects_a_second_chat_for_the_pair(self):
+        chat, _ = Chat.get_or_create_private(self.khetu, self.ravi)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Chat.objects.create(chat_type="private", low_user_id=chat.low_user_id, high_user_id=chat.high_user_id)
+        # Group chats are not keyed by pair
+        Chat.objects.create(chat_type="group", low_user_id=chat.low_user_id, high_user_id=chat.high_user_id)
+
+    def test_deleting_a_participant_keeps_the_other_sides_history(self):
+        meera = User.objects.create_user(username="meera", email="meera@gmail.com", password="StrongPass123!")
+        chat, _ = Chat.get_or_create_private(self.khetu, self.ravi)
+        other_chat, _ = Chat.get_or_create_private(self.khetu, meera)
+        Message.objects.create(chat=chat, sender=self.khetu, content="hello", seq=1)
+        Message.objects.create(chat=chat, sender=self.ravi, content="hi", seq=2)
+
+        self.ravi.delete()
+        # Both chats now have a NULL on the same side: no unique conflict
+        meera.delete()
+
+        chat.refresh_from_db()
+        self.assertEqual((chat.low_user_id, chat.high_user_id), (self.khetu.id, None))
+        self.assertTrue(Chat.objects.filter(id=other_chat.id).exists())
+        self.assertEqual(list(chat.messages.values_list("content", flat=True)), ["hello"])
+        self.assertTrue(ChatMember.objects.filter(chat=chat, user=self.khetu).exists())
+
+
+class QueryBudget:
+    """
+    Fails when the block runs more than `budget` queries.
+
+    Every query is recorded with the project frames that issued it (and
+    the template line, when a template triggered it) so an N+1 shows up
+    as the same origin repeated in the failure message.
+    """
+
+    def __init__(self, test, name, budget):
+        self.test = test
+        self.name = name
+        self.budget = budget
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append((sql, self.origin()))
+        return execute(sql, params, many, context)
+
+    def origin(self):
+        frames, template_line = [], None
+        frame = sys._getframe(2)
+        while frame:
+            code = frame.f_code
+            if template_line is None and code.co_name == "render_annotated":
+                node = frame.f_locals.get("self")
+                if getattr(node, "origin", None) is not None:
+                    template_line = f"{node.origin.template_name}:{node.token.lineno}"
+            if code.co_filename.startswith(str(settings.BASE_DIR)) and "site-packages" not in code.co_filename:
+                frames.append(f"{code.co_filename[len(str(settings.BASE_DIR)) + 1:]}:{frame.f_lineno} in {code.co_name}")
+            frame = frame.f_back
+        if template_line:
+            frames.insert(0, f"template {template_line}")
+        return frames
+
+    def __enter__(self):
+        self.wrapper_enter()
+        return self
+
+    async def __aenter__(self):
+        # Consumer queries run on consumer_db's threads, whose connections
+        # are not the one the test coroutine sees
+        consumer_db.execute_wrappers.append(self)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        consumer_db.execute_wrappers.remove(self)
+        self.check(exc_info)
+
+    def wrapper_enter(self):
+        self.wrapper = connection.execute_wrapper(self)
+        self.wrapper.__enter__()
+
+    def wrapper_exit(self, *exc_info):
+        self.wrapper.__exit__(*exc_info)
+
+    def __exit__(self, *exc_info):
+        self.wrapper_exit(*exc_info)
+        self.check(exc_info)
+
+    def check(self, exc_info):
+        if exc_info[0] is not None or len(self.queries) <= self.budget:
+            return
+        report = "\n".join(
+            f"{number}. {sql}\n" + "\n".join(f"     {line}" for line in origin)
+            for number, (sql, origin) in enumerate(self.queries, start=1)
+        )
+        self.test.fail(f"{self.name}: {len(self.queries)} queries, budget is {self.budget}\n{report}")
+
+
+# Queries each code path may run against the seeded data below, counting
+# transaction statements (SAVEPOINT/RELEASE) too. Raise a budget only
+# together with the reason; growing with the data is a bug.
+QUERY_BUDGETS = {
+    "home": 2,
+    "room": 8,
+    "start_chat": 5,
+    "chat_messages": 3,
+    "conversations": 2,
+    "search_messages": 3,
+    "search_users": 3,
+    "export": 4,
+    "consumer.connect": 0,
+    "consumer.subscribe": 1,
+    "consumer.chat_message": 9,
+    "consumer.read": 1,
+    "consumer.resume": 2,
+    "consumer.disconnect": 0,
+}
+
+SEED_CONVERSATIONS = 60  # more than one sidebar page
+SEED_MESSAGES = 120  # per chat with the main user, several history pages
+
+
+def seed_chats(user, conversations, messages_per_chat):
+    """`conversations` private chats of `user`, the first one busy; returns them."""
+    others = [
+        User.objects.create_user(
+            username=f"friend{n}", email=f"friend{n}@gmail.com", password="StrongPass123!",
+            first_name=f"Friend{n}", last_name="Kumar",
+        )
+        for n in range(conversations)
+    ]
+    chats = []
+    for n, other in enumerate(others):
+        chat, _ = Chat.get_or_create_private(user, other)
+        count = messages_per_chat if n == 0 else 3
+        messages = Message.objects.bulk_create(
+            Message(chat=chat, sender=(user, other)[i % 2], content=f"hello {n} number {i}", seq=i + 1)
+            for i in range(count)
+        )
+        record_messages(messages)
+        index_messages([message.id for message in messages])
+        chats.append(chat)
+    return chats
+
+
+async def read_stream(response):
+    return b"".join([chunk async for chunk in response.streaming_content])
+
+
+class QueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        cls.chats = seed_chats(cls.khetu, SEED_CONVERSATIONS, SEED_MESSAGES)
+
+    def setUp(self):
+        # Cold caches: the budgets cover a first visit
+        cache.clear()
+        chat_membership.clear_local()
+        prefix_index.invalidate()
+        login_client(self.client, self.khetu)
+
+    def within_budget(self, name):
+        return QueryBudget(self, name, QUERY_BUDGETS[name])
+
+    def test_home(self):
+        with self.within_budget("home"):
+            response = self.client.get(reverse("ChatApp:home"))
+        self.assertEqual(response.status_code, 200)
+
+    def test_room(self):
+        with self.within_budget("room"):
+            response = self.client.get(reverse("ChatApp:room", args=[self.chats[0].id]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_start_chat(self):
+        friend = self.chats[1].participants.exclude(id=self.khetu.id).get()
+        with self.within_budget("start_chat"):
+            response = self.client.get(reverse("ChatApp:start_chat", args=[friend.id]))
+        self.assertEqual(response.status_code, 302)
+
+    def test_chat_messages(self):
+        url = reverse("ChatApp:get_chat_messages", args=[self.chats[0].id])
+        before = self.client.get(url).json()["before"]
+        chat_membership.clear_local()
+        cache.clear()
+
+        with self.within_budget("chat_messages"):
+            response = self.client.get(url, {"before": before, "limit": 50})
+        self.assertEqual(len(response.json()["messages"]), 50)
+
+    def test_conversations(self):
+        before = conversation_page(self.khetu)["next_cursor"]
+        with self.within_budget("conversations"):
+            response = self.client.get(reverse("ChatApp:conversations"), {"before": before})
+        self.assertEqual(response.json()["html"].count("data-chat-id"), SEED_CONVERSATIONS - 50)
+
+    def test_search_messages(self):
+        with self.within_budget("search_messages"):
+            response = self.client.get(reverse("ChatApp:search_messages"), {"q": "hello"})
+        self.assertEqual(len(response.json()["results"]), 20)
+
+    def test_search_users(self):
+        with self.within_budget("search_users"):
+            response = self.client.get(reverse("ChatApp:search_users"), {"q": "friend"})
+        self.assertEqual(len(response.json()["users"]), 10)
+
+    @override_settings(CHAT_EXPORT={"CHUNK_SIZE": 20, "LINES_PER_WRITE": 10})
+    def test_export(self):
+        # Many cursor fetches and response chunks; the count must not grow with the history
+        counts = []
+        for chat, expected in ((self.chats[1], 3), (self.chats[0], SEED_MESSAGES)):
+            cache.clear()
+            chat_membership.clear_local()
+            with self.within_budget("export") as budget:
+                response = self.client.get(reverse("ChatApp:export_chat", args=[chat.id]))
+                # The stream is async; its cursor still runs on this thread
+                lines = async_to_sync(read_stream)(response).splitlines()
+            self.assertEqual(len(lines), expected)
+            counts.append(len(budget.queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_budget_failure_names_the_origin(self):
+        with self.assertRaises(AssertionError) as failure:
+            with QueryBudget(self, "probe", 1):
+                for chat in Chat.objects.all()[:3]:
+                    chat.participants.count()
+        self.assertIn("probe: 4 queries, budget is 1", str(failure.exception))
+        self.assertIn("Apps/ChatApp/tests.py", str(failure.exception))
+
+
+class ConsumerQueryBudgetTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        chat_membership.clear_local()
+        recent_history.chats.clear()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.chats = seed_chats(self.khetu, 5, SEED_MESSAGES)
+
+    def within_budget(self, name):
+        return QueryBudget(self, name, QUERY_BUDGETS[name])
+
+    @override_settings(CHAT_READ_RECEIPTS={"INTERVAL": 0})
+    async def test_consumer_handlers(self):
+        chat_id = self.chats[0].id
+        last_message = await Message.objects.filter(chat_id=chat_id).alatest("id")
+        communicator = make_communicator(self.khetu)
+
+        async with self.within_budget("consumer.connect"):
+            self.assertTrue((await communicator.connect())[0])
+
+        async with self.within_budget("consumer.subscribe"):
+            await communicator.send_json_to({"type": "subscribe", "chat_id": chat_id})
+            self.assertEqual((await communicator.receive_json_from())["type"], "subscribed")
+
+        async with self.within_budget("consumer.chat_message"):
+            await communicator.send_json_to({"type": "chat_message", "chat_id": chat_id, "message": "hi"})
+            self.assertEqual((await communicator.receive_json_from())["message"], "hi")
+
+        async with self.within_budget("consumer.read"):
+            await communicator.send_json_to({"type": "read", "chat_id": chat_id, "seq": last_message.seq})
+            self.assertEqual((await communicator.receive_json_from())["type"], "read_receipt")
+
+        # Nothing in this process's recent history: the replay reads the table
+        recent_history.chats.clear()
+        async with self.within_budget("consumer.resume"):
+            await communicator.send_json_to({"type": "resume", "chat_id": self.chats[1].id, "last_seq": 0})
+            frames = [await communicator.receive_json_from() for _ in range(4)]
+        self.assertEqual(frames[-1]["type"], "resumed")
+
+        async with self.within_budget("consumer.disconnect"):
+            await communicator.disconnect()
+
+
+ARCHIVE_STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+    "chat_archive": {"BACKEND": "django.core.files.storage.InMemoryStorage"},
+}
+
+
+@override_settings(
+    STORAGES=ARCHIVE_STORAGES,
+    CHAT_ARCHIVE={"STORAGE": "chat_archive", "AFTER_DAYS": 30, "SEGMENT_SIZE": 4},
+)
+class MessageArchiveTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        chat_membership.clear_local()
+        segment_cache.clear()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.chat, _ = Chat.get_or_create_private(self.khetu, self.ravi)
+        login_client(self.client, self.khetu)
+
+    def add_messages(self, chat, count, days_ago, first_seq):
+        start = timezone.now() - timedelta(days=days_ago)
+        messages = Message.objects.bulk_create(
+            Message(
+                chat=chat, sender=(self.khetu, self.ravi)[n % 2], content=f"m{first_seq + n}",
+                timestamp=start + timedelta(minutes=n), seq=first_seq + n,
+            )
+            for n in range(count)
+        )
+        index_messages([message.id for message in messages])
+        return messages
+
+    def walk(self, url, **params):
+        seen = []
+        while True:
+            data = self.client.get(url, {"limit": 3, **params}).json()
+            seen = [m["content"] for m in data["messages"]] + seen
+            if not data["has_older"]:
+                return seen
+            params = {"before": data["before"]}
+
+    def test_busy_chat_archives_whole_segments_and_history_reads_through(self):
+        self.add_messages(self.chat, 10, days_ago=60, first_seq=1)
+        self.add_messages(self.chat, 3, days_ago=0, first_seq=11)
+
+        self.assertEqual(archive_cold_messages(), 8)
+
+        # Two full segments; the two cold messages left over wait for the next one
+        self.assertEqual(list(MessageArchiveSegment.objects.values_list("message_count", flat=True)), [4, 4])
+        self.assertEqual(Message.objects.filter(chat=self.chat).count(), 5)
+        url = reverse("ChatApp:get_chat_messages", args=[self.chat.id])
+        self.assertEqual(self.walk(url), [f"m{n}" for n in range(1, 14)])
+        # Archived messages leave the search index with the table
+        self.assertEqual(search_messages(self.khetu, "m3")["results"], [])
+
+    def test_after_cursor_continues_from_archive_into_the_table(self):
+        self.add_messages(self.chat, 8, days_ago=60, first_seq=1)
+        self.add_messages(self.chat, 5, days_ago=0, first_seq=9)
+        archive_cold_messages()
+        url = reverse("ChatApp:get_chat_messages", args=[self.chat.id])
+        everything = self.client.get(url, {"limit": 13}).json()
+        self.assertEqual(everything["messages"][0]["content"], "m1")
+
+        # Cursor on m1, which lives in the first segment
+        newer = self.client.get(url, {"limit": 5, "after": everything["before"]}).json()
+        self.assertEqual([m["content"] for m in newer["messages"]], ["m2", "m3", "m4", "m5", "m6"])
+        self.assertTrue(newer["has_newer"])
+        newer = self.client.get(url, {"limit": 5, "after": newer["after"]}).json()
+        self.assertEqual([m["content"] for m in newer["messages"]], ["m7", "m8", "m9", "m10", "m11"])
+
+    def test_idle_chat_is_archived_whole_and_keeps_its_seq(self):
+        self.add_messages(self.chat, 6, days_ago=60, first_seq=1)
+        Chat.objects.filter(id=self.chat.id).update(updated_at=timezone.now() - timedelta(days=59))
+
+        self.assertEqual(archive_cold_messages(), 6)
+        self.assertFalse(Message.objects.filter(chat=self.chat).exists())
+
+        response = self.client.get(reverse("ChatApp:room", args=[self.chat.id]))
+        self.assertEqual([m.content for m in response.context["messages"]], [f"m{n}" for n in range(1, 7)])
+        self.assertEqual(response.context["last_seq"], 6)
+        self.assertEqual(next_seq(self.chat.id), 7)
+
+    def test_runs_walk_the_chats_from_where_the_last_one_stopped(self):
+        amit = User.objects.create_user(username="amit", email="amit@gmail.com", password="StrongPass123!")
+        other_chat, _ = Chat.get_or_create_private(self.khetu, amit)
+        self.add_messages(self.chat, 4, days_ago=60, first_seq=1)
+        self.add_messages(other_chat, 4, days_ago=60, first_seq=1)
+
+        with self.settings(CHAT_ARCHIVE={**settings.CHAT_ARCHIVE, "CHATS_PER_RUN": 1}):
+            archive_cold_messages()
+            self.assertEqual(list(MessageArchiveSegment.objects.values_list("chat_id", flat=True)), [self.chat.id])
+            archive_cold_messages()
+
+        self.assertEqual(
+            sorted(MessageArchiveSegment.objects.values_list("chat_id", flat=True)), [self.chat.id, other_chat.id]
+        )
+
+    def test_deleting_the_chat_deletes_its_segment_files(self):
+        self.add_messages(self.chat, 4, days_ago=60, first_seq=1)
+        archive_cold_messages()
+        path = MessageArchiveSegment.objects.get().path
+        storage = storages["chat_archive"]
+        self.assertTrue(storage.exists(path))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chat.delete()
+
+        self.assertFalse(storage.exists(path))
+
+
+@override_settings(
+    STORAGES=ARCHIVE_STORAGES,
+    CHAT_ARCHIVE={"STORAGE": "chat_archive", "AFTER_DAYS": 30, "SEGMENT_SIZE": 2},
+    CHAT_EXPORT={"CHUNK_SIZE": 2, "LINES_PER_WRITE": 2},
+)
+class ChatExportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        chat_membership.clear_local()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.chat, _ = Chat.get_or_create_private(self.khetu, self.ravi)
+        start = timezone.now() - timedelta(days=60)
+        contents = ["hi", 'say "cheese", ok', "two\nlines", "bye", "later"]
+        Message.objects.bulk_create(
+            Message(
+                chat=self.chat, sender=(self.khetu, self.ravi)[n % 2], content=content,
+                timestamp=start + timedelta(days=n * 20), seq=n + 1,
+            )
+            for n, content in enumerate(contents)
+        )
+        # The first two end up in the archive, the rest stay in the table
+        archive_cold_messages()
+        self.contents = contents
+        login_client(self.async_client, self.khetu)
+        self.url = reverse("ChatApp:export_chat", args=[self.chat.id])
+
+    async def export(self, **params):
+        response = await self.async_client.get(self.url, params)
+        chunks = [chunk async for chunk in response.streaming_content]
+        return response, chunks
+
+    async def test_ndjson_streams_archive_then_table_in_order(self):
+        self.assertEqual(await MessageArchiveSegment.objects.acount(), 1)
+
+        response, chunks = await self.export()
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertIn(f'filename="chat-{self.chat.id}.ndjson"', response["Content-Disposition"])
+        rows = [json.loads(line) for line in b"".join(chunks).decode().splitlines()]
+        self.assertEqual([row["content"] for row in rows], self.contents)
+        self.assertEqual([row["seq"] for row in rows], [1, 2, 3, 4, 5])
+        self.assertEqual(rows[1]["sender"], "ravi")
+        # Written as it is read, LINES_PER_WRITE lines at a time
+        self.assertEqual(len(chunks), 3)
+
+    async def test_csv_round_trips_quotes_and_newlines(self):
+        response, chunks = await self.export(format="csv")
+
+        self.assertEqual(response["Content-Type"], "text/csv")
+        rows = list(csv.reader(io.StringIO(b"".join(chunks).decode())))
+        self.assertEqual(rows[0], ["id", "seq", "timestamp", "sender_id", "sender", "content"])
+        self.assertEqual([row[5] for row in rows[1:]], self.contents)
+
+    async def test_rejects_unknown_format_and_non_members(self):
+        response = await self.async_client.get(self.url, {"format": "xml"})
+        self.assertEqual(response.status_code, 400)
+
+        amit = await User.objects.acreate(username="amit", email="amit@gmail.com")
+        login_client(self.async_client, amit)
+        response = await self.async_client.get(self.url)
+        self.assertEqual(response.status_code, 404)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        chat_membership.clear_local()
+        prefix_index.invalidate()
+        reset_presence()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.chat, _ = Chat.get_or_create_private(self.khetu, self.ravi)
+        write_batch([
+            {"chat_id": self.chat.id, "sender_id": self.ravi.id, "content": f"m{n}", "timestamp": timezone.now(), "seq": n + 1}
+            for n in range(3)
+        ])
+        login_client(self.client, self.khetu)
+        self.history_url = reverse("ChatApp:get_chat_messages", args=[self.chat.id])
+        self.search_url = reverse("ChatApp:search_users")
+
+    def revalidate(self, url, response, **params):
+        return self.client.get(url, params, HTTP_IF_NONE_MATCH=response["ETag"])
+
+    def test_unchanged_history_is_a_304_without_the_page_query(self):
+        response = self.client.get(self.history_url, {"limit": 2})
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+
+        with self.assertNumQueries(1):  # JWT user only
+            repeat = self.revalidate(self.history_url, response, limit=2)
+        self.assertEqual(repeat.status_code, 304)
+        # Another page, or another reader, is another entity
+        self.assertEqual(self.revalidate(self.history_url, response, limit=3).status_code, 200)
+        login_client(self.client, self.ravi)
+        self.assertEqual(self.revalidate(self.history_url, response, limit=2).status_code, 200)
+
+    def test_new_message_changes_the_history_etag_after_commit(self):
+        response = self.client.get(self.history_url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            write_batch([{"chat_id": self.chat.id, "sender_id": self.ravi.id, "content": "new", "timestamp": timezone.now(), "seq": 4}])
+
+        fresh = self.revalidate(self.history_url, response)
+        self.assertEqual(fresh.status_code, 200)
+        self.assertEqual(fresh.json()["messages"][-1]["content"], "new")
+
+    def test_search_users_304_until_a_result_changes(self):
+        response = self.client.get(self.search_url, {"q": "ra"})
+        self.assertEqual(self.revalidate(self.search_url, response, q="ra").status_code, 304)
+
+        presence.touch(self.ravi.id)
+        online = self.revalidate(self.search_url, response, q="ra")
+        self.assertEqual(online.status_code, 200)
+        self.assertTrue(online.json()["users"][0]["is_online"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ravi.first_name = "Ravi"
+            self.ravi.save()
+        self.assertEqual(self.revalidate(self.search_url, online, q="ra").status_code, 200)
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        chat_membership.clear_local()
+        prefix_index.invalidate()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.chat, _ = Chat.get_or_create_private(self.khetu, self.ravi)
+        write_batch([
+            {"chat_id": self.chat.id, "sender_id": self.ravi.id, "content": f"m{n}", "timestamp": timezone.now(), "seq": n + 1}
+            for n in range(3)
+        ])
+        login_client(self.async_client, self.khetu)
+
+    @override_settings(DEBUG=True)
+    def test_asgi_middleware_chain_is_never_adapted_to_sync(self):
+        # Django logs every sync-only middleware it has to wrap in DEBUG
+        with self.assertNoLogs("django.request", level="DEBUG"):
+            ASGIHandler()
+        for view in (ChatHomeView, ChatRoomView, ChatMessagesAPIView, SearchUsersAPIView):
+            self.assertTrue(view.view_is_async, view)
+
+    async def test_async_views_render_for_the_jwt_user(self):
+        home = await self.async_client.get(reverse("ChatApp:home"))
+        self.assertEqual(home.status_code, 200)
+        self.assertEqual(home.context["current_user"], self.khetu)
+
+        room = await self.async_client.get(reverse("ChatApp:room", args=[self.chat.id]))
+        self.assertEqual([m.content for m in room.context["messages"]], ["m0", "m1", "m2"])
+        self.assertEqual(room.context["last_seq"], 3)
+
+        history_url = reverse("ChatApp:get_chat_messages", args=[self.chat.id])
+        history = await self.async_client.get(history_url)
+        self.assertEqual(len(history.json()["messages"]), 3)
+        repeat = await self.async_client.get(history_url, headers={"if-none-match": history["ETag"]})
+        self.assertEqual(repeat.status_code, 304)
+
+        users = await self.async_client.get(reverse("ChatApp:search_users"), {"q": "ra"})
+        self.assertEqual([user["username"] for user in users.json()["users"]], ["ravi"])
+
+    async def test_non_members_and_anonymous_users_are_turned_away(self):
+        amit = await User.objects.acreate(username="amit", email="amit@gmail.com")
+        login_client(self.async_client, amit)
+        response = await self.async_client.get(reverse("ChatApp:room", args=[self.chat.id]))
+        self.assertEqual(response.status_code, 404)
+
+        del self.async_client.cookies["access"]
+        response = await self.async_client.get(reverse("ChatApp:get_chat_messages", args=[self.chat.id]))
+        self.assertEqual(response.status_code, 302)
+
+    async def test_expired_access_token_is_refreshed_on_the_async_path(self):
+        access = AccessToken.for_user(self.khetu)
+        access.set_exp(lifetime=-timedelta(seconds=1))
+        refresh = await sync_to_async(RefreshToken.for_user)(self.khetu)
+        self.async_client.cookies["access"] = str(access)
+        self.async_client.cookies["refresh"] = str(refresh)
+
+        response = await self.async_client.get(reverse("ChatApp:home"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["current_user"], self.khetu)
+        self.assertNotEqual(response.cookies["access"].value, str(access))
+
+
+class ConsumerDBTests(SimpleTestCase):
+    async def run_blocking(self, calls):
+        lock = threading.Lock()
+        state = {"running": 0, "peak": 0, "threads": set()}
+
+        def blocking():
+            with lock:
+                state["running"] += 1
+                state["peak"] = max(state["peak"], state["running"])
+                state["threads"].add(threading.current_thread().name)
+            time.sleep(0.02)
+            with lock:
+                state["running"] -= 1
+            return True
+
+        results = await asyncio.gather(*(consumer_db.run(blocking) for _ in range(calls)))
+        self.assertEqual(results, [True] * calls)
+        return state
+
+    @override_settings(CHAT_CONSUMER_DB={"MAX_CONCURRENCY": 3})
+    async def test_calls_run_concurrently_up_to_the_limit(self):
+        state = await self.run_blocking(9)
+
+        self.assertEqual(state["peak"], 3)
+        self.assertTrue(all(name.startswith("consumer-db") for name in state["threads"]))
+
+    @override_settings(CHAT_CONSUMER_DB={"MAX_CONCURRENCY": None})
+    async def test_no_limit_falls_back_to_the_shared_sync_thread(self):
+        state = await self.run_blocking(4)
+
+        self.assertEqual(state["peak"], 1)
+        self.assertEqual(len(state["threads"]), 1)
+
+
+@override_settings(DATABASE_REPLICAS={"ALIASES": ["replica"], "STICKY_SECONDS": 10, "CHECK_INTERVAL": 0})
+class ReadReplicaRoutingTests(TransactionTestCase):
+    # "replica" is a second, empty SQLite database: whatever a read finds
+    # tells which of the two served it
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        cache.clear()
+        chat_membership.clear_local()
+        replica_health.clear()
+        self.khetu = User.objects.create_user(
+            username="khetu", email="khetu.mewada@gmail.com", password="StrongPass123!"
+        )
+        self.ravi = User.objects.create_user(
+            username="ravi", email="ravi@gmail.com", password="StrongPass123!"
+        )
+        self.chat, _ = Chat.get_or_create_private(self.khetu, self.ravi)
+        Message.objects.create(chat=self.chat, sender=self.ravi, content="hello", seq=1)
+        cache.clear()
+
+    def chat_visible(self):
+        return Chat.objects.filter(id=self.chat.id).exists()
+
+    def test_request_reads_go_to_the_replica(self):
+        with request_routing(self.khetu.id):
+            self.assertFalse(self.chat_visible())
+            # Outside the replicated apps, e.g. the user lookup, stays on the primary
+            self.assertTrue(User.objects.filter(id=self.khetu.id).exists())
+        # Consumers, tasks and the shell are not in a request
+        self.assertTrue(self.chat_visible())
+
+    def test_write_pins_the_request_and_then_the_user(self):
+        with request_routing(self.khetu.id):
+            Chat.objects.filter(id=self.chat.id).update(name="renamed")
+            self.assertTrue(self.chat_visible())
+
+        with request_routing(self.khetu.id):
+            self.assertTrue(self.chat_visible())
+        with request_routing(self.ravi.id):
+            self.assertFalse(self.chat_visible())
+
+        cache.delete(pin_key(self.khetu.id))
+        with request_routing(self.khetu.id):
+            self.assertFalse(self.chat_visible())
+
+    def test_new_message_pins_every_member(self):
+        message = Message.objects.create(chat=self.chat, sender=self.khetu, content="you there?", seq=2)
+        record_messages([message])
+
+        for user in (self.khetu, self.ravi):
+            with request_routing(user.id):
+                self.assertTrue(self.chat_visible())
+
+    def test_unreachable_replica_is_ejected(self):
+        with patch("WebChat.db_router.replica_lag", side_effect=OperationalError("connection refused")) as lag:
+            with self.assertLogs("WebChat.db_router", "WARNING"):
+                with request_routing(self.khetu.id):
+                    self.assertTrue(self.chat_visible())
+            with request_routing(self.khetu.id):
+                self.assertTrue(self.chat_visible())
+        # Not probed again until EJECT_SECONDS have passed
+        self.assertEqual(lag.call_count, 1)
+
+    def test_lagging_replica_is_ejected(self):
+        with patch("WebChat.db_router.replica_lag", return_value=30.0):
+            with self.assertLogs("WebChat.db_router", "WARNING") as logs:
+                with request_routing(self.khetu.id):
+                    self.assertTrue(self.chat_visible())
+        self.assertIn("30.0s behind", logs.output[0])
+
+    def test_history_api_reads_the_replica_until_the_user_writes(self):
+        login_client(self.client, self.khetu)
+        url = reverse("ChatApp:get_chat_messages", args=[self.chat.id])
+
+        # Membership comes from the primary; the page itself from the empty replica
+        self.assertEqual(self.client.get(url).json()["messages"], [])
+
+        cache.set(pin_key(self.khetu.id), 1)
+        self.assertEqual([m["content"] for m in self.client.get(url).json()["messages"]], ["hello"])
+
+    async def test_async_request_write_pins_the_user(self):
+        meera = await User.objects.acreate_user(
+            username="meera", email="meera@gmail.com", password="StrongPass123!"
+        )
+        login_client(self.async_client, self.khetu)
+
+        # A GET, but it creates the chat
+        response = await self.async_client.get(reverse("ChatApp:start_chat", args=[meera.id]))
+
+        self.assertEqual(response.status_code, 302)
+        self.assertIsNotNone(await cache.aget(pin_key(self.khetu.id)))
+        self.assertIsNone(await cache.aget(pin_key(self.ravi.id)))
+
+
+def pool_stats(**stats):
+    # What psycopg_pool's pop_stats() returns; counters left out are zero
+    return {"pool_min": 1, "pool_max": 9, "pool_size": 4, "pool_available": 1, "requests_waiting": 0, **stats}
+
+
+class PoolMetricsTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        pool_metrics.totals.clear()
+        pool_metrics.connected.clear()
+        pool_metrics.published_at = float("-inf")
+        pool_metrics.connected_to("default")
+
+    def publish(self, *batches):
+        batches = list(batches)
+        pool = SimpleNamespace(pop_stats=lambda: batches.pop(0))
+        with patch("WebChat.db_pool.pool_for", lambda alias: pool if alias == "default" else None):
+            while batches:
+                pool_metrics.publish()
+
+    def test_counters_accumulate_across_snapshots(self):
+        self.publish(
+            pool_stats(requests_num=10, requests_queued=2, requests_wait_ms=40),
+            pool_stats(requests_num=30, requests_queued=2, requests_wait_ms=40, requests_waiting=3),
+        )
+
+        [snapshot] = collect().values()
+        stats = snapshot["pools"]["default"]
+        self.assertEqual(stats["requests_num"], 40)
+        self.assertEqual(stats["requests_waiting"], 3)
+        self.assertEqual(stats["wait_ms_avg"], 20.0)
+        self.assertEqual(stats["checkout_ms_avg"], 2.0)
+        self.assertAlmostEqual(stats["saturation"], 3 / 9)
+
+    def test_totals_add_up_processes(self):
+        self.publish(pool_stats(requests_num=10, requests_wait_ms=10))
+        snapshot = next(iter(collect().values()))
+
+        totals = summarize({"web-1": snapshot, "web-2": snapshot})
+
+        self.assertEqual(totals["default"]["pool_max"], 18)
+        self.assertEqual(totals["default"]["requests_num"], 20)
+        self.assertEqual(totals["default"]["checkout_ms_avg"], 1.0)
+
+    @override_settings(DB_POOL_METRICS={"INTERVAL": 60})
+    def test_publishing_is_throttled(self):
+        pool = SimpleNamespace(pop_stats=lambda: pool_stats(requests_num=1))
+        with patch("WebChat.db_pool.pool_for", lambda alias: pool if alias == "default" else None):
+            pool_metrics.maybe_publish()
+            pool_metrics.maybe_publish()
+
+        [snapshot] = collect().values()
+        self.assertEqual(snapshot["pools"]["default"]["requests_num"], 1)
+
+    def test_only_connected_aliases_are_read(self):
+        opened = []
+
+        def pool_for(alias):
+            # Accessing connections[alias].pool opens the pool
+            opened.append(alias)
+            return SimpleNamespace(pop_stats=lambda: pool_stats(requests_num=1))
+
+        with patch("WebChat.db_pool.pool_for", pool_for):
+            pool_metrics.publish()
+
+        self.assertEqual(opened, ["default"])
+
+    def test_nothing_published_without_a_pool(self):
+        # SQLite here: no pools, so checkouts cost no cache writes
+        pool_metrics.publish()
+
+        self.assertEqual(collect(), {})
+
+    def test_command_reports_totals(self):
+        self.publish(pool_stats(requests_num=10, requests_errors=1))
+        out = io.StringIO()
+
+        call_command("db_pool_stats", stdout=out)
+
+        self.assertIn("total default (1 processes): 3/9 in use", out.getvalue())
+        self.assertIn("1 timeouts", out.getvalue())
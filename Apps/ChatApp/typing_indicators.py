@@ -0,0 +1,122 @@
+import asyncio
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger("Apps.ChatApp.typing_indicators")
+
+DEFAULT_TYPING_CONFIG = {
+    "TTL": 5,  # seconds without a typing frame before "is typing" expires
+    "INTERVAL": 1,  # min seconds between two broadcasts for the same chat
+}
+
+
+class TypingState:
+    __slots__ = ("sent", "wanted", "last_sent_at", "expire_handle", "flush_handle")
+
+    def __init__(self):
+        self.sent = False
+        self.wanted = False
+        self.last_sent_at = float("-inf")
+        self.expire_handle = None
+        self.flush_handle = None
+
+    def cancel(self):
+        for handle in (self.expire_handle, self.flush_handle):
+            if handle:
+                handle.cancel()
+        self.expire_handle = None
+        self.flush_handle = None
+
+
+class TypingTracker:
+    """
+    Coalesces one user's typing frames per chat.
+
+    Clients send a typing frame on every keystroke; only state transitions
+    are handed to `publish(chat_id, is_typing)`, at most one per INTERVAL,
+    and "is typing" flips back to False by itself after TTL seconds of
+    silence.
+    """
+
+    def __init__(self, publish, ttl=None, interval=None):
+        config = {**DEFAULT_TYPING_CONFIG, **getattr(settings, "CHAT_TYPING", {})}
+        self.publish = publish
+        self.ttl = ttl if ttl is not None else config["TTL"]
+        self.interval = interval if interval is not None else config["INTERVAL"]
+        self.states = {}
+        self._tasks = set()
+
+    async def update(self, chat_id, is_typing):
+        loop = asyncio.get_running_loop()
+        state = self.states.setdefault(chat_id, TypingState())
+
+        if state.expire_handle:
+            state.expire_handle.cancel()
+            state.expire_handle = None
+        if is_typing:
+            state.expire_handle = loop.call_later(self.ttl, self._expire, chat_id)
+
+        state.wanted = is_typing
+        await self._maybe_publish(chat_id, state)
+
+    async def clear(self, chat_id):
+        # Called on unsubscribe/disconnect so nobody is left "typing"
+        state = self.states.pop(chat_id, None)
+        if not state:
+            return
+        state.cancel()
+        if state.sent:
+            await self._publish(chat_id, False)
+
+    async def _maybe_publish(self, chat_id, state):
+        if self.states.get(chat_id) is not state:
+            return
+
+        if state.wanted == state.sent:
+            # Flapped back before the pending broadcast went out
+            if state.flush_handle:
+                state.flush_handle.cancel()
+                state.flush_handle = None
+            return
+
+        if state.flush_handle:
+            # A broadcast is already scheduled and will carry the latest state
+            return
+
+        loop = asyncio.get_running_loop()
+        wait = state.last_sent_at + self.interval - loop.time()
+        if wait > 0:
+            state.flush_handle = loop.call_later(wait, self._deferred_flush, chat_id)
+            return
+
+        state.sent = state.wanted
+        state.last_sent_at = loop.time()
+        await self._publish(chat_id, state.sent)
+
+    async def _publish(self, chat_id, is_typing):
+        try:
+            await self.publish(chat_id, is_typing)
+        except Exception:
+            logger.warning(f"[FAIL] typing broadcast -> chat_id={chat_id}", exc_info=True)
+
+    def _spawn(self, chat_id):
+        state = self.states.get(chat_id)
+        if not state:
+            return
+        task = asyncio.get_running_loop().create_task(self._maybe_publish(chat_id, state))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _deferred_flush(self, chat_id):
+        state = self.states.get(chat_id)
+        if state:
+            state.flush_handle = None
+            self._spawn(chat_id)
+
+    def _expire(self, chat_id):
+        state = self.states.get(chat_id)
+        if state:
+            state.expire_handle = None
+            state.wanted = False
+            self._spawn(chat_id)
@@ -4,6 +4,9 @@ from .views import (
     ChatRoomView,
     StartChatView,
     ChatMessagesAPIView,
+    ChatExportView,
+    ConversationsAPIView,
+    SearchMessagesAPIView,
     SearchUsersAPIView
 )
 
@@ -14,5 +17,8 @@ urlpatterns = [
     path('chat/<int:chat_id>/', ChatRoomView.as_view(), name='room'),
     path('start-chat/<int:user_id>/', StartChatView.as_view(), name='start_chat'),
     path('api/chat/<int:chat_id>/messages/', ChatMessagesAPIView.as_view(), name='get_chat_messages'),
+    path('api/chat/<int:chat_id>/export/', ChatExportView.as_view(), name='export_chat'),
+    path('api/conversations/', ConversationsAPIView.as_view(), name='conversations'),
+    path('api/search-messages/', SearchMessagesAPIView.as_view(), name='search_messages'),
     path('api/search-users/', SearchUsersAPIView.as_view(), name='search_users'),
 ]
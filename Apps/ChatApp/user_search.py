@@ -0,0 +1,178 @@
+import bisect
+import hashlib
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.functions import Greatest, Length
+
+DEFAULT_USER_SEARCH_CONFIG = {
+    "BACKEND": "auto",  # "trigram" (Postgres pg_trgm), "prefix" (in-memory) or "auto"
+    "CACHE_ALIAS": "default",
+    "CACHE_TIMEOUT": 30,  # seconds a query's result ids are reused
+    "PREFIX_INDEX_TTL": 60,  # seconds before another process's renames are picked up
+    "MIN_LENGTH": 1,
+    "LIMIT": 10,
+}
+
+SEARCH_FIELDS = ("username", "first_name", "last_name")
+
+
+def get_user_search_config():
+    return {**DEFAULT_USER_SEARCH_CONFIG, **getattr(settings, "CHAT_USER_SEARCH", {})}
+
+
+SEARCH_VERSION_KEY = "usersearch:version"
+
+
+def get_search_cache():
+    return caches[get_user_search_config()["CACHE_ALIAS"]]
+
+
+def search_version():
+    """Changes whenever a user appears, disappears or looks different in results."""
+    cache = get_search_cache()
+    version = cache.get(SEARCH_VERSION_KEY)
+    if version is None:
+        cache.add(SEARCH_VERSION_KEY, uuid.uuid4().hex[:12], timeout=None)
+        version = cache.get(SEARCH_VERSION_KEY)
+    return version
+
+
+def bump_search_version():
+    transaction.on_commit(
+        lambda: get_search_cache().set(SEARCH_VERSION_KEY, uuid.uuid4().hex[:12], timeout=None)
+    )
+
+
+def normalize(query):
+    return " ".join(query.lower().split())
+
+
+def prefix_rank(query):
+    # Prefix matches on any name field come first
+    return Case(
+        *[When(**{f"{field}__istartswith": query}, then=Value(0)) for field in SEARCH_FIELDS],
+        default=Value(1),
+        output_field=IntegerField(),
+    )
+
+
+def trigram_search(query, limit):
+    """
+    Substring search served by the pg_trgm GIN indexes on UPPER(field).
+
+    icontains compiles to UPPER(field) LIKE UPPER('%q%'), which those
+    indexes answer without a sequential scan.
+    """
+    from django.contrib.postgres.search import TrigramSimilarity
+
+    matches = Q()
+    for field in SEARCH_FIELDS:
+        matches |= Q(**{f"{field}__icontains": query})
+    return list(
+        get_user_model().objects.filter(matches, is_active=True)
+        .annotate(
+            rank=prefix_rank(query),
+            similarity=Greatest(*[TrigramSimilarity(field, query) for field in SEARCH_FIELDS]),
+        )
+        .order_by("rank", "-similarity", Length("username"), "username")
+        .values_list("id", flat=True)[:limit]
+    )
+
+
+class PrefixIndex:
+    """
+    Sorted (token, user_id) pairs for every name token of every active user.
+
+    Prefix lookups are two bisects. Used where pg_trgm is not available
+    (SQLite test and dev runs); only matches from the start of a name or
+    word, not anywhere inside it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = None
+        self.usernames = {}
+        self.built_at = 0.0
+
+    def invalidate(self):
+        with self.lock:
+            self.entries = None
+
+    def build(self):
+        entries, usernames = [], {}
+        rows = get_user_model().objects.filter(is_active=True).values_list("id", *SEARCH_FIELDS)
+        for user_id, username, first_name, last_name in rows.iterator():
+            usernames[user_id] = username
+            tokens = {username.lower()}
+            tokens.update(" ".join(filter(None, (first_name, last_name))).lower().split())
+            full_name = f"{first_name} {last_name}".strip().lower()
+            if full_name:
+                tokens.add(full_name)
+            entries.extend((token, user_id) for token in tokens)
+        entries.sort()
+        return entries, usernames
+
+    def get_entries(self):
+        ttl = get_user_search_config()["PREFIX_INDEX_TTL"]
+        with self.lock:
+            if self.entries is None or time.monotonic() - self.built_at > ttl:
+                self.entries, self.usernames = self.build()
+                self.built_at = time.monotonic()
+            return self.entries, self.usernames
+
+    def search(self, query, limit):
+        entries, usernames = self.get_entries()
+        start = bisect.bisect_left(entries, (query,))
+        end = bisect.bisect_left(entries, (query + "\uffff",))
+
+        ranked = {}
+        for token, user_id in entries[start:end]:
+            # Whole-username prefix beats a name prefix
+            rank = 0 if usernames[user_id].lower().startswith(query) else 1
+            ranked[user_id] = min(rank, ranked.get(user_id, rank))
+        ordered = sorted(ranked, key=lambda user_id: (ranked[user_id], len(usernames[user_id]), usernames[user_id]))
+        return ordered[:limit]
+
+
+prefix_index = PrefixIndex()
+
+
+def get_backend():
+    backend = get_user_search_config()["BACKEND"]
+    if backend == "auto":
+        return "trigram" if connection.vendor == "postgresql" else "prefix"
+    return backend
+
+
+def search_user_ids(query, limit=None):
+    """
+    Ranked ids of users matching query, cached per normalized query.
+
+    Consecutive keystrokes share prefixes, so hot prefixes are answered
+    from the cache for CACHE_TIMEOUT seconds; new and renamed users show
+    up once that lapses.
+    """
+    config = get_user_search_config()
+    query = normalize(query)
+    limit = limit or config["LIMIT"]
+    if len(query) < config["MIN_LENGTH"]:
+        return []
+
+    digest = hashlib.sha1(query.encode()).hexdigest()
+    cache_key = f"usersearch:{get_backend()}:{limit}:{digest}"
+    cache = get_search_cache()
+    user_ids = cache.get(cache_key)
+    if user_ids is None:
+        if get_backend() == "trigram":
+            user_ids = trigram_search(query, limit)
+        else:
+            user_ids = prefix_index.search(query, limit)
+        cache.set(cache_key, user_ids, timeout=config["CACHE_TIMEOUT"])
+    return user_ids
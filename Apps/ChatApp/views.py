@@ -1,63 +1,174 @@
+import hashlib
 from datetime import date
+from functools import wraps
+from asgiref.sync import sync_to_async
 from django.views import View
 from django.views.generic import TemplateView
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import redirect, aget_object_or_404, get_object_or_404
+from django.template.response import TemplateResponse
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import JsonResponse
-from django.db.models import Q, Max
-from django.db import transaction
+from django.http import JsonResponse, StreamingHttpResponse
+from django.db.models import Max
 from django.contrib import messages
-from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.contrib.auth import get_user_model
-from .models import Chat, Message, MessageRead
-from Apps.Account.models import UserProfile
+from .archive import history_page, last_archived_seq
+from .export import EXPORT_FORMATS, stream_export
+from .history import history_version
+from .membership import acheck_chat_member, chat_membership, check_chat_member
+from .message_search import InvalidQuery, search_messages
+from .models import Chat, ChatMember, Message
+from .pagination import ROOM_TAIL_SIZE, InvalidCursor, parse_limit, serialize_message
+from .presence import presence
+from .read_state import mark_read
+from .sidebar_cache import cached_sidebar
+from .summaries import conversation_page
+from .user_search import search_user_ids, search_version
 
 User = get_user_model()
 
-class ChatHomeView(LoginRequiredMixin, TemplateView):
-    template_name = 'ChatApp/home.html'
 
-    def get(self, request, *args, **kwargs):
-        profile, _ = UserProfile.objects.get_or_create(user=request.user)
-        profile.is_online = True
-        profile.last_seen = timezone.now()
-        profile.save()
+def etag(*parts):
+    return hashlib.md5(":".join(str(part) for part in parts).encode()).hexdigest()
+
+
+def history_etag(request, chat_id):
+    # Same page of the same history version for the same reader (is_own
+    # differs per reader); non-members fall through to the view's 404
+    if not chat_membership.is_member(chat_id, request.user.id):
+        return None
+    return etag(chat_id, history_version(chat_id), request.user.id, request.GET.urlencode())
+
+
+def search_users_etag(request):
+    # Cached result ids, presence and the search version: no database query
+    query = request.GET.get('q', '')
+    if not query:
+        return None
+    user_ids = search_user_ids(query, limit=11)
+    online_ids = sorted(presence.online_ids(user_ids))
+    return etag(search_version(), request.user.id, query, user_ids, online_ids)
+
+
+# Browsers keep the response but revalidate it every time, so repeated
+# polls and re-opened rooms come back as 304s
+revalidate = cache_control(private=True, no_cache=True)
+
+
+def async_condition(etag_func):
+    """condition(etag_func=...) for async views; the ETag is worked out off the event loop."""
+    def decorator(view):
+        @wraps(view)
+        async def inner(request, *args, **kwargs):
+            tag = await sync_to_async(etag_func)(request, *args, **kwargs)
+            return await condition(etag_func=lambda *args, **kwargs: tag)(view)(request, *args, **kwargs)
+        return inner
+    return decorator
+
+
+class AsyncLoginRequiredMixin(LoginRequiredMixin):
+    """LoginRequiredMixin for async views: the user is loaded with request.auser()."""
+
+    async def dispatch(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        if not request.user.is_authenticated:
+            return self.handle_no_permission()
+        return await super(LoginRequiredMixin, self).dispatch(request, *args, **kwargs)
+
+
+def sidebar_context(user, before=None):
+    # One page of conversation summaries plus presence for the people on it
+    page = conversation_page(user, before=before)
+    user_ids = {member.other_user_id for member in page['conversations'] if member.other_user_id}
+    return {
+        'conversations': page['conversations'],
+        'sidebar_next': page['next_cursor'],
+        'sidebar_user_ids': user_ids,
+        'online_user_ids': presence.online_ids(user_ids),
+    }
+
+
+def render_sidebar(user):
+    context = sidebar_context(user)
+    return {
+        'html': render_to_string('ChatApp/conversation_items.html', {**context, 'current_user': user}),
+        'next': context['sidebar_next'],
+        'user_ids': context['sidebar_user_ids'],
+        'online': context['online_user_ids'],
+    }
+
+
+def sidebar(user):
+    # Room switches re-render the same sidebar; serve it from the versioned cache
+    entry = cached_sidebar(user.id, lambda: render_sidebar(user), presence.online_ids)
+    return {'sidebar_html': mark_safe(entry['html']), 'sidebar_next': entry['next']}
+
+
+# The home, room, history and user search views are async: under daphne
+# they hold a thread only for the database and cache calls they await,
+# not for the whole request. Templates render in the handler's thread
+# (TemplateResponse), so lazy lookups in them stay safe.
+
+class ChatHomeView(AsyncLoginRequiredMixin, TemplateView):
+    template_name = 'ChatApp/home.html'
 
-        chats = Chat.objects.filter(participants=request.user).annotate(
-            last_message_time=Max('messages__timestamp')
-        ).order_by('-last_message_time')
+    async def get(self, request, *args, **kwargs):
+        # Page views count as presence for one TTL, no UserProfile write
+        await presence.atouch(request.user.id)
 
-        return render(request, self.template_name, {
-            'chats': chats,
+        return TemplateResponse(request, self.template_name, {
+            **await sync_to_async(sidebar)(request.user),
             'current_user': request.user,
             'today': date.today(),
             'is_home_page': True
         })
 
-class ChatRoomView(LoginRequiredMixin, TemplateView):
+class ChatRoomView(AsyncLoginRequiredMixin, TemplateView):
     template_name = 'ChatApp/room.html'
 
-    def get(self, request, chat_id):
-        chat = get_object_or_404(Chat, id=chat_id, participants=request.user)
+    async def get(self, request, chat_id):
+        await acheck_chat_member(chat_id, request.user)
+        chat = await aget_object_or_404(Chat, id=chat_id)
 
         messages_qs = chat.messages.all().order_by('timestamp')
 
-        unread = messages_qs.exclude(sender=request.user).exclude(
-            read_by__user=request.user
+        # Only the newest page is rendered; room.js pages older history in.
+        # chat_id stays loaded: the related manager checks it on every row
+        tail = await sync_to_async(history_page)(
+            chat_id,
+            messages_qs.select_related('sender').only(
+                'id', 'chat_id', 'seq', 'content', 'timestamp', 'sender_id', 'sender__username'
+            ),
+            limit=ROOM_TAIL_SIZE,
         )
-        for msg in unread:
-            MessageRead.objects.get_or_create(message=msg, user=request.user)
+        if tail['messages']:
+            # Opening the room reads up to the newest message
+            await sync_to_async(mark_read)(chat_id, request.user.id, tail['messages'][-1].id)
+
+        member = await ChatMember.objects.filter(
+            chat_id=chat_id, user=request.user
+        ).select_related('other_user__profile').afirst()
+        other_user = member.other_user if member else None
 
-        chats = Chat.objects.filter(participants=request.user).annotate(
-            last_message_time=Max('messages__timestamp')
-        ).order_by('-last_message_time')
+        last_seq = (await messages_qs.aaggregate(last_seq=Max('seq')))['last_seq']
+        if not last_seq:
+            last_seq = await sync_to_async(last_archived_seq)(chat_id)
 
-        return render(request, self.template_name, {
+        return TemplateResponse(request, self.template_name, {
             'chat': chat,
-            'messages': messages_qs,
+            'messages': tail['messages'],
+            'has_older': tail['has_older'],
+            'before_cursor': tail['before'],
+            # room.js resumes the socket from here
+            'last_seq': last_seq,
             'current_user': request.user,
-            'chats': chats,
-            'active_chat_id': chat_id,
+            'other_user': other_user,
+            'online_user_ids': await presence.aonline_ids([other_user.id] if other_user else []),
+            **await sync_to_async(sidebar)(request.user),
             'today': date.today(),
             'is_home_page': False
         })
@@ -71,21 +182,9 @@ class StartChatView(LoginRequiredMixin, View):
             messages.error(request, "You cannot chat with yourself.")
             return redirect('ChatApp:home')
 
-        with transaction.atomic():
-            chat = Chat.objects.filter(
-                chat_type='private',
-                participants=request.user
-            ).filter(
-                participants=other_user
-            ).annotate(
-                pcount=Max('participants')
-            ).first()
-
-            if chat:
-                return redirect('ChatApp:room', chat_id=chat.id)
-
-            chat = Chat.objects.create(chat_type='private')
-            chat.participants.add(request.user, other_user)
+        chat, created = Chat.get_or_create_private(request.user, other_user)
+        if not created:
+            return redirect('ChatApp:room', chat_id=chat.id)
 
         messages.success(
             request,
@@ -94,35 +193,112 @@ class StartChatView(LoginRequiredMixin, View):
         return redirect('ChatApp:room', chat_id=chat.id)
 
 
-class ChatMessagesAPIView(LoginRequiredMixin, View):
+class ChatMessagesAPIView(AsyncLoginRequiredMixin, View):
+
+    @method_decorator([revalidate, async_condition(history_etag)])
+    async def get(self, request, chat_id):
+        await acheck_chat_member(chat_id, request.user)
+
+        # Keyset pagination: ?before=<cursor> for older, ?after=<cursor> for
+        # newer; reads past the oldest stored message continue in the archive
+        try:
+            page = await sync_to_async(history_page)(
+                chat_id,
+                Message.objects.filter(chat_id=chat_id).select_related('sender').only(
+                    'id', 'seq', 'content', 'timestamp', 'sender_id', 'sender__username'
+                ),
+                before=request.GET.get('before'),
+                after=request.GET.get('after'),
+                limit=parse_limit(request.GET.get('limit')),
+            )
+        except InvalidCursor:
+            return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+        return JsonResponse({
+            'messages': [serialize_message(msg, request.user) for msg in page['messages']],
+            'has_older': page['has_older'],
+            'has_newer': page['has_newer'],
+            'before': page['before'],
+            'after': page['after'],
+        })
+
+class ChatExportView(LoginRequiredMixin, View):
 
     def get(self, request, chat_id):
-        chat = get_object_or_404(Chat, id=chat_id, participants=request.user)
-        data = []
-
-        for msg in chat.messages.all().order_by('timestamp'):
-            data.append({
-                'id': msg.id,
-                'sender': msg.sender.username,
-                'content': msg.content,
-                'timestamp': msg.timestamp.strftime('%I:%M %p'),
-                'is_own': msg.sender == request.user
-            })
+        check_chat_member(chat_id, request.user)
+
+        # ?format=ndjson (default) or csv; the whole history, streamed
+        export_format = request.GET.get('format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            return JsonResponse({'error': 'Invalid format'}, status=400)
 
-        return JsonResponse({'messages': data})
+        response = StreamingHttpResponse(
+            stream_export(chat_id, export_format), content_type=EXPORT_FORMATS[export_format]
+        )
+        response['Content-Disposition'] = f'attachment; filename="chat-{chat_id}.{export_format}"'
+        return response
+
+class ConversationsAPIView(LoginRequiredMixin, View):
+
+    def get(self, request):
+        # Next sidebar page, rendered with the same partial as the first
+        try:
+            context = sidebar_context(request.user, before=request.GET.get('before'))
+        except InvalidCursor:
+            return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+        html = render_to_string('ChatApp/conversation_items.html', {**context, 'current_user': request.user})
+        return JsonResponse({'html': html, 'next': context['sidebar_next']})
 
-class SearchUsersAPIView(LoginRequiredMixin, View):
+class SearchMessagesAPIView(LoginRequiredMixin, View):
 
     def get(self, request):
+        # ?q= terms, optional ?chat=<id> to stay in one room, ?before=<cursor>
+        chat_id = request.GET.get('chat')
+        if chat_id is not None:
+            if not chat_id.isdigit():
+                return JsonResponse({'error': 'Invalid chat'}, status=400)
+            chat_id = int(chat_id)
+
+        try:
+            page = search_messages(
+                request.user,
+                request.GET.get('q', ''),
+                chat_id=chat_id,
+                before=request.GET.get('before'),
+                limit=parse_limit(request.GET.get('limit'), default=20),
+            )
+        except InvalidQuery:
+            return JsonResponse({'results': [], 'next': None})
+        except InvalidCursor:
+            return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+        return JsonResponse({
+            'results': [
+                {**serialize_message(message, request.user), 'chat_id': message.chat_id, 'snippet': snippet}
+                for message, snippet in page['results']
+            ],
+            'next': page['next'],
+        })
+
+class SearchUsersAPIView(AsyncLoginRequiredMixin, View):
+
+    @method_decorator([revalidate, async_condition(search_users_etag)])
+    async def get(self, request):
         query = request.GET.get('q', '')
         if not query:
             return JsonResponse({'users': []})
 
-        users = User.objects.filter(
-            Q(username__icontains=query) |
-            Q(first_name__icontains=query) |
-            Q(last_name__icontains=query)
-        ).exclude(id=request.user.id)[:10].select_related('profile')[:10]
+        # Ranked ids from the search index (cached per prefix), one extra in
+        # case the requester is among them
+        user_ids = [
+            user_id for user_id in await sync_to_async(search_user_ids)(query, limit=11)
+            if user_id != request.user.id
+        ][:10]
+        found = await User.objects.select_related('profile').ain_bulk(user_ids)
+        users = [found[user_id] for user_id in user_ids if user_id in found]
+
+        online_ids = await presence.aonline_ids([user.id for user in users])
 
         results = []
         for user in users:
@@ -133,7 +309,7 @@ class SearchUsersAPIView(LoginRequiredMixin, View):
                 'full_name': user.get_full_name() or user.username,
                 'initials': profile.get_avatar_initials() if profile else user.username[:2].upper(),
                 'profile_image': profile.profile_image.url if profile and profile.profile_image else None,
-                'is_online': profile.is_online if profile else False
+                'is_online': user.id in online_ids
             })
 
         return JsonResponse({'users': results})
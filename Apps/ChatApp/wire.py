@@ -0,0 +1,46 @@
+import json
+
+try:
+    import msgpack
+except ImportError:  # optional: without it every socket speaks JSON
+    msgpack = None
+
+# Offered by clients in Sec-WebSocket-Protocol, most compact first
+MSGPACK_PROTOCOL = "webchat.msgpack"
+JSON_PROTOCOL = "webchat.json"
+
+
+def supported_protocols():
+    if msgpack is not None:
+        return [MSGPACK_PROTOCOL, JSON_PROTOCOL]
+    return [JSON_PROTOCOL]
+
+
+def choose_protocol(offered):
+    """Pick the subprotocol to accept; None keeps the legacy plain-JSON socket."""
+    for protocol in supported_protocols():
+        if protocol in (offered or []):
+            return protocol
+    return None
+
+
+def encode_frame(frame):
+    # Outbound frames are serialized once by the producer, never per
+    # recipient: one copy per wire format travels in the channel event.
+    return {
+        "text": json.dumps(frame),
+        "bytes": msgpack.packb(frame, use_bin_type=True) if msgpack is not None else None,
+    }
+
+
+def decode_frame(text_data=None, bytes_data=None):
+    if bytes_data is not None:
+        if msgpack is None:
+            raise ValueError("Binary frames need msgpack")
+        return msgpack.unpackb(bytes_data, raw=False)
+    return json.loads(text_data)
+
+
+def to_epoch_ms(value):
+    # Clients format the time themselves, in their own locale and timezone
+    return int(value.timestamp() * 1000)
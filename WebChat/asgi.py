@@ -17,6 +17,10 @@ django_asgi_app = get_asgi_application()
 from channels.routing import ProtocolTypeRouter, URLRouter
 from Apps.ChatApp.routing import websocket_urlpatterns
 from Apps.ChatApp.JWTAuth import JWTAuthMiddleware
+from Apps.ChatApp.message_buffer import drain_on_shutdown
+
+# Write-behind messages still queued are written before daphne exits
+drain_on_shutdown()
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
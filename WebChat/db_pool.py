@@ -0,0 +1,157 @@
+import os
+import socket
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+DEFAULT_POOL_METRICS_CONFIG = {
+    "CACHE_ALIAS": "default",
+    "INTERVAL": 15,  # seconds between snapshots a process publishes
+}
+
+# psycopg_pool statistics: counters are reset by pop_stats() and summed
+# here, gauges describe the pool as it is right now
+COUNTERS = (
+    "requests_num", "requests_queued", "requests_wait_ms", "requests_errors", "usage_ms",
+    "returns_bad", "connections_num", "connections_ms", "connections_errors", "connections_lost",
+)
+GAUGES = ("pool_min", "pool_max", "pool_size", "pool_available", "requests_waiting")
+
+PROCESSES_KEY = "dbpool:processes"
+
+
+def get_pool_metrics_config():
+    return {**DEFAULT_POOL_METRICS_CONFIG, **getattr(settings, "DB_POOL_METRICS", {})}
+
+
+def get_cache():
+    return caches[get_pool_metrics_config()["CACHE_ALIAS"]]
+
+
+def process_name():
+    # Looked up every time: Celery prefork children share the parent's module state
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def snapshot_key(process):
+    return f"dbpool:{process}"
+
+
+def pool_for(alias):
+    connection = connections[alias]
+    if connection.vendor != "postgresql":
+        return None
+    # Django 5.1+: the psycopg pool, None when pooling is off
+    return getattr(connection, "pool", None)
+
+
+def derive(stats):
+    """
+    Add the figures worth alerting on to a stats dict.
+
+    wait_ms_avg: mean wait of checkouts that found no idle connection.
+    checkout_ms_avg: mean wait over all checkouts.
+    saturation: share of pool_max checked out right now; 1.0 with
+    requests_waiting > 0 means the pool is the bottleneck.
+    """
+    requests, queued = stats["requests_num"], stats["requests_queued"]
+    in_use = stats["pool_size"] - stats["pool_available"]
+    return {
+        **stats,
+        "wait_ms_avg": stats["requests_wait_ms"] / queued if queued else 0.0,
+        "checkout_ms_avg": stats["requests_wait_ms"] / requests if requests else 0.0,
+        "saturation": in_use / stats["pool_max"] if stats["pool_max"] else 0.0,
+    }
+
+
+class PoolMetrics:
+    """
+    Connection pool statistics of this process, published to the shared cache.
+
+    Pools are per process, so each process writes its own snapshot at most
+    every INTERVAL seconds, on a connection checkout (connection_created,
+    see Apps/ChatApp/signals.py). collect() reads back every process seen
+    recently. Counters are cumulative since the process started. Only
+    aliases this process has connected to are read: the first access to
+    a connection's pool opens it, replicas no request used included.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}  # alias -> Counter of COUNTERS
+        self.connected = set()  # aliases with a connection checked out so far
+        self.published_at = float("-inf")
+
+    def connected_to(self, alias):
+        with self.lock:
+            self.connected.add(alias)
+
+    def snapshot(self):
+        pools = {}
+        with self.lock:
+            aliases = sorted(self.connected)
+        for alias in aliases:
+            pool = pool_for(alias)
+            if pool is None:
+                continue
+            stats = pool.pop_stats()
+            with self.lock:
+                totals = self.totals.setdefault(alias, Counter())
+                totals.update({name: stats.get(name, 0) for name in COUNTERS})
+                pools[alias] = derive({
+                    **{name: stats.get(name, 0) for name in GAUGES},
+                    **{name: totals[name] for name in COUNTERS},
+                })
+        return pools
+
+    def maybe_publish(self):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.published_at < get_pool_metrics_config()["INTERVAL"]:
+                return
+            self.published_at = now
+        self.publish()
+
+    def publish(self):
+        pools = self.snapshot()
+        if not pools:
+            return
+        cache = get_cache()
+        ttl = get_pool_metrics_config()["INTERVAL"] * 4
+        process, now = process_name(), time.time()
+        cache.set(snapshot_key(process), {"at": now, "pools": pools}, timeout=ttl)
+        # Read-modify-write: a lost race drops a process until its next snapshot
+        processes = {
+            name: seen for name, seen in (cache.get(PROCESSES_KEY) or {}).items() if now - seen < ttl
+        }
+        processes[process] = now
+        cache.set(PROCESSES_KEY, processes, timeout=None)
+
+
+pool_metrics = PoolMetrics()
+
+
+def collect():
+    """{process: {"at", "pools": {alias: stats}}} for every process still publishing."""
+    cache = get_cache()
+    processes = cache.get(PROCESSES_KEY) or {}
+    snapshots = cache.get_many([snapshot_key(process) for process in processes])
+    return {
+        process: snapshots[snapshot_key(process)]
+        for process in sorted(processes)
+        if snapshot_key(process) in snapshots
+    }
+
+
+def summarize(snapshots):
+    """Per-alias stats added up over processes, derived figures recomputed."""
+    summed = {}
+    for snapshot in snapshots.values():
+        for alias, stats in snapshot["pools"].items():
+            totals = summed.setdefault(alias, Counter())
+            totals.update({name: stats[name] for name in (*GAUGES, *COUNTERS)})
+    return {alias: derive(dict(totals)) for alias, totals in summed.items()}
@@ -0,0 +1,205 @@
+import logging
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+
+logger = logging.getLogger("WebChat.db_router")
+
+DEFAULT_REPLICA_CONFIG = {
+    "ALIASES": [],  # DATABASES entries replicating default; empty routes everything to default
+    "APPS": ["ChatApp"],  # app labels whose reads may be served by a replica
+    "STICKY_SECONDS": 10,  # a user reads the primary this long after a write that concerns them
+    "CACHE_ALIAS": "default",  # where pins live, shared by every worker
+    "MAX_LAG": 5,  # seconds of replay lag before a replica is ejected
+    "CHECK_INTERVAL": 5,  # seconds between health checks of a replica, per process
+    "EJECT_SECONDS": 30,  # how long an ejected replica is left alone
+}
+
+# pg_last_xact_replay_timestamp() grows on an idle primary too, so a
+# replica that has replayed everything it received counts as current
+LAG_SQL = (
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+    "THEN 0 ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+def get_replica_config():
+    return {**DEFAULT_REPLICA_CONFIG, **getattr(settings, "DATABASE_REPLICAS", {})}
+
+
+def get_cache():
+    return caches[get_replica_config()["CACHE_ALIAS"]]
+
+
+def pin_key(user_id):
+    return f"db:pinned:{user_id}"
+
+
+def pin_users(user_ids):
+    """Send the users' reads to the primary for the next STICKY_SECONDS."""
+    config = get_replica_config()
+    user_ids = set(user_ids)
+    if not config["ALIASES"] or not user_ids:
+        return
+    get_cache().set_many({pin_key(user_id): 1 for user_id in user_ids}, timeout=config["STICKY_SECONDS"])
+
+
+async def apin_users(user_ids):
+    config = get_replica_config()
+    user_ids = set(user_ids)
+    if not config["ALIASES"] or not user_ids:
+        return
+    await get_cache().aset_many({pin_key(user_id): 1 for user_id in user_ids}, timeout=config["STICKY_SECONDS"])
+
+
+class RoutingState:
+    # One per HTTP request; outside a request (consumers, tasks, shell) every read goes to the primary
+    def __init__(self, user_id=None, pinned=False):
+        self.user_id = user_id
+        self.pinned = pinned
+        self.wrote = False
+
+
+routing_state = ContextVar("routing_state", default=None)
+
+
+@contextmanager
+def request_routing(user_id, pinned=False):
+    """Route the reads of one request; the user is pinned afterwards if it wrote."""
+    if user_id is not None and not pinned:
+        pinned = get_cache().get(pin_key(user_id)) is not None
+    state = RoutingState(user_id, pinned)
+    token = routing_state.set(state)
+    try:
+        yield state
+    finally:
+        routing_state.reset(token)
+        if state.wrote and user_id is not None:
+            pin_users([user_id])
+
+
+@asynccontextmanager
+async def arequest_routing(user_id, pinned=False):
+    if user_id is not None and not pinned:
+        pinned = await get_cache().aget(pin_key(user_id)) is not None
+    state = RoutingState(user_id, pinned)
+    token = routing_state.set(state)
+    try:
+        yield state
+    finally:
+        routing_state.reset(token)
+        if state.wrote and user_id is not None:
+            await apin_users([user_id])
+
+
+def replica_lag(connection):
+    with connection.cursor() as cursor:
+        if connection.vendor != "postgresql":
+            cursor.execute("SELECT 1")
+            return 0.0
+        cursor.execute(LAG_SQL)
+        return float(cursor.fetchone()[0] or 0)
+
+
+class ReplicaHealth:
+    """
+    Which replicas may serve reads, as seen from this process.
+
+    Each replica is checked at most every CHECK_INTERVAL seconds, by the
+    thread that routes the next read to it. One that cannot be reached or
+    lags more than MAX_LAG seconds is ejected for EJECT_SECONDS, then
+    checked again before it serves anything.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked_at = {}  # alias -> monotonic time of the last check
+        self.ejected_until = {}  # alias -> monotonic time
+
+    def available(self, aliases):
+        config = get_replica_config()
+        healthy = []
+        for alias in aliases:
+            now = time.monotonic()
+            with self.lock:
+                if self.ejected_until.get(alias, 0) > now:
+                    continue
+                due = now - self.checked_at.get(alias, float("-inf")) >= config["CHECK_INTERVAL"]
+                if due:
+                    # Claimed here, so concurrent reads don't all run the check
+                    self.checked_at[alias] = now
+            if due and not self.check(alias, config):
+                continue
+            healthy.append(alias)
+        return healthy
+
+    def check(self, alias, config):
+        try:
+            lag = replica_lag(connections[alias])
+        except Exception as exc:
+            connections[alias].close()
+            self.eject(alias, f"unreachable: {exc}", config)
+            return False
+        if lag > config["MAX_LAG"]:
+            self.eject(alias, f"{lag:.1f}s behind", config)
+            return False
+        return True
+
+    def eject(self, alias, reason, config):
+        with self.lock:
+            self.ejected_until[alias] = time.monotonic() + config["EJECT_SECONDS"]
+            self.checked_at.pop(alias, None)
+        logger.warning(f"[FAIL] replica ejected -> {alias}: {reason}")
+
+    def clear(self):
+        with self.lock:
+            self.checked_at.clear()
+            self.ejected_until.clear()
+
+
+replica_health = ReplicaHealth()
+
+
+class PrimaryReplicaRouter:
+    """
+    Reads inside HTTP requests go to a healthy replica, everything else to default.
+
+    The primary still serves a request's reads when its user is pinned
+    (it, or a message to one of its chats, wrote something in the last
+    STICKY_SECONDS), once the request itself has written, inside a
+    transaction, and for apps not listed in APPS.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = routing_state.get()
+        if state is None or state.pinned:
+            return None
+        config = get_replica_config()
+        if not config["ALIASES"] or model._meta.app_label not in config["APPS"]:
+            return None
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        healthy = replica_health.available(config["ALIASES"])
+        return random.choice(healthy) if healthy else None
+
+    def db_for_write(self, model, **hints):
+        state = routing_state.get()
+        if state is not None:
+            state.wrote = state.pinned = True
+        # Explicitly: an instance read from a replica must still be saved to the primary
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *get_replica_config()["ALIASES"]}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
@@ -57,7 +57,8 @@ SIMPLE_JWT = {
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'Apps.Account.middleware.AsyncWhiteNoiseMiddleware',
+    'Apps.Account.middleware.ReadYourWritesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -97,8 +98,126 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Chat message persistence:
+#   "sync"         → each message is written before it is broadcast
+#   "write_behind" → broadcast first, bulk insert from an in-process buffer
+CHAT_MESSAGE_PERSISTENCE = os.getenv('CHAT_MESSAGE_PERSISTENCE', 'sync')
+CHAT_MESSAGE_BUFFER = {
+    "MAX_SIZE": 10000,
+    "BATCH_SIZE": 200,
+    "FLUSH_INTERVAL": 0.05,
+    "RETRIES": 3,
+    "RETRY_DELAY": 0.5,
+    "SHUTDOWN_TIMEOUT": 10,
+}
+
+# Typing indicators: "is typing" expires after TTL seconds without a frame,
+# and at most one broadcast per user per chat goes out every INTERVAL seconds
+CHAT_TYPING = {
+    "TTL": 5,
+    "INTERVAL": 1,
+}
+
+# Sidebar: the rendered first page of conversations is cached per user
+# under a version bumped by new messages, reads and contact profile edits
+CHAT_SIDEBAR_CACHE = {
+    "CACHE_ALIAS": "default",
+    "TIMEOUT": 300,
+}
+
+# User search: pg_trgm indexes on Postgres, an in-process prefix index
+# elsewhere; result ids are cached per query for CACHE_TIMEOUT seconds
+CHAT_USER_SEARCH = {
+    "BACKEND": "auto",
+    "CACHE_TIMEOUT": 30,
+}
+
+# Read receipts: each socket's read frames are coalesced for INTERVAL seconds
+# into one watermark UPDATE and one broadcast per chat
+CHAT_READ_RECEIPTS = {
+    "INTERVAL": 1,
+}
+
+# Presence: per-socket connection counts with heartbeats, kept in the
+# django-redis "default" cache; last_seen is flushed by chat.flush_presence
+CHAT_PRESENCE = {
+    "BACKEND": "redis",
+    "CACHE_ALIAS": "default",
+    "TTL": 60,
+    "HEARTBEAT_INTERVAL": 20,
+}
+
+# Chat membership checks: in-process LRU in front of the shared cache
+CHAT_MEMBERSHIP_CACHE = {
+    "CACHE_ALIAS": "default",
+    "TTL": 300,
+    "LOCAL_TTL": 5,
+    "MAX_CHATS": 10000,
+}
+
+# Resumable sockets: per-chat seq numbers, recent-history replay and
+# client idempotency keys
+CHAT_RESUME = {
+    "BUFFER_SIZE": 200,
+    "MAX_CHATS": 1000,
+    "MAX_REPLAY": 500,
+    "IDEMPOTENCY_TTL": 300,
+}
+
+# Chats one multiplexed socket may be subscribed to at the same time
+CHAT_SUBSCRIPTIONS = {
+    "MAX_PER_SOCKET": 100,
+}
+
+# Per-socket outbound queue; on overflow typing frames are shed first, then
+# "disconnect" closes with a resume hint or "drop_oldest" drops frames
+CHAT_OUTBOUND = {
+    "MAX_SIZE": 500,
+    "TYPING_HIGH_WATER": 50,
+    "OVERFLOW_POLICY": "disconnect",
+}
+
+# Cold archive: chat.archive_cold_messages moves messages older than
+# AFTER_DAYS into gzipped per-chat segments in the STORAGE alias (local
+# files by default, any object store backend in STORAGES); history reads
+# continue into them transparently
+CHAT_ARCHIVE = {
+    "STORAGE": "default",
+    "AFTER_DAYS": 180,
+    "SEGMENT_SIZE": 1000,
+    "CHATS_PER_RUN": 100,
+}
+
+# Chat export: rows per server-side cursor fetch and lines per streamed chunk
+CHAT_EXPORT = {
+    "CHUNK_SIZE": 2000,
+    "LINES_PER_WRITE": 500,
+}
+
+# WebSocket consumers: database calls in flight per worker process, each
+# on its own thread. None = one shared sync thread, the
+# database_sync_to_async default
+CHAT_CONSUMER_DB = {
+    "MAX_CONCURRENCY": 8,
+}
+
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
+#
+# psycopg_pool keeps one pool per process and database. Under ASGI every
+# HTTP request runs its sync work (sync views, sync_to_async, the async
+# ORM) on a thread of its own and holds a connection until
+# request_finished; a chat export holds one for the whole download. The
+# consumer DB threads (or the one sync thread) hold one each on top. The
+# default pool covers DB_POOL_HTTP_CONCURRENCY such requests per process;
+# past max_size, checkouts wait up to `timeout` and fail with PoolTimeout.
+# Postgres needs nodes × processes × DB_POOL_MAX_SIZE connections at most,
+# with no PgBouncer in between; Celery prefork children use one thread
+# and grow their pool to one.
+DB_POOL_HTTP_CONCURRENCY = int(os.getenv('DB_POOL_HTTP_CONCURRENCY', 20))
+DB_POOL_MAX_SIZE = int(os.getenv(
+    'DB_POOL_MAX_SIZE', DB_POOL_HTTP_CONCURRENCY + (CHAT_CONSUMER_DB["MAX_CONCURRENCY"] or 1)
+))
 DATABASES = {
         'default': {
             'ENGINE': 'django.db.backends.postgresql',
@@ -107,13 +226,46 @@ DATABASES = {
             'PASSWORD': os.getenv('DB_PASSWORD'),
             'HOST': os.getenv('DB_HOST'),
             'PORT': os.getenv('DB_PORT'),
-            'CONN_MAX_AGE': 60,
-            'options': {
-                'sslmode': 'require',
+            # Pooled connections go back to the pool after every request
+            # instead of being kept per thread
+            'CONN_MAX_AGE': 0,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'sslmode': os.getenv('DB_SSLMODE', 'prefer'),
+                'pool': {
+                    'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 1)),
+                    'max_size': DB_POOL_MAX_SIZE,
+                    'timeout': 10,  # seconds a checkout waits before PoolTimeout
+                    'max_idle': 300,
+                    'max_lifetime': 1800,
+                },
             }
         }
     }
 
+# Pool statistics: each process publishes a snapshot to the cache at most
+# every INTERVAL seconds; `manage.py db_pool_stats` adds them up
+DB_POOL_METRICS = {
+    "CACHE_ALIAS": "default",
+    "INTERVAL": 15,
+}
+
+# Read replicas: DB_REPLICA_HOSTS=host1,host2 adds replica_1, replica_2, ...
+# with default's credentials. ChatApp reads inside HTTP requests go to a
+# healthy replica; a user stays on the primary for STICKY_SECONDS after a
+# write that concerns them. Consumers and tasks always use the primary.
+DATABASE_ROUTERS = ['WebChat.db_router.PrimaryReplicaRouter']
+DATABASE_REPLICAS = {
+    "ALIASES": [],
+    "STICKY_SECONDS": 10,
+    "MAX_LAG": 5,
+    "CHECK_INTERVAL": 5,
+    "EJECT_SECONDS": 30,
+}
+for number, host in enumerate(filter(None, os.getenv('DB_REPLICA_HOSTS', '').split(',')), start=1):
+    DATABASES[f'replica_{number}'] = {**DATABASES['default'], 'HOST': host.strip()}
+    DATABASE_REPLICAS["ALIASES"].append(f'replica_{number}')
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 AUTH_PASSWORD_VALIDATORS = [
@@ -198,6 +350,22 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'Asia/Kolkata'
 
+# Periodic tasks (run the worker with -B or a separate celery beat)
+CELERY_BEAT_SCHEDULE = {
+    "flush-presence": {
+        "task": "chat.flush_presence",
+        "schedule": 30.0,
+    },
+    "index-unindexed-messages": {
+        "task": "chat.index_unindexed_messages",
+        "schedule": 60.0,
+    },
+    "archive-cold-messages": {
+        "task": "chat.archive_cold_messages",
+        "schedule": 3600.0,
+    },
+}
+
 # Password send an email link expired in 5 min
 PASSWORD_RESET_TIMEOUT = 300
 
@@ -7,8 +7,15 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": ":memory:",
-    }
+    },
+    # Separate database standing in for a read replica; only tests that
+    # enable it through DATABASE_REPLICAS route anything there
+    "replica": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": ":memory:",
+    },
 }
+DATABASE_REPLICAS = {"ALIASES": []}
 
 # Use in-memory email backend (safe + testable)
 EMAIL_BACKEND = "django.core.mail.backends.locmem.EmailBackend"
@@ -33,6 +40,13 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Presence kept in process memory instead of Redis
+CHAT_PRESENCE = {
+    "BACKEND": "local",
+    "TTL": 60,
+    "HEARTBEAT_INTERVAL": 20,
+}
+
 # Speed up tests: faster password hashing
 PASSWORD_HASHERS = [
     "django.contrib.auth.hashers.MD5PasswordHasher",
@@ -1,4 +1,5 @@
 let userMenuVisible = false;
+const SEARCH_DEBOUNCE_MS = 250;
 
 function toggleUserMenu() {
     const menu = document.getElementById('userMenu');
@@ -9,7 +10,49 @@ function toggleUserMenu() {
     btn.classList.toggle('active', userMenuVisible);
 }
 
+let loadingConversations = false;
+
+function markActiveConversation(root) {
+    // Kept out of the cached sidebar HTML so every room can share it
+    if (typeof chatId === 'undefined') return;
+    const item = root.querySelector(`.contact-item[data-chat-id="${chatId}"]`);
+    if (item) item.classList.add('active');
+}
+
+function initConversationPaging() {
+    const list = document.getElementById('contactsList');
+    const items = document.getElementById('conversationItems');
+    if (!list || !items) return;
+    markActiveConversation(items);
+
+    list.addEventListener('scroll', () => {
+        if (list.scrollTop + list.clientHeight >= list.scrollHeight - 200) {
+            loadMoreConversations(items);
+        }
+    });
+}
+
+function loadMoreConversations(items) {
+    // The sidebar is keyset-paginated, the cursor rides on the container
+    const next = items.dataset.next;
+    if (!next || loadingConversations) return;
+    loadingConversations = true;
+
+    fetch(`/api/conversations/?before=${encodeURIComponent(next)}`)
+        .then(res => res.json())
+        .then(data => {
+            items.insertAdjacentHTML('beforeend', data.html);
+            markActiveConversation(items);
+            items.dataset.next = data.next || '';
+        })
+        .catch(err => console.error('Failed to load conversations', err))
+        .finally(() => {
+            loadingConversations = false;
+        });
+}
+
 document.addEventListener('DOMContentLoaded', () => {
+    initConversationPaging();
 
     const menuBtn = document.getElementById('menuBtn');
     if (menuBtn) {
@@ -33,53 +76,65 @@ document.addEventListener('DOMContentLoaded', () => {
 
     if (!searchInput) return;
 
+    let searchTimer;
+    let searchController;
+
     searchInput.addEventListener('input', () => {
         const q = searchInput.value.trim();
+        clearTimeout(searchTimer);
+        if (searchController) searchController.abort();
         if (!q) {
             resultsDiv.style.display = 'none';
             return;
         }
 
-        fetch(`/api/search-users/?q=${encodeURIComponent(q)}`)
-            .then(res => res.json())
-            .then(data => {
-                resultsDiv.innerHTML = '';
-                if (!data.users.length) {
-                    resultsDiv.innerHTML =
-                        `<div class="dropdown-item">No users found</div>`;
-                }2
-
-                // data.users.forEach(user => {
-                //     const div = document.createElement('div');
-                //     div.className = 'dropdown-item';
-                //     div.textContent = user.full_name;
-                //     div.onclick = () => location.href = `/start-chat/${user.id}/`;
-                //     resultsDiv.appendChild(div);
-                // });
-                data.users.forEach(user => {
-                        const div = document.createElement('div');
-                        div.className = 'dropdown-item search-result-item';
-
-                        const avatarHtml = user.profile_image
-                        ? `<img src="${user.profile_image}" class="search-avatar-img" alt="">`
-                        : `<div class="search-avatar-initials">${user.initials}</div>`;
-
-                    div.innerHTML = `
-                        <div class="search-avatar-container">
-                            ${avatarHtml}
-                            ${user.is_online ? '<div class="online-indicator-small"></div>' : ''}
-                        </div>
-                        <div class="search-info">
-<!--                            <div class="search-name">${user.full_name}</div>-->
-                            <div class="search-username">${user.username}</div>
-                        </div>
-                    `;
-                    div.onclick = () => location.href = `/start-chat/${user.id}/`;
-                    resultsDiv.appendChild(div);
-                });
+        // One request per pause in typing; a newer query aborts the older one
+        searchTimer = setTimeout(() => {
+            searchController = new AbortController();
+            fetch(`/api/search-users/?q=${encodeURIComponent(q)}`, { signal: searchController.signal })
+                .then(res => res.json())
+                .then(data => {
+                    resultsDiv.innerHTML = '';
+                    if (!data.users.length) {
+                        resultsDiv.innerHTML =
+                            `<div class="dropdown-item">No users found</div>`;
+                    }2
 
-                resultsDiv.style.display = 'block';
-            });
+                    // data.users.forEach(user => {
+                    //     const div = document.createElement('div');
+                    //     div.className = 'dropdown-item';
+                    //     div.textContent = user.full_name;
+                    //     div.onclick = () => location.href = `/start-chat/${user.id}/`;
+                    //     resultsDiv.appendChild(div);
+                    // });
+                    data.users.forEach(user => {
+                            const div = document.createElement('div');
+                            div.className = 'dropdown-item search-result-item';
+
+                            const avatarHtml = user.profile_image
+                            ? `<img src="${user.profile_image}" class="search-avatar-img" alt="">`
+                            : `<div class="search-avatar-initials">${user.initials}</div>`;
+
+                        div.innerHTML = `
+                            <div class="search-avatar-container">
+                                ${avatarHtml}
+                                ${user.is_online ? '<div class="online-indicator-small"></div>' : ''}
+                            </div>
+                            <div class="search-info">
+    <!--                            <div class="search-name">${user.full_name}</div>-->
+                                <div class="search-username">${user.username}</div>
+                            </div>
+                        `;
+                        div.onclick = () => location.href = `/start-chat/${user.id}/`;
+                        resultsDiv.appendChild(div);
+                    });
+
+                    resultsDiv.style.display = 'block';
+                })
+                .catch(err => {
+                    if (err.name !== 'AbortError') console.error('User search failed', err);
+                });
+        }, SEARCH_DEBOUNCE_MS);
     });
 
     document.addEventListener('keydown', e => {
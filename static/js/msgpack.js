@@ -0,0 +1,176 @@
+// MessagePack for the webchat.msgpack socket protocol, served with the app
+// instead of a third-party CDN. Covers what chat frames carry: nil, booleans,
+// integers, floats, strings, binary, arrays and maps. Exposes the same
+// MessagePack.encode / MessagePack.decode that room.js calls.
+(() => {
+    const textEncoder = new TextEncoder();
+    const textDecoder = new TextDecoder();
+
+    function encode(value) {
+        const bytes = [];
+
+        function pushUint(number, size) {
+            for (let shift = (size - 1) * 8; shift >= 0; shift -= 8) {
+                bytes.push(Math.floor(number / 2 ** shift) & 0xff);
+            }
+        }
+
+        function pushFloat64(number) {
+            const view = new DataView(new ArrayBuffer(8));
+            view.setFloat64(0, number);
+            bytes.push(0xcb, ...new Uint8Array(view.buffer));
+        }
+
+        function pushInt(number) {
+            if (number >= 0) {
+                if (number < 0x80) bytes.push(number);
+                else if (number < 0x100) bytes.push(0xcc, number);
+                else if (number < 0x10000) { bytes.push(0xcd); pushUint(number, 2); }
+                else if (number < 0x100000000) { bytes.push(0xce); pushUint(number, 4); }
+                else { bytes.push(0xcf); pushUint(number, 8); }
+            } else if (number >= -0x20) {
+                bytes.push(number & 0xff);
+            } else if (number >= -0x80) {
+                bytes.push(0xd0, number & 0xff);
+            } else if (number >= -0x8000) {
+                bytes.push(0xd1); pushUint(number + 0x10000, 2);
+            } else if (number >= -0x80000000) {
+                bytes.push(0xd2); pushUint(number + 0x100000000, 4);
+            } else {
+                pushFloat64(number);
+            }
+        }
+
+        function pushLength(length, fixBase, fixMax, codes) {
+            if (fixBase !== null && length <= fixMax) bytes.push(fixBase | length);
+            else if (codes[0] && length < 0x100) bytes.push(codes[0], length);
+            else if (length < 0x10000) { bytes.push(codes[1]); pushUint(length, 2); }
+            else { bytes.push(codes[2]); pushUint(length, 4); }
+        }
+
+        function write(item) {
+            if (item === null || item === undefined) {
+                bytes.push(0xc0);
+            } else if (item === true || item === false) {
+                bytes.push(item ? 0xc3 : 0xc2);
+            } else if (typeof item === 'number') {
+                if (Number.isSafeInteger(item)) pushInt(item);
+                else pushFloat64(item);
+            } else if (typeof item === 'string') {
+                const encoded = textEncoder.encode(item);
+                pushLength(encoded.length, 0xa0, 31, [0xd9, 0xda, 0xdb]);
+                encoded.forEach(byte => bytes.push(byte));
+            } else if (item instanceof Uint8Array) {
+                pushLength(item.length, null, 0, [0xc4, 0xc5, 0xc6]);
+                item.forEach(byte => bytes.push(byte));
+            } else if (Array.isArray(item)) {
+                pushLength(item.length, 0x90, 15, [null, 0xdc, 0xdd]);
+                item.forEach(write);
+            } else {
+                const keys = Object.keys(item).filter(key => item[key] !== undefined);
+                pushLength(keys.length, 0x80, 15, [null, 0xde, 0xdf]);
+                keys.forEach(key => {
+                    write(key);
+                    write(item[key]);
+                });
+            }
+        }
+
+        write(value);
+        return new Uint8Array(bytes);
+    }
+
+    function decode(data) {
+        const view = new DataView(data.buffer, data.byteOffset, data.byteLength);
+        let offset = 0;
+
+        function take(size) {
+            const start = offset;
+            offset += size;
+            if (offset > data.length) throw new RangeError('Truncated MessagePack data');
+            return start;
+        }
+
+        function uint(size) {
+            const start = take(size);
+            if (size === 1) return view.getUint8(start);
+            if (size === 2) return view.getUint16(start);
+            if (size === 4) return view.getUint32(start);
+            return Number(view.getBigUint64(start));
+        }
+
+        function int(size) {
+            const start = take(size);
+            if (size === 1) return view.getInt8(start);
+            if (size === 2) return view.getInt16(start);
+            if (size === 4) return view.getInt32(start);
+            return Number(view.getBigInt64(start));
+        }
+
+        function str(length) {
+            const start = take(length);
+            return textDecoder.decode(data.subarray(start, start + length));
+        }
+
+        function bin(length) {
+            const start = take(length);
+            return data.slice(start, start + length);
+        }
+
+        function array(length) {
+            const items = [];
+            for (let i = 0; i < length; i++) items.push(read());
+            return items;
+        }
+
+        function map(length) {
+            const items = {};
+            for (let i = 0; i < length; i++) {
+                const key = read();
+                items[key] = read();
+            }
+            return items;
+        }
+
+        function read() {
+            const code = uint(1);
+            if (code < 0x80) return code;
+            if (code < 0x90) return map(code & 0x0f);
+            if (code < 0xa0) return array(code & 0x0f);
+            if (code < 0xc0) return str(code & 0x1f);
+            if (code >= 0xe0) return code - 0x100;
+            switch (code) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: return bin(uint(1));
+                case 0xc5: return bin(uint(2));
+                case 0xc6: return bin(uint(4));
+                case 0xca: return view.getFloat32(take(4));
+                case 0xcb: return view.getFloat64(take(8));
+                case 0xcc: return uint(1);
+                case 0xcd: return uint(2);
+                case 0xce: return uint(4);
+                case 0xcf: return uint(8);
+                case 0xd0: return int(1);
+                case 0xd1: return int(2);
+                case 0xd2: return int(4);
+                case 0xd3: return int(8);
+                case 0xd9: return str(uint(1));
+                case 0xda: return str(uint(2));
+                case 0xdb: return str(uint(4));
+                case 0xdc: return array(uint(2));
+                case 0xdd: return array(uint(4));
+                case 0xde: return map(uint(2));
+                case 0xdf: return map(uint(4));
+                default: throw new TypeError(`Unsupported MessagePack type 0x${code.toString(16)}`);
+            }
+        }
+
+        const value = read();
+        if (offset !== data.length) throw new RangeError('Trailing bytes after MessagePack value');
+        return value;
+    }
+
+    window.MessagePack = { encode, decode };
+})();
@@ -3,6 +3,50 @@ let typingTimer;
 let reconnectAttempts = 0;
 const maxReconnectAttempts = 5;
 
+// Highest seq rendered so far; reconnects resume from here instead of reloading
+let lastSeq = initialLastSeq;
+// Sent messages not yet echoed back, keyed by client_id, resent after a reconnect
+const outbox = new Map();
+// Set from a resume request until its 'resumed' marker; frames arriving
+// meanwhile (replayed or live) are held and rendered together in seq order
+let resuming = false;
+let pendingFrames = [];
+
+// Cursor for the page before the oldest rendered message
+let olderCursor = null;
+let hasOlder = false;
+let loadingOlder = false;
+
+// MessagePack when the optional library is loaded, JSON otherwise
+const wireProtocols = window.MessagePack ? ['webchat.msgpack', 'webchat.json'] : ['webchat.json'];
+
+function sendFrame(frame) {
+    if (chatSocket.protocol === 'webchat.msgpack') {
+        chatSocket.send(MessagePack.encode(frame));
+    } else {
+        chatSocket.send(JSON.stringify(frame));
+    }
+}
+
+function decodeFrame(data) {
+    if (data instanceof ArrayBuffer) {
+        return MessagePack.decode(new Uint8Array(data));
+    }
+    return JSON.parse(data);
+}
+
+function newClientId() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+}
+
+function formatTime(epochMs) {
+    return new Date(epochMs).toLocaleTimeString([], {
+        hour: 'numeric',
+        minute: '2-digit'
+    });
+}
+
 function updateConnectionStatus(status) {
     const statusEl = document.getElementById('connectionStatus');
     const sendBtn = document.getElementById('sendBtn');
@@ -26,15 +70,60 @@ function initWebSocket() {
     updateConnectionStatus('connecting');
 
     const protocol = location.protocol === 'https:' ? 'wss' : 'ws';
-    chatSocket = new WebSocket(`${protocol}://${location.host}/ws/chat/${chatId}/`);
+    // One socket per user; chats are joined with subscribe/resume frames
+    chatSocket = new WebSocket(`${protocol}://${location.host}/ws/chat/`, wireProtocols);
+    chatSocket.binaryType = 'arraybuffer';
 
-    chatSocket.onopen = () => updateConnectionStatus('connected');
+    chatSocket.onopen = () => {
+        // Replays only what was missed since the last rendered message
+        pendingFrames = [];
+        requestResume();
+    };
 
     chatSocket.onmessage = e => {
-        const data = JSON.parse(e.data);
+        const data = decodeFrame(e.data);
+
+        // Ignore events for other chats carried on the same socket
+        if (data.chat_id !== chatId) return;
+
+        if (data.type === 'resumed') {
+            resuming = false;
+            // The replay is complete up to here; a seq still missing is a
+            // permanent hole (deleted sender, failed write) and is skipped
+            pendingFrames
+                .sort((a, b) => a.seq - b.seq)
+                .forEach(frame => {
+                    if (frame.seq > lastSeq) renderFrame(frame);
+                });
+            pendingFrames = [];
+            updateConnectionStatus('connected');
+            // Retries keep their client_id, so the server drops duplicates
+            outbox.forEach(frame => sendFrame(frame));
+        }
+
+        if (data.type === 'error' && data.error === 'resync_required') {
+            location.reload();
+        }
 
         if (data.type === 'chat_message') {
-            addMessage(data.message, data.sender_id === currentUserId);
+            if (data.client_id) outbox.delete(data.client_id);
+            // Replays and live events can overlap right after a resume
+            if (data.seq && data.seq <= lastSeq) return;
+            if (resuming) {
+                pendingFrames.push(data);
+                return;
+            }
+            // Frames were dropped server-side: replay the gap by seq
+            if (data.seq && data.seq > lastSeq + 1) {
+                pendingFrames.push(data);
+                requestResume();
+                return;
+            }
+            renderFrame(data);
+        }
+
+        if (data.type === 'read_receipt' && data.user_id !== currentUserId) {
+            showReadUpTo(data.seq);
         }
 
         if (data.type === 'typing_indicator') {
@@ -42,29 +131,114 @@ function initWebSocket() {
         }
     };
 
-    chatSocket.onclose = () => {
+    chatSocket.onclose = e => {
         updateConnectionStatus('disconnected');
+        // 4008: dropped as a slow consumer, reconnect and resume right away
+        if (e.code === 4008) {
+            setTimeout(initWebSocket, 500);
+            return;
+        }
         if (reconnectAttempts++ < maxReconnectAttempts) {
             setTimeout(initWebSocket, reconnectAttempts * 3000);
         }
     };
 }
 
-function addMessage(text, isOwn) {
-    const container = document.getElementById('messagesContainer');
+function requestResume() {
+    resuming = true;
+    sendFrame({ type: 'resume', chat_id: chatId, last_seq: lastSeq });
+}
+
+function renderFrame(data) {
+    if (data.seq) lastSeq = data.seq;
+    addMessage(data.message, data.sender_id === currentUserId, data.timestamp, data.message_id, data.seq);
+    if (data.sender_id !== currentUserId) markRead(data.seq);
+}
+
+function buildMessage(text, isOwn, timestamp, messageId, seq) {
     const msg = document.createElement('div');
     msg.className = `message ${isOwn ? 'sent' : 'received'}`;
+    if (messageId) msg.dataset.messageId = messageId;
+    // Read receipts go by seq: write-behind messages have no id yet
+    if (seq) msg.dataset.seq = seq;
     msg.innerHTML = `
         <div class="message-text">${escapeHtml(text)}</div>
-        <div class="message-time">${new Date().toLocaleTimeString([], {
-            hour: 'numeric',
-            minute: '2-digit'
-        })}</div>
+        <div class="message-time">${formatTime(timestamp || Date.now())}</div>
     `;
-    container.appendChild(msg);
+    return msg;
+}
+
+function addMessage(text, isOwn, timestamp, messageId, seq) {
+    const container = document.getElementById('messagesContainer');
+    container.appendChild(buildMessage(text, isOwn, timestamp, messageId, seq));
     container.scrollTop = container.scrollHeight;
 }
 
+function markRead(seq) {
+    // The server coalesces these, one per message is fine
+    if (!seq || document.hidden || chatSocket.readyState !== WebSocket.OPEN) return;
+    sendFrame({ type: 'read', chat_id: chatId, seq: seq });
+}
+
+function showReadUpTo(seq) {
+    document.querySelectorAll('#messagesContainer .message.sent[data-seq]').forEach(msg => {
+        if (Number(msg.dataset.seq) <= seq) msg.classList.add('read');
+    });
+}
+
+function initHistory() {
+    const container = document.getElementById('messagesContainer');
+    olderCursor = container.dataset.before || null;
+    hasOlder = container.dataset.hasOlder === 'true';
+
+    // The server-rendered tail carries epoch ms, formatted here like live and paged messages
+    container.querySelectorAll('.message[data-timestamp]').forEach(msg => {
+        msg.querySelector('.message-time').textContent = formatTime(Number(msg.dataset.timestamp));
+    });
+
+    container.scrollTop = container.scrollHeight;
+    container.addEventListener('scroll', () => {
+        if (container.scrollTop < 100) loadOlderMessages();
+    });
+    fillViewport();
+}
+
+function fillViewport() {
+    // A short tail leaves nothing to scroll, so keep paging until it overflows
+    const container = document.getElementById('messagesContainer');
+    if (container.scrollHeight <= container.clientHeight) loadOlderMessages();
+}
+
+async function loadOlderMessages() {
+    if (loadingOlder || !hasOlder || !olderCursor) return;
+    loadingOlder = true;
+
+    try {
+        const res = await fetch(`${historyUrl}?before=${encodeURIComponent(olderCursor)}`, {
+            credentials: 'same-origin'
+        });
+        if (!res.ok) return;
+        const page = await res.json();
+
+        const container = document.getElementById('messagesContainer');
+        const previousHeight = container.scrollHeight;
+        const fragment = document.createDocumentFragment();
+        page.messages.forEach(m => fragment.appendChild(buildMessage(m.content, m.is_own, m.timestamp, m.id, m.seq)));
+        container.insertBefore(fragment, container.firstChild);
+        // Keep the message under the reader in place
+        container.scrollTop += container.scrollHeight - previousHeight;
+
+        olderCursor = page.before;
+        hasOlder = page.has_older;
+    } catch (err) {
+        console.error('Failed to load older messages', err);
+        return;
+    } finally {
+        loadingOlder = false;
+    }
+    fillViewport();
+}
+
 function escapeHtml(text) {
     const d = document.createElement('div');
     d.textContent = text;
@@ -83,6 +257,13 @@ function toggleTyping(show, user = '') {
 
 document.addEventListener('DOMContentLoaded', () => {
     initWebSocket();
+    initHistory();
+
+    document.addEventListener('visibilitychange', () => {
+        // Messages that arrived while the tab was hidden are read on return
+        const received = document.querySelectorAll('#messagesContainer .message.received[data-seq]');
+        if (received.length) markRead(Number(received[received.length - 1].dataset.seq));
+    });
     initMessageSearch();
 
     document.getElementById('sendBtn').onclick = sendMessage;
@@ -95,10 +276,10 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     document.getElementById('messageInput').addEventListener('input', () => {
-        chatSocket.send(JSON.stringify({ type: 'typing', is_typing: true }));
+        sendFrame({ type: 'typing', chat_id: chatId, is_typing: true });
         clearTimeout(typingTimer);
         typingTimer = setTimeout(() => {
-            chatSocket.send(JSON.stringify({ type: 'typing', is_typing: false }));
+            sendFrame({ type: 'typing', chat_id: chatId, is_typing: false });
         }, 1000);
     });
 });
@@ -108,40 +289,68 @@ function sendMessage() {
     const msg = input.value.trim();
     if (!msg || chatSocket.readyState !== WebSocket.OPEN) return;
 
-    chatSocket.send(JSON.stringify({
+    const frame = {
         type: 'chat_message',
+        chat_id: chatId,
+        client_id: newClientId(),
         message: msg
-    }));
+    };
+    outbox.set(frame.client_id, frame);
+    sendFrame(frame);
 
     input.value = '';
 }
 
 function initMessageSearch() {
     const searchInput = document.getElementById('chatSearchInput');
-    const messagesContainer = document.getElementById('messagesContainer');
+    const resultsDiv = document.getElementById('chatSearchResults');
 
     if (!searchInput) return;
 
+    let searchTimer;
+    let searchController;
+
+    // Searches the whole chat on the server, not just the rendered tail
     searchInput.addEventListener('input', () => {
-        const query = searchInput.value.toLowerCase().trim();
-        const messages = messagesContainer.querySelectorAll('.message');
-
-        messages.forEach(msg => {
-            const text = msg.querySelector('.message-text').textContent.toLowerCase();
-            if (text.includes(query)) {
-                msg.style.display = 'block';
-                // Remove highlighting if it exists
-                msg.querySelector('.message-text').innerHTML = escapeHtml(msg.querySelector('.message-text').textContent);
-
-                if (query !== '') {
-                    // Simple highlighting
-                    const originalText = msg.querySelector('.message-text').textContent;
-                    const regex = new RegExp(`(${query})`, 'gi');
-                    msg.querySelector('.message-text').innerHTML = originalText.replace(regex, '<mark>$1</mark>');
-                }
-            } else {
-                msg.style.display = 'none';
-            }
-        });
+        const query = searchInput.value.trim();
+        clearTimeout(searchTimer);
+        if (searchController) searchController.abort();
+        if (!query) {
+            resultsDiv.style.display = 'none';
+            return;
+        }
+
+        searchTimer = setTimeout(() => {
+            searchController = new AbortController();
+            const params = new URLSearchParams({ q: query, chat: chatId });
+            fetch(`/api/search-messages/?${params}`, { signal: searchController.signal })
+                .then(res => res.json())
+                .then(data => {
+                    resultsDiv.innerHTML = '';
+                    if (!data.results.length) {
+                        resultsDiv.innerHTML = `<div class="dropdown-item">No messages found</div>`;
+                    }
+                    data.results.forEach(result => {
+                        const div = document.createElement('div');
+                        div.className = 'dropdown-item search-result-item';
+                        // Snippets arrive escaped, with matches wrapped in <mark>
+                        div.innerHTML = `
+                            <div class="search-info">
+                                <div class="search-username">${escapeHtml(result.sender)} · ${formatTime(result.timestamp)}</div>
+                                <div class="search-snippet">${result.snippet}</div>
+                            </div>
+                        `;
+                        resultsDiv.appendChild(div);
+                    });
+                    resultsDiv.style.display = 'block';
+                })
+                .catch(err => {
+                    if (err.name !== 'AbortError') console.error('Message search failed', err);
+                });
+        }, 250);
+    });
+
+    document.addEventListener('keydown', e => {
+        if (e.key === 'Escape') resultsDiv.style.display = 'none';
     });
 }